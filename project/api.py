@@ -0,0 +1,175 @@
+# api.py
+"""JSON API v1 для мобильного клиента: книги, жанры, одобренные рецензии.
+
+Выдача строится теми же запросами, что и HTML-страницы (book_list_query,
+book_reviews_query, keyset_paginate), только без шаблонов:
+- курсоры after/before вместо номеров страниц, limit ≤ API_MAX_PAGE_SIZE;
+- fields=id,title,… — в ответ попадают только перечисленные поля, а
+  описание не читается из БД, если его не просили (по умолчанию в списке
+  его нет);
+- слабый ETag из updated_at строк (и справочника жанров, если жанры в
+  ответе): при совпадении с If-None-Match — 304 без сериализации;
+- gzip, если клиент его принимает и ответ больше API_GZIP_MIN_BYTES.
+"""
+import gzip
+import hashlib
+import json
+
+from flask import Response, current_app, request
+from sqlalchemy.orm import defer
+
+from covers import DERIVATIVE_FORMATS, DERIVATIVE_SIZES, derivative_path
+from models import Book, Review, lookups
+
+# меняется вместе с форматом ответа — старые ETag клиентов перестают совпадать
+SCHEMA_VERSION = 1
+
+
+class ApiError(Exception):
+    """Ошибка запроса к API: отдаётся как {"error": message} с кодом status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# ──────────────── ПАРАМЕТРЫ ЗАПРОСА ─────────────────────────────
+def parse_fields(allowed, default):
+    """fields=a,b из query string → кортеж имён (порядок — как в allowed)."""
+    spec = request.args.get("fields")
+    if not spec:
+        return default
+    wanted = {f.strip() for f in spec.split(",") if f.strip()}
+    unknown = wanted - set(allowed)
+    if unknown:
+        raise ApiError(400, f"неизвестные поля: {', '.join(sorted(unknown))}; "
+                            f"допустимо: {', '.join(allowed)}")
+    return tuple(f for f in allowed if f in wanted) or default
+
+
+def parse_limit():
+    config = current_app.config
+    limit = request.args.get("limit", config["API_PAGE_SIZE"], type=int)
+    return min(max(limit, 1), config["API_MAX_PAGE_SIZE"])
+
+
+# ──────────────── ПОЛЯ ──────────────────────────────────────────
+def _iso(value):
+    return value.isoformat() + "Z" if value else None      # в БД — наивное UTC
+
+
+def book_modified(book):
+    """Время последнего изменения книги или её агрегатов рейтинга."""
+    stamps = [book.updated_at, book.stats.updated_at if book.stats else None]
+    return max((s for s in stamps if s), default=None)
+
+
+def cover_info(cover, link):
+    if cover is None:
+        return None
+    info = {"url": link(cover.filename)}
+    for size in DERIVATIVE_SIZES:
+        for fmt in DERIVATIVE_FORMATS:
+            info[f"{size}_{fmt}"] = link(derivative_path(cover.filename, size, fmt))
+    return info
+
+
+BOOK_FIELDS = {
+    "id": lambda b, link: b.id,
+    "title": lambda b, link: b.title,
+    "author": lambda b, link: b.author,
+    "year": lambda b, link: b.year,
+    "publisher": lambda b, link: b.publisher,
+    "pages": lambda b, link: b.pages,
+    "genres": lambda b, link: [{"id": g.id, "name": g.name} for g in b.genres],
+    "cover": lambda b, link: cover_info(b.cover, link),
+    "avg_rating": lambda b, link: b.avg_rating(),
+    "review_count": lambda b, link: b.review_count,
+    "description": lambda b, link: b.description,
+    "description_html": lambda b, link: b.description_html,
+    "updated_at": lambda b, link: _iso(book_modified(b)),
+}
+BOOK_LIST_FIELDS = tuple(f for f in BOOK_FIELDS if not f.startswith("description"))
+
+REVIEW_FIELDS = {
+    "id": lambda r: r.id,
+    "book_id": lambda r: r.book_id,
+    "rating": lambda r: r.rating,
+    "text": lambda r: r.text_md,
+    "text_html": lambda r: r.text_html,
+    "author": lambda r: r.user.full_name,
+    "created_at": lambda r: _iso(r.created_at),
+    "updated_at": lambda r: _iso(r.updated_at),
+}
+
+
+def book_query(query, fields):
+    """Не читать описание и его HTML, если ни то ни другое не запрошено."""
+    if "description" not in fields and "description_html" not in fields:
+        query = query.options(defer(Book.description), defer(Book.description_rendered))
+    return query
+
+
+def review_query(query, fields):
+    if "text" not in fields and "text_html" not in fields:
+        query = query.options(defer(Review.text_md), defer(Review.text_rendered))
+    return query
+
+
+def serialize_book(book, fields, link):
+    return {f: BOOK_FIELDS[f](book, link) for f in fields}
+
+
+def serialize_review(review, fields):
+    return {f: REVIEW_FIELDS[f](review) for f in fields}
+
+
+def page_payload(page, items):
+    return {"items": items, "next_cursor": page.next_cursor, "prev_cursor": page.prev_cursor}
+
+
+# ──────────────── ETAG И ОТВЕТ ──────────────────────────────────
+def book_version(book):
+    return book.id, _iso(book_modified(book)), book.cover.md5_hash if book.cover else None
+
+
+def lookups_version(fields):
+    """Имена жанров берутся из справочника: переименование жанра меняет ответ,
+    не трогая updated_at книг, поэтому справочник входит в ETag."""
+    return lookups.genre_choices() if "genres" in fields else None
+
+
+def review_version(review):
+    return review.id, _iso(review.updated_at)
+
+
+def make_etag(*parts):
+    """Хэш версий строк, попавших в ответ (плюс запрошенные поля и курсоры)."""
+    raw = json.dumps([SCHEMA_VERSION, *parts], default=str, separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def conditional_json(etag, build):
+    """304, если ETag совпал с If-None-Match, иначе JSON из build() (возможно, gzip)."""
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        body = json.dumps(build(), ensure_ascii=False, separators=(",", ":")).encode()
+        resp = Response(body, mimetype="application/json")
+        _compress(resp)
+    resp.set_etag(etag, weak=True)      # слабый: gzip и без него — один и тот же ресурс
+    resp.cache_control.public = True
+    resp.cache_control.no_cache = True  # кэшировать можно, но только с перепроверкой
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def _compress(resp):
+    body = resp.get_data()
+    if (len(body) < current_app.config["API_GZIP_MIN_BYTES"]
+            or not request.accept_encodings["gzip"]):
+        return
+    resp.set_data(gzip.compress(body, compresslevel=current_app.config["API_GZIP_LEVEL"],
+                                mtime=0))
+    resp.headers["Content-Encoding"] = "gzip"
@@ -1,30 +1,46 @@
+import hmac
 import os
-import hashlib
-import random
-import requests, hashlib
+import signal
+import sys
+import time
 from functools import wraps
 import click
-from faker import Faker
 from flask import (
-    Flask, redirect, url_for, flash, request,
-    render_template, send_from_directory
+    Flask, Response, redirect, url_for, flash, request, abort, jsonify,
+    render_template, send_from_directory, session
 )
 from flask_login import current_user, login_user, logout_user
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash
+from sqlalchemy.exc import IntegrityError
                      
 
 from config import Config
-from extensions import db, login_manager
+from extensions import db, login_manager, page_cache, instrumentation, job_queue
 from models import (
     Role, User, Genre, Cover,
-    Book, Review, ReviewStatus
+    Book, BookStats, Review,
+    adjust_book_stats, rebuild_book_stats,
+    backfill_rendered_html, lookups, identities,
+    book_list_query, book_detail_query, book_reviews_query, BOOK_REVIEW_SORTS,
+    similar_books_query,
+    moderation_reviews_query, user_reviews_query, review_detail_query
 )
 from forms import LoginForm, BookForm, ReviewForm
+from pagination import keyset_paginate, cached_count
+import migrations
+import dbconfig
+import seeding
+import markup
+import api
+import search
+import facets
+import tasks
+from moderation import bulk_change_status, claim_batch, release_claims
+from covers import (
+    store_upload, attach_cover, make_derivatives, derivative_path, parse_upload_name
+)
 
 
 # ────────────────────────────────────────────────────────────────
-fake = Faker("ru_RU")            # единый экземпляр Faker
 
 
 def create_app() -> Flask:
@@ -33,95 +49,54 @@ def create_app() -> Flask:
     app.config.from_object(Config)
 
     # ── init extensions
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", dbconfig.engine_options(app.config))
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = "login"
-
-    # ── seed (roles, statuses, demo-users, genres, fake books)
-    def seed() -> None:
-        # ---- роли
-        roles = {
-            "administrator": "Полный доступ",
-            "moderator":     "Модерация рецензий",
-            "user":          "Обычный пользователь"
-        }
-        for name, desc in roles.items():
-            if not Role.query.filter_by(name=name).first():
-                db.session.add(Role(name=name, description=desc))
-
-        # ---- статусы
-        statuses = {
-            "pending":  "На рассмотрении",
-            "approved": "Одобрена",
-            "rejected": "Отклонена"
-        }
-        for name, desc in statuses.items():
-            if not ReviewStatus.query.filter_by(name=name).first():
-                db.session.add(ReviewStatus(name=name, description=desc))
-
-        db.session.commit()        # нужны id ролей
-
-        # ---- demo-users
-        demo = [
-            ("admin", "adminpass", "Admin",      "Super", "administrator"),
-            ("mod",   "modpass",   "Moderator",  "Mighty", "moderator"),
-            ("user",  "userpass",  "User",       "Usual", "user")
-        ]
-        for uname, pwd, last, first, r in demo:
-            if not User.query.filter_by(username=uname).first():
-                role = Role.query.filter_by(name=r).first()
-                db.session.add(
-                    User(
-                        username=uname,
-                        password_hash=generate_password_hash(pwd),
-                        last_name=last,
-                        first_name=first,
-                        role=role
-                    )
-                )
-
-        # ---- жанры
-        base_genres = [
-            "Фэнтези", "Научная фантастика", "Детектив", "История",
-            "Бизнес", "Саморазвитие", "Приключения", "Поэзия"
-        ]
-        for g in base_genres:
-            if not Genre.query.filter_by(name=g).first():
-                db.session.add(Genre(name=g))
-        db.session.commit()
-
-        # ---- книги: генерируем, только если их пока нет
-        if not Book.query.first():
-            all_genres = Genre.query.all()
-            for _ in range(40):                       # ~40 книг
-                g_sample = random.sample(all_genres, k=random.randint(1, 3))
-                year = random.randint(1950, 2024)
-                book = Book(
-                    title=fake.sentence(nb_words=4).rstrip("."),
-                    description=fake.paragraph(nb_sentences=8),
-                    year=year,
-                    publisher=fake.company(),
-                    author=fake.name(),
-                    pages=random.randint(120, 700),
-                    genres=g_sample
-                )
-                db.session.add(book)
-            print("✅ Faker: сгенерировано 40 книг.")
-        else:
-            print("ℹ️  Faker: книги уже существуют, генерация пропущена.")
-
-        db.session.commit()
-        print("✅ seed(): готово")
-
-    # ── create tables & seed
+    page_cache.init_app(app)
+    instrumentation.init_app(app)
+    job_queue.init_app(app)
+    instrumentation.track_cache("page", lambda: (page_cache.hits, page_cache.misses))
+    instrumentation.track_cache("identity", lambda: (identities.hits, identities.misses))
+    instrumentation.track_cache("markdown", lambda: (markup.cache_stats["hits"],
+                                                     markup.cache_stats["misses"]))
+
+    # ── migrate schema (демо-данные — отдельно: flask seed)
     with app.app_context():
-        db.create_all()
-        seed()
+        dbconfig.install(db.engine, app.config)
+        # служебные сообщения — в stderr: stdout у CLI занят данными (flask export-books > файл)
+        print(f"ℹ️  БД {dbconfig.describe(db.engine)}", file=sys.stderr)
+        if app.config["AUTO_MIGRATE"]:
+            try:
+                applied = migrations.upgrade()
+            except migrations.MigrationError as exc:
+                print(f"❌ migrate: {exc}", file=sys.stderr)
+                raise SystemExit(1)
+            for version in applied:
+                print(f"✅ migrate: применена версия схемы {version}", file=sys.stderr)
 
     # ────────────────── STATIC (covers)
     @app.route("/uploads/<path:filename>")
     def uploads(filename):
-        return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+        # файлы адресуются по md5 содержимого, поэтому их можно кэшировать «навсегда»;
+        # ETag берём из имени, без похода в БД
+        folder = app.config["UPLOAD_FOLDER"]
+        md5, original, variant = parse_upload_name(filename)
+        immutable = True
+        if variant and not os.path.isfile(os.path.join(folder, filename)):
+            filename, variant, immutable = original, None, False   # миниатюры ещё нет
+        etag = f"{md5}.{variant}" if md5 and variant else (md5 or True)
+        resp = send_from_directory(folder, filename, etag=etag, conditional=True,
+                                   max_age=app.config["COVER_MAX_AGE"] if immutable else 300)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = immutable
+        return resp
+
+    @app.template_global()
+    def cover_url(cover, size=None, fmt="jpg"):
+        """URL обложки или её уменьшенной копии (card/detail, jpg/webp)."""
+        name = derivative_path(cover.filename, size, fmt) if size else cover.filename
+        return url_for("uploads", filename=name)
 
     # ────────────────── AUTH
     @app.route("/login", methods=["GET", "POST"])
@@ -155,7 +130,7 @@ def create_app() -> Flask:
                     flash("Для выполнения данного действия необходимо пройти процедуру аутентификации",
                           "warning")
                     return redirect(url_for("login", next=request.full_path))
-                if current_user.role.name not in roles:
+                if current_user.role_name not in roles:
                     flash("У вас недостаточно прав для выполнения данного действия",
                           "danger")
                     return redirect(url_for("index"))
@@ -163,36 +138,95 @@ def create_app() -> Flask:
             return wrapped
         return decorator
 
+    # ────────────────── АГРЕГАТЫ РЕЙТИНГА
+    def sync_book_stats(review, was_approved, removed=False):
+        """Сдвигает агрегаты книги после изменения рецензии (в той же транзакции).
+
+        Возвращает True, если изменилось то, что видно всем (одобренные рецензии).
+        """
+        is_approved = not removed and review.status_id == lookups.status_id("approved")
+        sign = int(is_approved) - int(was_approved)
+        if not sign:
+            return False
+        facets.remove_book(review.book_id)          # средняя оценка сменит корзину
+        adjust_book_stats(review.book_id, sign, sign * review.rating)
+        facets.add_book(review.book_id)
+        return True
+
     # ────────────────── ГЛАВНАЯ
     @app.route("/")
+    @page_cache.cached(tags=lambda: ["books"])
     def index():
-        page = request.args.get("page", 1, type=int)
-        books = Book.query.order_by(Book.year.desc()).paginate(page=page, per_page=10)
-        return render_template("index.html", books=books)
+        flt = facets.FacetFilter(request.args)
+        counts = facets.facet_counts(flt)
+        books = keyset_paginate(
+            flt.apply(book_list_query()), [Book.year, Book.id], descending=True,
+            after=request.args.get("after"), before=request.args.get("before"),
+            total=counts["total"],
+        )
+        return render_template("index.html", books=books, flt=flt, counts=counts,
+                               genres=lookups.genre_choices(),
+                               ratings=facets.RATING_CHOICES)
+
+    # ────────────────── ПОИСК
+    @app.route("/search")
+    @page_cache.cached(tags=lambda: ["books"])
+    def search_books():
+        q = request.args.get("q", "").strip()
+        page = max(request.args.get("page", 1, type=int), 1)
+        per_page = 10
+        ids = search.search_book_ids(q, limit=per_page + 1, offset=(page - 1) * per_page)
+        has_next = len(ids) > per_page
+        ids = ids[:per_page]
+        by_id = {b.id: b for b in book_list_query().filter(Book.id.in_(ids))} if ids else {}
+        books = [by_id[i] for i in ids if i in by_id]
+        return render_template("search.html", q=q, books=books,
+                               page=page, has_next=has_next)
 
     # ────────────────── ПРОСМОТР КНИГИ
+    def book_reviews_page(book_id):
+        """Порция одобренных рецензий книги по ?sort=new|top и ?after (keyset)."""
+        sort = request.args.get("sort")
+        if sort not in BOOK_REVIEW_SORTS:
+            sort = "new"
+        page = keyset_paginate(
+            book_reviews_query()
+            .filter_by(book_id=book_id, status_id=lookups.status_id("approved")),
+            BOOK_REVIEW_SORTS[sort], descending=True,
+            after=request.args.get("after"), per_page=app.config["REVIEWS_PER_PAGE"],
+        )
+        return page, sort
+
     @app.route("/books/<int:book_id>")
+    @page_cache.cached(tags=lambda book_id: [f"book:{book_id}"])
     def view_book(book_id):
-        book = Book.query.get_or_404(book_id)
-        approved = ReviewStatus.query.filter_by(name="approved").first()
-        reviews = (
-            Review.query.filter_by(book_id=book.id, status=approved)
-            .order_by(Review.created_at.desc())
-            .all()
-        )
+        book = book_detail_query().filter(Book.id == book_id).first_or_404()
+        reviews, sort = book_reviews_page(book.id)
         user_review = (
             Review.query.filter_by(book_id=book.id, user_id=current_user.id).first()
             if current_user.is_authenticated else None
         )
-        return render_template("book_detail.html", book=book,
-                               reviews=reviews, user_review=user_review)
+        similar = similar_books_query(book.id).limit(app.config["SIMILAR_BOOKS_SHOWN"]).all()
+        return render_template("book_detail.html", book=book, reviews=reviews,
+                               sort=sort, user_review=user_review, similar=similar)
+
+    @app.route("/books/<int:book_id>/reviews")
+    @page_cache.cached(tags=lambda book_id: [f"book:{book_id}"])
+    def book_reviews(book_id):
+        """Следующая порция рецензий — HTML-фрагмент для подгрузки при прокрутке."""
+        reviews, sort = book_reviews_page(book_id)
+        # пустая порция — единственный случай, когда нужна отдельная проверка книги
+        if not reviews.items and not db.session.query(Book.id).filter_by(id=book_id).first():
+            abort(404)
+        return render_template("_review_list.html", book_id=book_id,
+                               reviews=reviews, sort=sort)
 
     # ────────────────── ДОБАВЛЕНИЕ КНИГИ
     @app.route("/books/add", methods=["GET", "POST"])
     @role_required("administrator", "moderator")
     def add_book():
         form = BookForm()
-        form.genres.choices = [(g.id, g.name) for g in Genre.query.order_by(Genre.name)]
+        form.genres.choices = lookups.genre_choices()
         if form.validate_on_submit():
             book = Book(
                 title=form.title.data,
@@ -200,31 +234,22 @@ def create_app() -> Flask:
                 year=form.year.data,
                 publisher=form.publisher.data,
                 author=form.author.data,
-                pages=form.pages.data
+                pages=form.pages.data,
+                stats=BookStats()
             )
             book.genres = Genre.query.filter(Genre.id.in_(form.genres.data)).all()
             db.session.add(book)
             db.session.flush()  # нужен id
 
             if form.cover.data:
-                f = form.cover.data
-                md5 = hashlib.md5(f.read()).hexdigest()
-                f.seek(0)
-                existing = Cover.query.filter_by(md5_hash=md5).first()
-                if existing:
-                    book.cover = existing
-                else:
-                    filename = f"{md5}{os.path.splitext(secure_filename(f.filename))[1]}"
-                    path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-                    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-                    f.save(path)
-                    db.session.add(Cover(
-                        filename=filename,
-                        mimetype=f.mimetype,
-                        md5_hash=md5,
-                        book=book
-                    ))
+                md5, filename, mimetype = store_upload(form.cover.data,
+                                                       app.config["UPLOAD_FOLDER"])
+                attach_cover(book, md5, filename, mimetype)
+                job_queue.enqueue("cover_derivatives", {"filename": filename})
+            facets.add_book(book.id)
+            job_queue.enqueue("search_index", {"book_ids": [book.id]})
             db.session.commit()
+            page_cache.invalidate("books")
             flash("Книга добавлена", "success")
             return redirect(url_for("view_book", book_id=book.id))
         return render_template("book_form.html", form=form, title="Добавить книгу")
@@ -238,7 +263,7 @@ def create_app() -> Flask:
 
         # обложку не трогаем
         form.cover.render_kw = {"disabled": True}
-        form.genres.choices = [(g.id, g.name) for g in Genre.query.order_by(Genre.name)]
+        form.genres.choices = lookups.genre_choices()
 
         # заполняем мультиселект при первом открытии
         if request.method == "GET":
@@ -246,6 +271,7 @@ def create_app() -> Flask:
 
         # ─── ЭТОТ блок должен быть ОТДЕЛЬНО ───
         if form.validate_on_submit():
+            facets.remove_book(book.id)     # вклад в счётчики по старым жанрам/году
             book.title       = form.title.data
             book.description = form.description.data
             book.year        = form.year.data
@@ -255,8 +281,12 @@ def create_app() -> Flask:
             book.genres      = Genre.query.filter(
                 Genre.id.in_(form.genres.data)
             ).all()
+            db.session.flush()
+            facets.add_book(book.id)
+            job_queue.enqueue("search_index", {"book_ids": [book.id]})
 
             db.session.commit()
+            page_cache.invalidate("books", f"book:{book.id}")
             flash("Книга обновлена", "success")
             return redirect(url_for("view_book", book_id=book.id))
 
@@ -274,11 +304,14 @@ def create_app() -> Flask:
     def delete_book(book_id):
         book = Book.query.get_or_404(book_id)
         if book.cover:
-            path = os.path.join(app.config["UPLOAD_FOLDER"], book.cover.filename)
-            if os.path.exists(path):
-                os.remove(path)
+            # файл удалит задача, если он не нужен другой книге с той же картинкой
+            job_queue.enqueue("cover_gc", {"filename": book.cover.filename},
+                              delay=app.config["COVER_GC_DELAY_SECONDS"])
+        facets.remove_book(book.id)
         db.session.delete(book)
+        job_queue.enqueue("search_index", {"book_ids": [book_id]})
         db.session.commit()
+        page_cache.invalidate("books", f"book:{book_id}")
         flash("Книга удалена", "info")
         return redirect(url_for("index"))
 
@@ -293,15 +326,21 @@ def create_app() -> Flask:
 
         form = ReviewForm()
         if form.validate_on_submit():
-            pending = ReviewStatus.query.filter_by(name="pending").first()
             review = Review(
                 book=book,
-                user=current_user,
+                user_id=current_user.id,
                 rating=form.rating.data,
                 text_md=form.text.data,
-                status=pending
+                status_id=lookups.status_id("pending")
             )
             db.session.add(review)
+            try:
+                db.session.flush()          # uq_review_book_user ловит двойную отправку
+            except IntegrityError:
+                db.session.rollback()
+                flash("Вы уже оставили рецензию", "warning")
+                return redirect(url_for("view_book", book_id=book_id))
+            sync_book_stats(review, was_approved=False)
             db.session.commit()
             flash("Рецензия отправлена на модерацию", "info")
             return redirect(url_for("view_book", book_id=book.id))
@@ -311,11 +350,10 @@ def create_app() -> Flask:
     @app.route("/my_reviews")
     @role_required("user", "moderator", "administrator")
     def my_reviews():
-        page = request.args.get("page", 1, type=int)
-        reviews = (
-            Review.query.filter_by(user_id=current_user.id)
-            .order_by(Review.created_at.desc())
-            .paginate(page=page, per_page=10)
+        reviews = keyset_paginate(
+            user_reviews_query().filter_by(user_id=current_user.id),
+            [Review.created_at, Review.id], descending=True,
+            after=request.args.get("after"), before=request.args.get("before"),
         )
         return render_template("my_reviews.html", reviews=reviews)
 
@@ -323,29 +361,80 @@ def create_app() -> Flask:
     @app.route("/moderation")
     @role_required("administrator", "moderator")
     def moderation():
-        page = request.args.get("page", 1, type=int)
-        pending = ReviewStatus.query.filter_by(name="pending").first()
-        reviews = (
-            Review.query.filter_by(status=pending)
-            .order_by(Review.created_at)
-            .paginate(page=page, per_page=10)
+        pending_id = lookups.status_id("pending")
+        reviews = keyset_paginate(
+            moderation_reviews_query().filter_by(status_id=pending_id),
+            [Review.created_at, Review.id],
+            after=request.args.get("after"), before=request.args.get("before"),
+            total=cached_count("moderation", Review.query.filter_by(status_id=pending_id),
+                               ttl=15),
         )
         return render_template("moderate_list.html", reviews=reviews)
 
+    # ─── очередь с арендой: id взятой пачки лежат в сессии, переход к
+    # следующей рецензии не перечитывает очередь из БД
+    QUEUE_KEY = "moderation_queue"
+
+    @app.route("/moderation/claim", methods=["POST"])
+    @role_required("administrator", "moderator")
+    def moderation_claim():
+        ids = claim_batch(current_user.id, app.config["MODERATION_CLAIM_SIZE"],
+                          app.config["MODERATION_LEASE_SECONDS"])
+        db.session.commit()
+        session[QUEUE_KEY] = ids
+        if not ids:
+            flash("Свободных рецензий на рассмотрении нет", "info")
+            return redirect(url_for("moderation"))
+        return redirect(url_for("moderation_view", review_id=ids[0]))
+
+    @app.route("/moderation/release", methods=["POST"])
+    @role_required("administrator", "moderator")
+    def moderation_release():
+        released = release_claims(current_user.id)
+        db.session.commit()
+        session.pop(QUEUE_KEY, None)
+        flash(f"Возвращено в очередь: {released}", "info")
+        return redirect(url_for("moderation"))
+
+    def queue_after(review_id, drop=False):
+        """Следующая рецензия пачки после review_id (drop — убрать её из пачки)."""
+        queue = session.get(QUEUE_KEY) or []
+        if review_id not in queue:
+            return None
+        i = queue.index(review_id)
+        rest = queue[i + 1:] + queue[:i]          # пропущенные — в конце круга
+        if drop:
+            session[QUEUE_KEY] = queue[:i] + queue[i + 1:]
+        return rest[0] if rest else None
+
     # ────────────────── ПРОСМОТР РЕЦЕНЗИИ
     @app.route("/moderation/<int:review_id>")
     @role_required("administrator", "moderator")
     def moderation_view(review_id):
-        review = Review.query.get_or_404(review_id)
-        return render_template("moderate_view.html", review=review)
+        review = review_detail_query().filter(Review.id == review_id).first_or_404()
+        queue = session.get(QUEUE_KEY) or []
+        return render_template("moderate_view.html", review=review,
+                               queue=queue, next_id=queue_after(review_id))
 
     # ─── смена статуса
     def change_status(review_id, status_name):
         review = Review.query.get_or_404(review_id)
-        review.status = ReviewStatus.query.filter_by(name=status_name).first()
+        next_id = queue_after(review_id, drop=True)
+        next_url = url_for("moderation_view", review_id=next_id) if next_id else url_for("moderation")
+        if review.claim_active and review.claimed_by != current_user.id:
+            flash("Эту рецензию сейчас рассматривает другой модератор", "warning")
+            return redirect(next_url)
+        status = lookups.status(status_name)
+        was_approved = review.status_id == lookups.status_id("approved")
+        review.status_id = status.id
+        review.claimed_by = review.claim_expires = None
+        db.session.flush()
+        visible = sync_book_stats(review, was_approved)
         db.session.commit()
-        flash(f"Статус изменён на «{review.status.description}»", "success")
-        return redirect(url_for("moderation"))
+        if visible:
+            page_cache.invalidate("books", f"book:{review.book_id}")
+        flash(f"Статус изменён на «{status.description}»", "success")
+        return redirect(next_url)
 
     @app.route("/moderation/<int:review_id>/approve", methods=["POST"])
     @role_required("administrator", "moderator")
@@ -356,6 +445,68 @@ def create_app() -> Flask:
     @role_required("administrator", "moderator")
     def reject(review_id):
         return change_status(review_id, "rejected")
+
+    # ─── пакетная смена статуса
+    BULK_ACTIONS = {"approve": "approved", "reject": "rejected"}
+
+    def is_json_int(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    @app.route("/moderation/bulk", methods=["POST"])
+    @role_required("administrator", "moderator")
+    def moderation_bulk():
+        """Форма очереди (review_id=…&action=…) или JSON
+        {"action": …, "ids": […]} / {"action": …, "book_id": …, "from_status": "pending"}."""
+        data = request.get_json(silent=True) if request.is_json else None
+        if data is not None:
+            if not isinstance(data, dict):
+                abort(400)
+            action = data.get("action")
+            ids, book_id = data.get("ids"), data.get("book_id")
+            from_status = data.get("from_status")
+            # в JSON — только числа: строка "123" в ids разобралась бы посимвольно
+            if ids is not None and not (isinstance(ids, list) and all(map(is_json_int, ids))):
+                abort(400)
+            if book_id is not None and not is_json_int(book_id):
+                abort(400)
+        else:
+            action = request.form.get("action")
+            ids = request.form.getlist("review_id") or None
+            book_id = request.form.get("book_id")
+            from_status = request.form.get("from_status") or "pending"
+        if data is None and not ids and not book_id:
+            flash("Не выбрано ни одной рецензии", "warning")
+            return redirect(url_for("moderation"))
+        try:
+            ids = [int(i) for i in ids] if ids is not None else None
+            book_id = int(book_id) if book_id is not None else None
+            if from_status is not None:
+                lookups.status(from_status)
+            if action not in BULK_ACTIONS:
+                raise ValueError(action)
+        except (TypeError, ValueError, KeyError):
+            abort(400)
+        if ids is not None and len(ids) > app.config["MODERATION_BULK_MAX"]:
+            abort(413)
+
+        try:
+            result = bulk_change_status(
+                BULK_ACTIONS[action], review_ids=ids, book_id=book_id, from_status=from_status,
+                user_id=current_user.id)
+        except ValueError:
+            abort(400)
+        db.session.commit()
+        if result.book_ids:
+            page_cache.invalidate("books", *(f"book:{b}" for b in result.book_ids))
+
+        if data is not None:
+            return jsonify(result.as_dict())
+        status = lookups.status(result.status)
+        flash(f"«{status.description}»: {result.updated} из {len(result.items)}", "success")
+        if result.claimed:
+            flash(f"Не изменено: {result.claimed} — их сейчас рассматривают другие модераторы",
+                  "warning")
+        return redirect(url_for("moderation"))
     # ────────────────── УДАЛЕНИЕ РЕЦЕНЗИИ ─────────────────────────
     @app.route("/reviews/<int:review_id>/delete", methods=["POST"])
     @role_required("administrator", "moderator", "user")
@@ -363,103 +514,431 @@ def create_app() -> Flask:
         review = Review.query.get_or_404(review_id)
 
         # обычный пользователь может удалить только СВОЮ рецензию
-        if (current_user.role.name == "user"
+        if (current_user.role_name == "user"
                 and review.user_id != current_user.id):
             flash("Нельзя удалить чужую рецензию", "danger")
             return redirect(request.referrer or url_for("index"))
 
+        book_id = review.book_id
+        visible = sync_book_stats(review, review.status_name == "approved", removed=True)
         db.session.delete(review)
         db.session.commit()
+        if visible:
+            page_cache.invalidate("books", f"book:{book_id}")
         flash("Рецензия удалена", "info")
 
         # вернуться туда, откуда пришли (книга или «Мои рецензии»)
         return redirect(request.referrer or url_for("my_reviews"))
+
+    # ────────────────── JSON API v1 (см. api.py)
+    @app.errorhandler(api.ApiError)
+    def api_error(exc):
+        return jsonify(error=exc.message), exc.status
+
+    def upload_link(filename):
+        return url_for("uploads", filename=filename, _external=True)
+
+    @app.route("/api/v1/genres")
+    def api_genres():
+        genres = lookups.genre_choices()
+        return api.conditional_json(
+            api.make_etag(genres),
+            lambda: {"items": [{"id": gid, "name": name} for gid, name in genres]},
+        )
+
+    @app.route("/api/v1/books")
+    def api_books():
+        fields = api.parse_fields(api.BOOK_FIELDS, api.BOOK_LIST_FIELDS)
+        flt = facets.FacetFilter(request.args)
+        page = keyset_paginate(
+            api.book_query(flt.apply(book_list_query()), fields),
+            [Book.year, Book.id], descending=True,
+            after=request.args.get("after"), before=request.args.get("before"),
+            per_page=api.parse_limit(),
+        )
+        etag = api.make_etag(fields, page.next_cursor, page.prev_cursor,
+                             [api.book_version(b) for b in page.items],
+                             api.lookups_version(fields))
+        return api.conditional_json(etag, lambda: api.page_payload(
+            page, [api.serialize_book(b, fields, upload_link) for b in page.items]))
+
+    @app.route("/api/v1/books/<int:book_id>")
+    def api_book(book_id):
+        fields = api.parse_fields(api.BOOK_FIELDS, tuple(api.BOOK_FIELDS))
+        book = api.book_query(book_detail_query(), fields).filter(Book.id == book_id).first()
+        if book is None:
+            raise api.ApiError(404, "книга не найдена")
+        etag = api.make_etag(fields, api.book_version(book), api.lookups_version(fields))
+        return api.conditional_json(etag, lambda: api.serialize_book(book, fields, upload_link))
+
+    @app.route("/api/v1/books/<int:book_id>/reviews")
+    def api_book_reviews(book_id):
+        fields = api.parse_fields(api.REVIEW_FIELDS, tuple(api.REVIEW_FIELDS))
+        sort = request.args.get("sort", "new")
+        if sort not in BOOK_REVIEW_SORTS:
+            raise api.ApiError(400, f"sort: {' | '.join(BOOK_REVIEW_SORTS)}")
+        page = keyset_paginate(
+            api.review_query(book_reviews_query(), fields)
+            .filter_by(book_id=book_id, status_id=lookups.status_id("approved")),
+            BOOK_REVIEW_SORTS[sort], descending=True,
+            after=request.args.get("after"), before=request.args.get("before"),
+            per_page=api.parse_limit(),
+        )
+        # пустая выдача — единственный случай, когда нужна отдельная проверка книги
+        if not page.items and not db.session.query(Book.id).filter_by(id=book_id).first():
+            raise api.ApiError(404, "книга не найдена")
+        etag = api.make_etag(fields, page.next_cursor, page.prev_cursor,
+                             [api.review_version(r) for r in page.items])
+        return api.conditional_json(etag, lambda: api.page_payload(
+            page, [api.serialize_review(r, fields) for r in page.items]))
+
+    # ────────────────── МЕТРИКИ (INSTRUMENTATION=1)
+    @app.route("/_metrics")
+    def metrics():
+        if not instrumentation.enabled:
+            abort(404)
+        # сборщик Prometheus — по Bearer-токену, человек — как администратор
+        token = app.config["METRICS_TOKEN"]
+        bearer = request.headers.get("Authorization", "")
+        if not (token and hmac.compare_digest(bearer, f"Bearer {token}")):
+            if not current_user.is_authenticated or current_user.role_name != "administrator":
+                abort(403)
+        return Response(instrumentation.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    # ────────────────── CLI: ДАННЫЕ И ОБЛОЖКИ
+    cover_options = [
+        click.option("--source", default=None,
+                     help="picsum | unsplash | URL-шаблон с {seed} | каталог с картинками"),
+        click.option("--workers", default=8, show_default=True, help="Параллельных загрузок"),
+        click.option("--retries", default=3, show_default=True, help="Повторов на картинку"),
+        click.option("--batch", default=100, show_default=True, help="Книг на один коммит"),
+    ]
+
+    def with_cover_options(fn):
+        for option in reversed(cover_options):
+            fn = option(fn)
+        return fn
+
+    def download_covers(book_ids, source, workers, retries, batch):
+        """Скачивает и привязывает обложки книгам; печатает итоги."""
+        from covers import make_source, fetch_covers, attach_covers, FetchStats
+
+        stats = FetchStats()
+        results = fetch_covers(make_source(source), book_ids, app.config["UPLOAD_FOLDER"],
+                               workers=workers, retries=retries, stats=stats)
+        added, linked = attach_covers(results, batch_size=batch)
+        print(f"✅ обложек: с новым файлом={added}, с файлом другой книги={linked}")
+        print(stats.report())
+
     @app.cli.command("fake-books")
     @click.option("--count", default=40, help="Сколько книг добавить")
-    def fake_books(count):
-        """Генерирует <count> случайных книг через Faker."""
-        import requests, hashlib
-
+    @with_cover_options
+    def fake_books(count, source, workers, retries, batch):
+        """Генерирует <count> случайных книг через Faker и скачивает им обложки."""
+        from faker import Faker
         fake = Faker("ru_RU")
         all_genres = Genre.query.all()
-        upload_dir = app.config["UPLOAD_FOLDER"]
-        os.makedirs(upload_dir, exist_ok=True)
+        new_ids = []
+
+        for start in range(0, count, batch):
+            books = seeding.fake_books(fake, all_genres, min(batch, count - start))
+            db.session.add_all(books)
+            db.session.flush()      # нужны id для индексов и обложек
+            ids = [b.id for b in books]
+            search.index_books(ids)
+            facets.add_book(*ids)
+            db.session.commit()
+            new_ids += ids
+        print(f"✅ Добавлено книг: {count}")
 
-        for _ in range(count):
-            book = Book(
-                title=fake.sentence(nb_words=4).rstrip("."),
-                description=fake.paragraph(nb_sentences=8),
-                year=random.randint(1950, 2024),
-                publisher=fake.company(),
-                author=fake.name(),
-                pages=random.randint(120, 700),
-                genres=random.sample(all_genres, k=random.randint(1, 3))
+        download_covers(new_ids, source or "unsplash", workers, retries, batch)
+
+    @app.cli.command("seed")
+    @click.option("--books", default=40, help="Сколько книг создать, если каталог пуст (0 — не создавать)")
+    def seed(books):
+        """Справочники, демо-пользователи, жанры и книги-примеры (повторный запуск безопасен)."""
+        users, added = seeding.seed_demo(books)
+        print(f"✅ seed: новых пользователей={users}, книг={added}")
+
+    @app.cli.command("gen-data")
+    @click.option("--books", default=100_000, help="Сколько книг")
+    @click.option("--users", default=10_000, help="Сколько пользователей (роль user)")
+    @click.option("--reviews", default=500_000, help="Сколько рецензий (примерно)")
+    @click.option("--seed", default=1, help="Зерно генератора: те же параметры → те же данные")
+    @click.option("--batch", default=5000, help="Строк в одном INSERT")
+    @click.option("--status-mix", default="approved=0.7,pending=0.2,rejected=0.1",
+                  help="Доли статусов рецензий")
+    @click.option("--ratings", default="2,3,6,14,35,40", help="Веса оценок 0..5")
+    @click.option("--genres-per-book", default="1-3", help="Диапазон числа жанров у книги")
+    @click.option("--popularity", default=1.1,
+                  help="Показатель Ципфа для рецензий на книгу (0 — равномерно)")
+    def gen_data(books, users, reviews, seed, batch, status_mix, ratings, genres_per_book,
+                 popularity):
+        """Массово генерирует книги, пользователей и рецензии для нагрузочных тестов (офлайн)."""
+        from datagen import DataGenerator, parse_weights
+        try:
+            lo, _, hi = genres_per_book.partition("-")
+            generator = DataGenerator(
+                books, users, reviews, seed=seed, batch_size=batch,
+                status_mix=parse_weights(status_mix, names=("approved", "pending", "rejected")),
+                rating_weights=parse_weights(ratings),
+                genres_per_book=(int(lo), int(hi or lo)), popularity=popularity,
             )
-            db.session.add(book)
-            db.session.flush()      # нужен book.id для обложки
-
-            # загружаем обложку с Unsplash
-            url  = f"https://source.unsplash.com/featured/300x450/?book&sig={book.id}"
-            resp = requests.get(url, timeout=10)
-            if resp.ok:
-                md5 = hashlib.md5(resp.content).hexdigest()
-                existing = Cover.query.filter_by(md5_hash=md5).first()
-                if existing:
-                    book.cover = existing
-                else:
-                    filename = f"{md5}.jpg"
-                    with open(os.path.join(upload_dir, filename), "wb") as f:
-                        f.write(resp.content)
-                    db.session.add(Cover(
-                        filename=filename,
-                        mimetype="image/jpeg",
-                        md5_hash=md5,
-                        book=book
-                    ))
+        except ValueError as exc:
+            raise click.BadParameter(str(exc))
+        report = generator.run()
+        page_cache.clear()
+        for table, (rows, seconds) in report.items():
+            rate = f", {rows / seconds:,.0f} строк/с" if rows and seconds else ""
+            print(f"✅ {table}: {rows} строк за {seconds:.1f} с{rate}")
+
+    @app.cli.command("import-books")
+    @click.argument("path")
+    @click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]),
+                  help="По умолчанию — по расширению файла (- — stdin, CSV)")
+    @click.option("--batch", default=1000, show_default=True, help="Строк на один коммит")
+    @click.option("--covers", "covers_dir", type=click.Path(exists=True, file_okay=False),
+                  help="Каталог с файлами из колонки cover")
+    @click.option("--create-genres/--no-create-genres", default=True, show_default=True,
+                  help="Создавать неизвестные жанры (иначе строка считается ошибкой)")
+    def import_books(path, fmt, batch, covers_dir, create_genres):
+        """Потоково импортирует книги из CSV/JSONL (upsert по названию, автору и году)."""
+        from transfer import BookImporter, detect_format, open_stream, read_rows
+
+        importer = BookImporter(batch_size=batch, covers_dir=covers_dir,
+                                upload_dir=app.config["UPLOAD_FOLDER"],
+                                create_genres=create_genres)
+        with open_stream(path) as stream:
+            report = importer.run(read_rows(stream, detect_format(path, fmt)))
+        page_cache.clear()
+        seconds = importer.progress.elapsed
+        rows = report.inserted + report.updated
+        print(f"✅ импорт: новых={report.inserted}, обновлено={report.updated}, "
+              f"ошибок={report.failed}, новых жанров={report.genres_created} "
+              f"за {seconds:.1f} с ({rows / max(seconds, 1e-9):,.0f} строк/с)")
+        if covers_dir:
+            print(f"   обложки: добавлено={report.covers_added}, "
+                  f"из них с файлом другой книги (md5)={report.covers_duplicate}, "
+                  f"нет файла={report.covers_missing}")
+        for line_no, reason in report.errors:
+            print(f"   ✗ строка {line_no}: {reason}", file=sys.stderr)
+        print("ℹ️  HTML описаний досчитает flask backfill-html")
+
+    @app.cli.command("export-books")
+    @click.argument("path", default="-")
+    @click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]),
+                  help="По умолчанию — по расширению файла (- — stdout, CSV)")
+    @click.option("--batch", default=1000, show_default=True, help="Строк на одну порцию из БД")
+    def export_books(path, fmt, batch):
+        """Потоково выгружает каталог в CSV/JSONL (формат — как у import-books)."""
+        import transfer
+
+        started = time.perf_counter()
+        with transfer.open_stream(path, "w") as stream:
+            # в stdout идут данные — прогресс и итог печатаем в stderr
+            total = transfer.export_books(stream, transfer.detect_format(path, fmt),
+                                          batch_size=batch, progress_file=sys.stderr)
+        seconds = time.perf_counter() - started
+        print(f"✅ экспорт: книг={total} за {seconds:.1f} с "
+              f"({total / max(seconds, 1e-9):,.0f} строк/с)", file=sys.stderr)
 
-        db.session.commit()
-        print(f"✅ Добавлено книг: {count}")
-        
     @app.cli.command("fill-covers")
-    def fill_covers():
+    @with_cover_options
+    def fill_covers(source, workers, retries, batch):
         """Создаёт/привязывает обложки всем книгам, у которых их нет."""
-        import requests, hashlib, os, uuid
-        upload_dir = app.config["UPLOAD_FOLDER"]
-        os.makedirs(upload_dir, exist_ok=True)
-
-        books = Book.query.filter(Book.cover == None).all()
-        added, linked = 0, 0
-
-        for bk in books:
-            # 👉 уменьшаем шанс одинаковых байтов:
-            url = f"https://picsum.photos/seed/{uuid.uuid4()}/300/450"
-            resp = requests.get(url, timeout=10)
-            if not resp.ok:
-                continue
-
-            img = resp.content
-            md5 = hashlib.md5(img).hexdigest()
-            cover = Cover.query.filter_by(md5_hash=md5).first()
-
-            if cover:                         # такое изображение уже есть
-                bk.cover = cover              # просто привязываем
-                linked += 1
-                continue
-
-            # пишем файл
-            fname = f"{md5}.jpg"
-            with open(os.path.join(upload_dir, fname), "wb") as f:
-                f.write(img)
-
-            cover = Cover(filename=fname,
-                        mimetype="image/jpeg",
-                        md5_hash=md5,
-                        book=bk)
-            db.session.add(cover)
-            added += 1
-
+        book_ids = [bid for (bid,) in
+                    db.session.query(Book.id).filter(~Book.cover.has()).order_by(Book.id)]
+        download_covers(book_ids, source or "picsum", workers, retries, batch)
+
+    @app.cli.command("make-thumbs")
+    @click.option("--force", is_flag=True, help="Пересоздать и уже существующие копии")
+    @click.option("--workers", default=4, show_default=True, help="Параллельных потоков")
+    def make_thumbs(force, workers):
+        """Создаёт уменьшенные копии (card/detail, JPEG/WebP) для всех обложек."""
+        from concurrent.futures import ThreadPoolExecutor
+        from covers import thumbnails_available
+
+        if not thumbnails_available():
+            print("❌ Pillow не установлен: pip install -r requirements.txt")
+            raise SystemExit(1)
+        folder = app.config["UPLOAD_FOLDER"]
+        names = [fn for (fn,) in db.session.query(Cover.filename).order_by(Cover.id)]
+
+        def job(name):
+            try:
+                return make_derivatives(folder, name, force=force), None
+            except (OSError, ValueError) as exc:
+                return 0, f"{name}: {exc}"
+
+        created, errors = 0, []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for n, err in pool.map(job, names):
+                created += n
+                if err:
+                    errors.append(err)
+        print(f"✅ Обложек: {len(names)}, создано копий: {created}, ошибок: {len(errors)}")
+        for err in errors[:10]:
+            print(f"  ✗ {err}")
+
+    @app.cli.command("cache-clear")
+    def cache_clear():
+        """Очищает кэш HTML-страниц (нужно для PAGE_CACHE_BACKEND=file после правок из CLI)."""
+        page_cache.clear()
+        print("✅ Кэш страниц очищен")
+
+    @app.cli.command("rebuild-stats")
+    def rebuild_stats():
+        """Пересчитывает с нуля агрегаты рейтинга (число и средняя оценка рецензий)."""
+        rebuild_book_stats()
         db.session.commit()
-        print(f"✅ новых={added}, привязано к существующим={linked}")
+        print(f"✅ Агрегаты пересчитаны для книг: {BookStats.query.count()}")
+
+    @app.cli.command("db-upgrade")
+    def db_upgrade():
+        """Применяет недостающие миграции схемы БД."""
+        try:
+            applied = migrations.upgrade()
+        except migrations.MigrationError as exc:
+            print(f"❌ {exc}")
+            raise SystemExit(1)
+        print(f"✅ Применены версии: {applied}" if applied else "ℹ️  Схема уже актуальна")
+
+    @app.cli.command("dedupe-reviews")
+    def dedupe_reviews():
+        """Оставляет по одной (самой ранней) рецензии пользователя на книгу — перед миграцией 2."""
+        with db.engine.begin() as conn:
+            rows, total = migrations.duplicate_reviews(conn)
+            for book_id, user_id, n in rows:
+                print(f"  книга {book_id}, пользователь {user_id}: {n} рецензий")
+            removed = migrations.remove_duplicate_reviews(conn)
+        if total:
+            print(f"✅ Удалено дублирующихся рецензий: {removed} (пар: {total}), агрегаты пересчитаны")
+        else:
+            print("ℹ️  Дубликатов рецензий нет")
+
+    @app.cli.command("db-status")
+    def db_status():
+        """Показывает текущую версию схемы и неприменённые миграции."""
+        with db.engine.begin() as conn:
+            print(f"Версия схемы: {migrations.current_version(conn)}")
+        for version, description in migrations.pending():
+            print(f"  ожидает {version}: {description}")
+
+    @app.cli.command("search-reindex")
+    def search_reindex():
+        """Перестраивает полнотекстовый индекс книг (FTS5)."""
+        if not search.fts_available():
+            print("ℹ️  FTS5 доступен только для SQLite, используется поиск через ILIKE")
+            return
+        with db.engine.begin() as conn:
+            search.create_index(conn)
+            search.rebuild_index(conn)
+        print(f"✅ Поисковый индекс перестроен, книг: {Book.query.count()}")
+
+    @app.cli.command("rebuild-facets")
+    def rebuild_facets():
+        """Пересчитывает с нуля счётчики фасетов каталога (жанр/год/оценка)."""
+        facets.rebuild()
+        db.session.commit()
+        print("✅ Счётчики фасетов пересчитаны")
+
+    @app.cli.command("rebuild-similar")
+    @click.option("--full", is_flag=True, help="Пересчитать все книги, а не только изменившиеся")
+    @click.option("--top-k", default=12, show_default=True, help="Сколько похожих хранить на книгу")
+    @click.option("--chunk", default=256, show_default=True,
+                  help="Книг в одной порции (память — порция × число книг)")
+    def rebuild_similar(full, top_k, chunk):
+        """Пересчитывает «похожие книги» по жанрам, общим читателям и рейтингу."""
+        import similar
+        if not similar.available():
+            raise click.ClickException("нужны numpy и scipy (pip install numpy scipy)")
+        report = similar.rebuild(full=full, k=top_k, chunk=chunk)
+        page_cache.clear()
+        mode = "полный пересчёт" if report["full"] else "изменившиеся книги"
+        rate = report["books"] / max(report["seconds"], 1e-9)
+        print(f"✅ похожие книги ({mode}): книг={report['books']}, "
+              f"обновлено чужих списков={report['neighbours']}, строк={report['rows']} "
+              f"за {report['seconds']:.1f} с ({rate:,.0f} книг/с)")
+
+    # ────────────────── ФОНОВЫЕ ЗАДАЧИ (jobs.py, tasks.py)
+    @app.cli.command("jobs-worker")
+    @click.option("--once", is_flag=True, help="Выполнить готовые задачи и выйти")
+    def jobs_worker(once):
+        """Исполнитель фоновых задач (при JOBS_WORKER=off — обязателен)."""
+        if once:
+            ok, failed = job_queue.run_pending()
+            print(f"✅ задачи: выполнено {ok}, с ошибкой {failed}")
+            return
+        if app.config["PAGE_CACHE_BACKEND"] == "memory":
+            print("ℹ️  кэш страниц живёт в памяти веб-процессов — отсюда он не сбрасывается")
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: job_queue.stop())
+        print(f"✅ исполнитель задач запущен (pid {os.getpid()}), Ctrl+C — остановка")
+        job_queue.work()
+
+    @app.cli.command("jobs-stats")
+    @click.option("--failures", default=5, show_default=True, help="Сколько последних ошибок показать")
+    def jobs_stats(failures):
+        """Очередь задач: ждут, выполняются, выполнены, провалены, повторы."""
+        stats = job_queue.stats()
+        if not stats:
+            print("ℹ️  очередь задач пуста")
+            return
+        print(f"{'задача':<18} {'ждут':>6} {'готовы':>7} {'идут':>5} {'готово':>7} "
+              f"{'ошибка':>7} {'повторов':>9}  старейшая в очереди")
+        for kind, s in sorted(stats.items()):
+            oldest = f"{s['oldest'].total_seconds():.0f} с" if s["oldest"] else "—"
+            print(f"{kind:<18} {s['queued']:>6} {s['ready']:>7} {s['running']:>5} "
+                  f"{s['done']:>7} {s['failed']:>7} {s['retries']:>9}  {oldest}")
+        for job in job_queue.recent_failures(failures):
+            print(f"  ✗ #{job.id} {job.kind}, попыток {job.attempts}, "
+                  f"{job.finished_at:%Y-%m-%d %H:%M:%S}: {job.last_error}")
+
+    @app.cli.command("jobs-retry")
+    @click.argument("job_ids", nargs=-1, type=int)
+    @click.option("--kind", help="Только задачи этого вида")
+    def jobs_retry(job_ids, kind):
+        """Возвращает проваленные задачи в очередь (все или перечисленные id)."""
+        count = job_queue.retry_failed(kind=kind, job_ids=list(job_ids) or None)
+        print(f"✅ возвращено в очередь: {count}")
+
+    @app.cli.command("backfill-html")
+    @click.option("--force", is_flag=True, help="Перерендерить и уже заполненные строки")
+    def backfill_html(force):
+        """Сохраняет HTML описаний книг и рецензий, отрендеренный из Markdown."""
+        done = backfill_rendered_html(force=force)
+        print(f"✅ HTML обновлён у строк: {done}")
+
+    @app.cli.command("check-queries", with_appcontext=False)
+    def check_queries():
+        """Проверяет, что основные страницы укладываются в бюджет SQL-запросов."""
+        from sqlcount import QueryBudgetExceeded, assert_query_budget, budget_cases, login_client
+
+        # FlaskGroup уже держит общий app-context; каждый запрос тестового
+        # клиента выполняется в собственном (иначе Flask-Login закэширует
+        # пользователя в общем g)
+        job_queue.mode = "off"            # фоновый поток не должен работать во время замера
+        page_cache.backend = None         # меряем представления, а не попадания в кэш страниц
+        with app.app_context():
+            cases = budget_cases()
+
+        failed = 0
+        for endpoint, role, url, user, budget in cases:
+            if url is None or (role and user is None):
+                print(f"–  {endpoint} [{role or 'аноним'}]: нет данных, пропущено")
+                continue
+            client = app.test_client()
+            if role:
+                login_client(client, user)
+            try:
+                with app.app_context():
+                    _, statements = assert_query_budget(client, url, budget)
+                print(f"✅ {url} [{role or 'аноним'}]: {len(statements)}/{budget}")
+            except QueryBudgetExceeded as exc:
+                failed += 1
+                print(f"❌ [{role or 'аноним'}] {exc}")
+        if failed:
+            raise SystemExit(1)
 
 
     return app
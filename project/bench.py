@@ -0,0 +1,477 @@
+# bench.py
+"""Замеры производительности приложения.
+
+    python bench.py startup [--runs 5] [--database URL] [--json startup.json]
+    python bench.py routes [--books 5000 --users 1000 --reviews 20000] [--requests 200]
+                           [--gunicorn --workers 4 --concurrency 8] [--json routes.json]
+    python bench.py compare base.json new.json [--threshold 0.15]
+
+startup — холодный старт воркера: каждый прогон в отдельном процессе
+импортирует app (create_app, миграции, настройка движка) и сообщает время,
+пиковую память (ru_maxrss) и какие тяжёлые модули попали в память. Работает
+на временной копии instance/library.db (или на --database), рабочую БД не трогает.
+
+routes — задержки основных страниц и действий (p50/p95/p99, запросов в
+секунду, SQL-запросов на HTTP-запрос) на сгенерированном наборе данных
+(datagen, детерминированный --seed) во временной SQLite-базе. По умолчанию
+через тестовый клиент Flask в этом процессе; с --gunicorn — по HTTP к
+локальному gunicorn (SQL тогда не считается).
+
+compare — сравнивает два JSON-результата и завершается с кодом 1, если
+что-то стало медленнее порога.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# модули, которые нужны только CLI-командам и не должны грузиться воркером
+HEAVY_MODULES = ("faker", "requests", "PIL")
+
+_STARTUP_PROBE = f"""
+import json, resource, sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+print("BENCH " + json.dumps({{
+    "seconds": elapsed,
+    "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    "heavy": sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules),
+}}))
+"""
+
+
+def _probe(code, env):
+    proc = subprocess.run([sys.executable, "-c", code], cwd=HERE, env=env,
+                          capture_output=True, text=True, check=True)
+    line = next(l for l in reversed(proc.stdout.splitlines()) if l.startswith("BENCH "))
+    return json.loads(line[len("BENCH "):])
+
+
+def _summary(values):
+    return {"min": min(values), "median": statistics.median(values), "max": max(values)}
+
+
+def _startup_database(workdir):
+    """Копия instance/library.db во временном каталоге: create_app мигрирует её, а не рабочую БД."""
+    import sqlite3
+    path = os.path.join(workdir, "startup.db")
+    source = os.path.join(HERE, "instance", "library.db")
+    if os.path.exists(source):
+        # backup, а не копирование файла: забирает и то, что ещё лежит в -wal
+        with sqlite3.connect(f"file:{source}?mode=ro", uri=True) as src, \
+                sqlite3.connect(path) as dst:
+            src.backup(dst)
+    return f"sqlite:///{path}"
+
+
+def startup(runs=5, database=None):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env = dict(os.environ, DATABASE_URL=database or _startup_database(workdir),
+               UPLOAD_FOLDER=os.path.join(workdir, "uploads"))
+    try:
+        _probe(_STARTUP_PROBE, env)      # прогрев: миграции копии не входят в замер
+        samples = [_probe(_STARTUP_PROBE, env) for _ in range(runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "benchmark": "startup",
+        "runs": runs,
+        "seconds": _summary([s["seconds"] for s in samples]),
+        "maxrss_mb": _summary([s["maxrss_kb"] / 1024 for s in samples]),
+        "modules": samples[-1]["modules"],
+        "heavy_modules": samples[-1]["heavy"],
+    }
+
+
+# ──────────────── МАРШРУТЫ ───────────────────────────────────────
+def _percentile(ordered, p):
+    """Перцентиль по ближайшему рангу (ordered — отсортированный список)."""
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+class ClientDriver:
+    """Тестовый клиент Flask в этом процессе; считает SQL-запросы."""
+
+    def __init__(self, app):
+        from extensions import db
+        from sqlcount import count_queries, login_client
+        self.app = app
+        self._count_queries, self._login_client = count_queries, login_client
+        with app.app_context():
+            self.engine = db.engine
+        self._clients = {}
+
+    def client(self, user):
+        if user not in self._clients:
+            client = self.app.test_client()
+            if user is not None:
+                self._login_client(client, user)
+            self._clients[user] = client
+        return self._clients[user]
+
+    def request(self, user, method, url, data=None):
+        client = self.client(user)
+        with self.app.app_context():                 # свой g на каждый запрос, как в check-queries
+            with self._count_queries(self.engine) as statements:
+                started = time.perf_counter()
+                resp = client.open(url, method=method, data=data)
+                elapsed = time.perf_counter() - started
+        return resp.status_code, elapsed, len(statements)
+
+
+class HttpDriver:
+    """HTTP к локальному gunicorn; вход через форму, редиректы не выполняются
+    (как и у тестового клиента — меряется только сам запрос)."""
+
+    def __init__(self, base_url, passwords):
+        import urllib.request
+
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        self._no_redirect = NoRedirect
+        self.base_url = base_url
+        self.passwords = passwords               # username → пароль
+        self._openers = {}
+        self._lock = threading.Lock()
+
+    def client(self, user):
+        """Сессия пользователя (cookie jar общий для потоков); вход — один раз."""
+        import http.cookiejar
+        import urllib.request
+        with self._lock:
+            if user in self._openers:
+                return self._openers[user]
+            opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._no_redirect)
+            if user is not None:
+                form = {"username": user.username, "password": self.passwords[user.username],
+                        "csrf_token": self._csrf(opener, "/login")}
+                self._open(opener, "POST", "/login", form)
+            self._openers[user] = opener
+            return opener
+
+    def _csrf(self, opener, url):
+        page = self._open(opener, "GET", url)[1].decode()
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page)
+        return token.group(1) if token else ""
+
+    def _open(self, opener, method, url, data=None):
+        import urllib.error
+        import urllib.parse
+        body = urllib.parse.urlencode(data or {}, doseq=True).encode() if method == "POST" else None
+        try:
+            with opener.open(self.base_url + url, body) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as exc:    # в т. ч. 3xx: редиректы выключены
+            return exc.code, exc.read()
+
+    def request(self, user, method, url, data=None, csrf_from=None):
+        opener = self.client(user)
+        if csrf_from:                            # токен формы — вне замера
+            data = dict(data, csrf_token=self._csrf(opener, csrf_from))
+        started = time.perf_counter()
+        status, _ = self._open(opener, method, url, data)
+        return status, time.perf_counter() - started, None
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_gunicorn(workers):
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}",
+         "--log-level", "warning", "app:app"],
+        cwd=HERE, env=os.environ.copy(), stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("gunicorn не запустился")
+
+
+def _prepare_dataset(args):
+    """Временная БД (или --database) с демо-данными и сгенерированным набором."""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["DATABASE_URL"] = (args.database or
+                                  f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault("UPLOAD_FOLDER", os.path.join(workdir, "uploads"))
+    # по умолчанию меряем рендер, а не кэш страниц
+    os.environ["PAGE_CACHE_BACKEND"] = "memory" if args.page_cache else "none"
+    # фоновые задачи не выполняются во время замера: очередь разбирается между сценариями
+    os.environ["JOBS_WORKER"] = "off"
+    sys.path.insert(0, HERE)
+
+    import app as appmod
+    import seeding
+    from datagen import DataGenerator
+    from extensions import db
+    from models import Book, Genre, Review, User, lookups
+
+    app = appmod.app
+    app.config["WTF_CSRF_ENABLED"] = False       # тестовый клиент шлёт формы без токена
+    with app.app_context():
+        seeding.seed_demo(books=0)
+        if not args.database or args.generate:
+            DataGenerator(args.books, args.users, args.reviews, seed=args.seed).run()
+
+        rng = random.Random(args.seed)
+        book_ids = [b for (b,) in db.session.query(Book.id)]
+        pending = [r for (r,) in db.session.query(Review.id)
+                   .filter(Review.status_id == lookups.status_id("pending"))
+                   .order_by(Review.id).limit(args.requests * 2)]
+        reviewer_id = (db.session.query(Review.user_id).group_by(Review.user_id)
+                       .order_by(db.func.count().desc()).limit(1).scalar())
+        users = {u.username: u for u in User.query.filter(
+            db.or_(User.username.in_(["user", "mod"]), User.id == reviewer_id))}
+        writers = User.query.filter(User.username.like("load%")).order_by(User.id).limit(50).all()
+        plan = {
+            "book_ids": rng.sample(book_ids, min(len(book_ids), 1000)),
+            "genre_ids": [g for (g,) in db.session.query(Genre.id)],
+            "pending": pending,
+            "user": users["user"],
+            "moderator": users["mod"],
+            "reviewer": next((u for u in users.values() if u.id == reviewer_id), users["user"]),
+            "writers": writers or [users["user"]],
+            "workdir": workdir,
+            "dataset": {"books": len(book_ids), "users": User.query.count(),
+                        "reviews": Review.query.count(), "seed": args.seed},
+        }
+    return app, plan
+
+
+def _scenarios(plan, seed):
+    """name → (пользователь, fn(i) → (метод, url, данные, страница с CSRF-токеном))."""
+    rng = random.Random(seed)
+    books, genres, pending = plan["book_ids"], plan["genre_ids"], plan["pending"]
+
+    def pick_book(i):
+        return books[rng.randrange(len(books))]
+
+    def index(i):
+        return "GET", f"/?genre={genres[i % len(genres)]}" if i % 2 else "/", None, None
+
+    def new_review(i):
+        book = pick_book(i)
+        data = {"rating": rng.randint(1, 5), "text": "Бенчмарк: рецензия"}
+        return "POST", f"/reviews/new/{book}", data, f"/reviews/new/{book}"
+
+    def moderate(action, offset):
+        def step(i):
+            return "POST", f"/moderation/{pending[(2 * i + offset) % len(pending)]}/{action}", None, None
+        return step
+
+    scenarios = {
+        "index": (None, index),
+        "view_book": (None, lambda i: ("GET", f"/books/{pick_book(i)}", None, None)),
+        "view_book_user": (plan["user"], lambda i: ("GET", f"/books/{pick_book(i)}", None, None)),
+        "my_reviews": (plan["reviewer"], lambda i: ("GET", "/my_reviews", None, None)),
+        "moderation": (plan["moderator"], lambda i: ("GET", "/moderation", None, None)),
+        "new_review": ("writers", new_review),
+    }
+    if pending:
+        # чётные id ожидающих — на одобрение, нечётные — на отклонение
+        scenarios["approve"] = (plan["moderator"], moderate("approve", 0))
+        scenarios["reject"] = (plan["moderator"], moderate("reject", 1))
+    return scenarios
+
+
+def _run_scenario(driver, user, step, requests, concurrency, writers):
+    def one(i):
+        method, url, data, csrf_from = step(i)
+        who = writers[i % len(writers)] if user == "writers" else user
+        if isinstance(driver, HttpDriver):
+            return driver.request(who, method, url, data, csrf_from=csrf_from)
+        return driver.request(who, method, url, data)
+
+    for who in (writers if user == "writers" else [user]):
+        driver.client(who)                       # вход до замера
+    for i in range(min(5, requests)):            # прогрев: кэши, пул соединений
+        one(-1 - i)
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(one, range(requests)))
+    else:
+        samples = [one(i) for i in range(requests)]
+    wall = time.perf_counter() - started
+
+    latencies = sorted(s[1] * 1000 for s in samples)
+    result = {
+        "requests": requests,
+        "errors": sum(1 for s in samples if s[0] >= 400),
+        "status": {str(code): n for code, n in sorted(Counter(s[0] for s in samples).items())},
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "rps": round(requests / wall, 1),
+    }
+    if samples[0][2] is not None:
+        result["sql_per_request"] = round(statistics.fmean(s[2] for s in samples), 2)
+    return result
+
+
+def routes(args):
+    app, plan = _prepare_dataset(args)
+    scenarios = _scenarios(plan, args.seed)
+    only = set(args.only.split(",")) if args.only else set(scenarios)
+    server = None
+    if args.gunicorn:
+        import seeding
+        server, base_url = _start_gunicorn(args.workers)
+        passwords = {login: pwd for login, pwd, *_ in seeding.DEMO_USERS}
+        passwords.update({u.username: "loadtest" for u in plan["writers"]})
+        passwords.setdefault(plan["reviewer"].username, "loadtest")
+        driver, concurrency = HttpDriver(base_url, passwords), args.concurrency
+    else:
+        driver, concurrency = ClientDriver(app), 1     # тестовый клиент не потокобезопасен
+    try:
+        results = {}
+        for name, (user, step) in scenarios.items():
+            if name in only:
+                results[name] = _run_scenario(driver, user, step, args.requests, concurrency,
+                                              plan["writers"])
+                _drain_jobs(app)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(plan["workdir"], ignore_errors=True)
+    return {
+        "benchmark": "routes",
+        "mode": "gunicorn" if args.gunicorn else "test-client",
+        "workers": args.workers if args.gunicorn else None,
+        "concurrency": concurrency,
+        "page_cache": args.page_cache,
+        "dataset": plan["dataset"],
+        "git": _git_revision(),
+        "scenarios": results,
+    }
+
+
+def _drain_jobs(app):
+    """Выполняет накопленные сценарием фоновые задачи (вне замера)."""
+    from extensions import job_queue
+    with app.app_context():
+        job_queue.run_pending()
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ──────────────── СРАВНЕНИЕ ──────────────────────────────────────
+# метрика → True, если «больше — хуже»
+_COMPARED = {"p50_ms": True, "p95_ms": True, "p99_ms": True, "rps": False,
+             "sql_per_request": True}
+
+
+def compare(base, new, threshold):
+    """Строки отчёта и число регрессий (рост хуже порога; SQL — любой рост)."""
+    lines, regressions = [], 0
+    if base.get("benchmark") == "startup":
+        pairs = {"startup": ({"seconds": base["seconds"]["median"], "maxrss_mb": base["maxrss_mb"]["median"]},
+                             {"seconds": new["seconds"]["median"], "maxrss_mb": new["maxrss_mb"]["median"]})}
+        metrics = {"seconds": True, "maxrss_mb": True}
+    else:
+        pairs = {name: (base["scenarios"][name], new["scenarios"][name])
+                 for name in base["scenarios"] if name in new.get("scenarios", {})}
+        metrics = _COMPARED
+    for name, (old, cur) in pairs.items():
+        for metric, higher_is_worse in metrics.items():
+            if metric not in old or metric not in cur or not old[metric]:
+                continue
+            change = (cur[metric] - old[metric]) / old[metric]
+            worse = change if higher_is_worse else -change
+            limit = 0 if metric == "sql_per_request" else threshold
+            flag = "❌" if worse > limit + 1e-9 else "  "
+            regressions += flag == "❌"
+            lines.append(f"{flag} {name:16} {metric:16} {old[metric]:>10} → {cur[metric]:<10} "
+                         f"({change:+.1%})")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="name", required=True)
+
+    p = sub.add_parser("startup", help="холодный старт воркера")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--database", help="БД для create_app (по умолчанию — временная копия "
+                                      "instance/library.db)")
+    p.add_argument("--json", dest="json_path", help="куда записать результат")
+
+    p = sub.add_parser("routes", help="задержки основных маршрутов")
+    p.add_argument("--books", type=int, default=5000)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--reviews", type=int, default=20000)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--requests", type=int, default=200, help="запросов на сценарий")
+    p.add_argument("--only", help="сценарии через запятую")
+    p.add_argument("--database", help="готовая БД вместо временной (данные не генерируются)")
+    p.add_argument("--generate", action="store_true", help="с --database: всё же добавить данные")
+    p.add_argument("--page-cache", action="store_true", help="не отключать кэш страниц")
+    p.add_argument("--gunicorn", action="store_true", help="мерить по HTTP через gunicorn")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--json", dest="json_path", help="куда записать результат")
+
+    p = sub.add_parser("compare", help="сравнить два JSON-результата")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.15, help="допустимое ухудшение (доля)")
+    args = parser.parse_args(argv)
+
+    if args.name == "compare":
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        lines, regressions = compare(base, new, args.threshold)
+        print("\n".join(lines))
+        print(f"Регрессий: {regressions}")
+        sys.exit(1 if regressions else 0)
+
+    result = (startup(runs=args.runs, database=args.database) if args.name == "startup"
+              else routes(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
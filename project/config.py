@@ -3,4 +3,55 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY','dev-key')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL','sqlite:///library.db')
     SQLALCHEMY_TRACK_MODIFICATIONS=False
+    # применять миграции при старте; в проде лучше 0 и `flask db-upgrade` при деплое
+    AUTO_MIGRATE = os.getenv('AUTO_MIGRATE', '1') not in ('0', 'false', 'no')
+    # SQLite (см. dbconfig.py): WAL + busy_timeout против «database is locked» под gunicorn
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    # PostgreSQL: пул соединений на воркер
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') not in ('0', 'false', 'no')
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 15000))
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', os.path.join(os.path.dirname(__file__), 'uploads'))
+    COVER_MAX_AGE = int(os.getenv('COVER_MAX_AGE', 365 * 24 * 3600))   # обложки неизменяемы (имя = md5)
+    # кэш HTML-страниц для анонимов: memory | file (общий для воркеров) | none
+    PAGE_CACHE_BACKEND = os.getenv('PAGE_CACHE_BACKEND', 'memory')
+    PAGE_CACHE_DIR = os.getenv('PAGE_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'instance', 'page_cache'))
+    PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', 512))
+    PAGE_CACHE_TTL = int(os.getenv('PAGE_CACHE_TTL', 300))
+    # кэш current_user (снимок пользователя и роли) на воркер, секунды; 0 — выключен
+    IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 60))
+    IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 1024))
+    # справочники (роли, статусы, жанры) на воркер: как часто сверять их с БД, секунды
+    LOOKUPS_CHECK_SECONDS = int(os.getenv('LOOKUPS_CHECK_SECONDS', 30))
+    REVIEWS_PER_PAGE = int(os.getenv('REVIEWS_PER_PAGE', 10))         # порция рецензий на странице книги
+    SIMILAR_BOOKS_SHOWN = int(os.getenv('SIMILAR_BOOKS_SHOWN', 6))    # «похожие книги» (flask rebuild-similar)
+    MODERATION_BULK_MAX = int(os.getenv('MODERATION_BULK_MAX', 5000))   # id в одном пакетном запросе
+    # очередь модерации: сколько рецензий берётся за раз и на сколько секунд
+    MODERATION_CLAIM_SIZE = int(os.getenv('MODERATION_CLAIM_SIZE', 10))
+    MODERATION_LEASE_SECONDS = int(os.getenv('MODERATION_LEASE_SECONDS', 900))
+    # фоновые задачи (см. jobs.py): thread — поток в процессе приложения, off — только flask jobs-worker
+    JOBS_WORKER = os.getenv('JOBS_WORKER', 'thread')
+    JOBS_BATCH_SIZE = int(os.getenv('JOBS_BATCH_SIZE', 20))
+    JOBS_LEASE_SECONDS = int(os.getenv('JOBS_LEASE_SECONDS', 300))       # потом задачу подберёт другой
+    JOBS_POLL_SECONDS = float(os.getenv('JOBS_POLL_SECONDS', 2))
+    JOBS_RETRY_BASE_SECONDS = int(os.getenv('JOBS_RETRY_BASE_SECONDS', 10))   # пауза × 2^(попытка-1)
+    JOBS_KEEP_DONE_HOURS = int(os.getenv('JOBS_KEEP_DONE_HOURS', 24))
+    COVER_GC_DELAY_SECONDS = int(os.getenv('COVER_GC_DELAY_SECONDS', 600))   # файл удалённой обложки
+    # инструментирование запросов (см. instrumentation.py): Server-Timing, /_metrics, cProfile
+    INSTRUMENTATION = os.getenv('INSTRUMENTATION', '0') not in ('0', 'false', 'no')
+    SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 500))
+    SLOW_SQL_STATEMENTS = int(os.getenv('SLOW_SQL_STATEMENTS', 3))
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(__file__), 'instance', 'profiles'))
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')        # Bearer-токен для сборщика Prometheus
+    # JSON API (см. api.py)
+    API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 20))
+    API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 100))
+    API_GZIP_MIN_BYTES = int(os.getenv('API_GZIP_MIN_BYTES', 1024))   # меньше — не сжимаем
+    API_GZIP_LEVEL = int(os.getenv('API_GZIP_LEVEL', 6))
@@ -0,0 +1,401 @@
+# covers.py
+"""Хранение обложек и их параллельная загрузка для CLI (fake-books, fill-covers).
+
+Файлы лежат под UPLOAD_FOLDER по содержимому: ab/cd/<md5><ext>, где ab и
+cd — первые символы md5 (не больше 256 файлов-подкаталогов на уровень).
+Старые обложки с плоским именем <md5>.jpg продолжают работать: в БД
+хранится путь относительно UPLOAD_FOLDER.
+
+Рядом с оригиналом лежат уменьшенные копии <оригинал>.<размер>.<jpg|webp>
+(см. DERIVATIVE_SIZES); их делает Pillow, а без него отдаётся оригинал.
+
+Источник изображений подключаемый: HTTP-шаблон URL (picsum, unsplash или
+локальная заглушка вроде http://127.0.0.1:8000/{seed}.jpg) либо локальный
+каталог с картинками — так команды работают и без интернета.
+Скачивание идёт в ограниченном пуле потоков с повторами и экспоненциальной
+паузой, а запись в БД — пакетами с одним коммитом на пакет.
+"""
+import hashlib
+import io
+import os
+import random
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from werkzeug.utils import secure_filename
+
+SOURCES = {
+    "picsum":   "https://picsum.photos/seed/{seed}/300/450",
+    "unsplash": "https://source.unsplash.com/featured/300x450/?book&sig={seed}",
+}
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"GIF8", "image/gif", ".gif"),
+)
+
+
+CHUNK_SIZE = 64 * 1024
+
+DERIVATIVE_SIZES = {            # имя → максимальные (ширина, высота)
+    "card":   (320, 480),
+    "detail": (600, 900),
+}
+DERIVATIVE_FORMATS = ("jpg", "webp")
+_MD5_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def sniff_image(data, default=("image/jpeg", ".jpg")):
+    """(mimetype, расширение) по сигнатуре файла."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp", ".webp"
+    for magic, mimetype, ext in _SIGNATURES:
+        if data.startswith(magic):
+            return mimetype, ext
+    return default
+
+
+def content_path(md5, ext):
+    """Относительный путь файла по содержимому: ab/cd/<md5><ext>."""
+    return f"{md5[:2]}/{md5[2:4]}/{md5}{ext}"
+
+
+def _publish(tmp_path, upload_dir, relpath):
+    """Атомарно переносит временный файл на место; дубликат просто удаляется.
+
+    У существующего файла обновляется mtime: cover_gc не тронет файл, который
+    только что понадобился загрузке, ещё не закоммитившей свою обложку.
+    """
+    final = os.path.join(upload_dir, relpath)
+    os.makedirs(os.path.dirname(final), exist_ok=True)
+    if os.path.exists(final):
+        os.remove(tmp_path)
+        os.utime(final)
+    else:
+        os.replace(tmp_path, final)
+
+
+# ──────────────── ПРОИЗВОДНЫЕ (МИНИАТЮРЫ) ─────────────────────────
+def derivative_path(relpath, size, fmt):
+    """ab/cd/<md5>.png → ab/cd/<md5>.png.card.webp"""
+    return f"{relpath}.{size}.{fmt}"
+
+
+def parse_upload_name(relpath):
+    """Путь в UPLOAD_FOLDER → (md5 или None, оригинал, вариант или None).
+
+    Вариант — «<размер>.<формат>» для производных, None для оригинала.
+    """
+    head, name = os.path.split(relpath)
+    parts = name.split(".")
+    md5 = parts[0] if _MD5_RE.match(parts[0]) else None
+    if len(parts) >= 4 and parts[-2] in DERIVATIVE_SIZES and parts[-1] in DERIVATIVE_FORMATS:
+        original = os.path.join(head, ".".join(parts[:-2])).replace(os.sep, "/")
+        return md5, original, f"{parts[-2]}.{parts[-1]}"
+    return md5, relpath, None
+
+
+def thumbnails_available():
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def check_image(data):
+    """Проверяет, что скачанное — целое изображение, до записи в хранилище.
+
+    Страница ошибки вместо картинки или обрезанный ответ — ValueError/OSError;
+    загрузка повторит такой ответ как сетевую ошибку.
+    """
+    if sniff_image(data, default=None) is None:
+        raise ValueError("не изображение: неизвестная сигнатура")
+    if thumbnails_available():
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()                    # декодирует целиком: ловит обрезанные файлы
+
+
+def make_derivatives(upload_dir, relpath, force=False):
+    """Создаёт все уменьшенные копии оригинала. Возвращает число новых файлов."""
+    if not thumbnails_available():
+        return 0
+    from PIL import Image
+
+    targets = [
+        (size, fmt, derivative_path(relpath, size, fmt))
+        for size in DERIVATIVE_SIZES for fmt in DERIVATIVE_FORMATS
+    ]
+    if not force:
+        targets = [t for t in targets if not os.path.exists(os.path.join(upload_dir, t[2]))]
+    if not targets:
+        return 0
+
+    with Image.open(os.path.join(upload_dir, relpath)) as src:
+        src = src.convert("RGB")
+        for size, fmt, target in targets:
+            img = src.copy()
+            img.thumbnail(DERIVATIVE_SIZES[size], Image.LANCZOS)
+            fd, tmp_path = tempfile.mkstemp(dir=upload_dir, suffix=".part")
+            with os.fdopen(fd, "wb") as out:
+                if fmt == "webp":
+                    img.save(out, "WEBP", quality=80, method=4)
+                else:
+                    img.save(out, "JPEG", quality=85, optimize=True, progressive=True)
+            final = os.path.join(upload_dir, target)
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.replace(tmp_path, final)
+    return len(targets)
+
+
+def remove_cover_files(upload_dir, relpath):
+    """Удаляет оригинал и все его уменьшенные копии. Возвращает число удалённых файлов."""
+    names = [relpath] + [derivative_path(relpath, size, fmt)
+                         for size in DERIVATIVE_SIZES for fmt in DERIVATIVE_FORMATS]
+    removed = 0
+    for name in names:
+        try:
+            os.remove(os.path.join(upload_dir, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+# ──────────────── ЗАГРУЗКА ЧЕРЕЗ ФОРМУ И ИМПОРТ ─────────────────
+def _store_stream(stream, upload_dir, default_type):
+    """Потоково пишет stream в UPLOAD_FOLDER, считая md5 на лету.
+
+    Память — один блок CHUNK_SIZE независимо от размера файла.
+    Возвращает (md5, относительный путь, mimetype).
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    digest = hashlib.md5()
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, suffix=".part")
+    try:
+        head = b""
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if len(head) < 16:
+                    head += chunk[:16]
+                digest.update(chunk)
+                out.write(chunk)
+        md5 = digest.hexdigest()
+        mimetype, ext = sniff_image(head, default=default_type)
+        relpath = content_path(md5, ext)
+        _publish(tmp_path, upload_dir, relpath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return md5, relpath, mimetype
+
+
+def store_upload(file_storage, upload_dir):
+    """Сохраняет загруженный через форму файл. Возвращает (md5, путь, mimetype)."""
+    client_ext = os.path.splitext(secure_filename(file_storage.filename or ""))[1].lower()
+    return _store_stream(file_storage.stream, upload_dir,
+                         default_type=(file_storage.mimetype, client_ext))
+
+
+def store_file(path, upload_dir):
+    """То же для локального файла (импорт каталога)."""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as f:
+        return _store_stream(f, upload_dir, default_type=("application/octet-stream", ext))
+
+
+def attach_cover(book, md5, filename, mimetype):
+    """Привязывает к книге обложку из сохранённого файла.
+
+    У каждой книги своя строка Cover; одинаковые изображения делят один файл
+    (путь по md5), поэтому другая книга с той же картинкой обложку не теряет.
+    """
+    from models import Cover
+
+    if book.cover is None:
+        book.cover = Cover(filename=filename, mimetype=mimetype, md5_hash=md5)
+    else:
+        book.cover.filename, book.cover.mimetype, book.cover.md5_hash = filename, mimetype, md5
+
+
+# ──────────────── ИСТОЧНИКИ ─────────────────────────────────────
+class HttpImageSource:
+    """Изображение по URL-шаблону с плейсхолдером {seed}."""
+
+    def __init__(self, url_template, timeout=10):
+        import requests                   # нужен только CLI-командам
+        self.url_template = url_template
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def fetch(self, seed):
+        resp = self.session.get(self.url_template.format(seed=seed), timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.content
+
+    def __str__(self):
+        return self.url_template
+
+
+class DirectoryImageSource:
+    """Случайный файл из локального каталога (офлайн-режим)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = sorted(
+            os.path.join(path, f) for f in os.listdir(path)
+            if os.path.splitext(f)[1].lower() in (".jpg", ".jpeg", ".png", ".gif", ".webp")
+        )
+        if not self.files:
+            raise ValueError(f"в каталоге {path} нет изображений")
+
+    def fetch(self, seed):
+        with open(random.Random(str(seed)).choice(self.files), "rb") as f:
+            return f.read()
+
+    def __str__(self):
+        return self.path
+
+
+def make_source(spec, timeout=10):
+    """'picsum' | 'unsplash' | URL-шаблон с {seed} | путь к каталогу."""
+    if spec in SOURCES:
+        return HttpImageSource(SOURCES[spec], timeout)
+    if os.path.isdir(spec):
+        return DirectoryImageSource(spec)
+    if "{seed}" in spec:
+        return HttpImageSource(spec, timeout)
+    raise ValueError(f"неизвестный источник обложек: {spec}")
+
+
+# ──────────────── ЗАГРУЗКА ──────────────────────────────────────
+class FetchStats:
+    """Счётчики загрузки; повторы считают потоки загрузки, поэтому всё — под замком."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.started = time.monotonic()
+        self.ok = 0
+        self.bytes = 0
+        self.retries = 0
+        self.failures = {}                # вид ошибки → [сколько раз, пример]
+
+    def done(self, size):
+        with self._lock:
+            self.ok += 1
+            self.bytes += size
+
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+
+    def fail(self, exc):
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+        key = type(exc).__name__ + (f" {status}" if status else "")
+        with self._lock:
+            entry = self.failures.setdefault(key, [0, str(exc)[:120]])
+            entry[0] += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        failed = sum(n for n, _ in self.failures.values())
+        lines = [
+            f"обложек: {self.ok} за {elapsed:.1f} с "
+            f"({self.ok / elapsed:.1f} шт/с, {self.bytes / elapsed / 1024:.0f} КБ/с), "
+            f"повторов: {self.retries}, ошибок: {failed}"
+        ]
+        lines += [f"  ✗ {n} × {kind} (например: {sample})"
+                  for kind, (n, sample) in sorted(self.failures.items(), key=lambda e: -e[1][0])]
+        return "\n".join(lines)
+
+
+def _fetch_with_retry(source, seed, retries, backoff, stats):
+    for attempt in range(retries + 1):
+        try:
+            data = source.fetch(seed)
+            check_image(data)
+            return data
+        except Exception:
+            if attempt == retries:
+                raise
+            stats.retried()
+            time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+def fetch_covers(source, keys, upload_dir, workers=8, retries=3, backoff=0.5, stats=None):
+    """Скачивает по изображению на каждый ключ параллельно и сохраняет файлы.
+
+    Генерирует (key, md5, filename, mimetype) по мере готовности; файл
+    пишется прямо в потоке загрузки (путь по md5, запись идемпотентна) и только
+    после check_image — битый ответ не оставит в хранилище файла без Cover.
+    """
+    stats = stats or FetchStats()
+    os.makedirs(upload_dir, exist_ok=True)
+
+    def job(key):
+        data = _fetch_with_retry(source, key, retries, backoff, stats)
+        md5 = hashlib.md5(data).hexdigest()
+        mimetype, ext = sniff_image(data)
+        filename = content_path(md5, ext)
+        fd, tmp_path = tempfile.mkstemp(dir=upload_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        _publish(tmp_path, upload_dir, filename)
+        make_derivatives(upload_dir, filename)
+        return key, md5, filename, mimetype, len(data)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(job, key) for key in keys]
+        for fut in as_completed(futures):
+            try:
+                key, md5, filename, mimetype, size = fut.result()
+            except Exception as exc:
+                stats.fail(exc)
+                continue
+            stats.done(size)
+            yield key, md5, filename, mimetype
+
+
+def attach_covers(results, batch_size=100):
+    """Привязывает скачанные обложки к книгам пакетами (один SELECT и COMMIT на пакет).
+
+    results — (book_id, md5, filename, mimetype). Возвращает (с новым файлом,
+    с файлом, который уже был у другой книги).
+    """
+    from extensions import db
+    from models import Cover
+
+    added = linked = 0
+
+    def flush(batch):
+        nonlocal added, linked
+        known = set(db.session.scalars(
+            db.select(Cover.md5_hash).where(Cover.md5_hash.in_({r[1] for r in batch}))))
+        for book_id, md5, filename, mimetype in batch:
+            if md5 in known:                  # файл уже есть у другой книги — делим его
+                linked += 1
+            else:
+                known.add(md5)
+                added += 1
+            db.session.add(Cover(filename=filename, mimetype=mimetype,
+                                 md5_hash=md5, book_id=book_id))
+        db.session.commit()
+
+    batch = []
+    for item in results:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return added, linked
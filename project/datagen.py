@@ -0,0 +1,248 @@
+# datagen.py
+"""Генератор больших синтетических наборов данных для нагрузочных тестов.
+
+Пишет книги, связи с жанрами, пользователей и рецензии пачками через Core
+INSERT (executemany, без ORM-объектов и flush на строку) с явными id, поэтому
+связи строятся без обратных SELECT. Всё детерминировано: одинаковые seed и
+параметры дают одинаковые данные. Обложки не скачиваются — работает офлайн.
+
+Агрегаты, счётчики фасетов и поисковый индекс пересчитываются в конце
+одним INSERT … SELECT каждый. HTML рецензий/описаний не рендерится
+(его досчитает flask backfill-html или ленивый кэш при показе).
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text
+
+from extensions import db
+from models import Book, Genre, Review, User, book_genres, lookups, rebuild_book_stats
+import facets
+import search
+
+DEFAULT_STATUS_MIX = {"approved": 0.7, "pending": 0.2, "rejected": 0.1}
+DEFAULT_RATING_WEIGHTS = [2, 3, 6, 14, 35, 40]       # вес оценок 0..5
+# даты рецензий отсчитываются назад от фиксированного момента, а не от «сейчас»:
+# тот же seed в любой день даёт те же строки
+EPOCH = datetime(2024, 1, 1)
+
+
+def parse_weights(spec, names=None):
+    """"approved=0.7,pending=0.2" → dict или "2,3,6" → list (для --status-mix / --ratings)."""
+    if names is None:
+        return [float(x) for x in spec.split(",")]
+    weights = {}
+    for part in spec.split(","):
+        name, _, value = part.partition("=")
+        if name not in names:
+            raise ValueError(f"неизвестное имя {name!r}, допустимо: {', '.join(names)}")
+        weights[name] = float(value)
+    return weights
+
+
+class Progress:
+    """Печатает «таблица: n/total, строк/с» не чаще раза в секунду и итог.
+
+    total=None — объём заранее неизвестен (потоковый импорт/экспорт).
+    """
+
+    def __init__(self, label, total=None, file=None):
+        self.label, self.total = label, total
+        self.file = file or sys.stdout
+        self.done = 0
+        self.started = self.printed = time.perf_counter()
+
+    def add(self, n):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.printed >= 1 or (self.total is not None and self.done >= self.total):
+            self.printed = now
+            self.show(now)
+
+    def show(self, now=None):
+        rate = self.done / max((now or time.perf_counter()) - self.started, 1e-9)
+        of = f"/{self.total}" if self.total is not None else ""
+        print(f"  {self.label}: {self.done}{of} ({rate:,.0f} строк/с)", file=self.file)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class DataGenerator:
+    def __init__(self, books, users, reviews, seed=1, batch_size=5000,
+                 status_mix=None, rating_weights=None, genres_per_book=(1, 3),
+                 popularity=1.1, years=(1950, 2024), days=730, password="loadtest"):
+        self.books, self.users, self.reviews = books, users, reviews
+        self.seed = seed
+        self.batch_size = batch_size
+        self.status_mix = status_mix or DEFAULT_STATUS_MIX
+        self.rating_weights = rating_weights or DEFAULT_RATING_WEIGHTS
+        self.genres_per_book = genres_per_book
+        self.popularity = popularity          # показатель Ципфа: рецензии у «хитов»
+        self.years = years
+        self.days = days                      # рецензии за N дней до EPOCH
+        self.password = password
+        self.rng = random.Random(seed)
+        self.report = {}
+
+    # ─── вспомогательное
+    def _insert(self, table, rows_iter, total, label):
+        progress = Progress(label, total)
+        batch = []
+        for row in rows_iter:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                db.session.execute(table.insert(), batch)
+                db.session.commit()
+                progress.add(len(batch))
+                batch = []
+        if batch:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+            progress.add(len(batch))
+        self.report[label] = (progress.done, progress.elapsed)
+
+    @staticmethod
+    def _next_id(model):
+        return (db.session.scalar(select(func.max(model.id))) or 0) + 1
+
+    def _pools(self):
+        from faker import Faker
+        fake = Faker("ru_RU")
+        fake.seed_instance(self.seed)
+        n = max(50, min(2000, self.books // 20))
+        return {
+            "authors": [fake.name() for _ in range(n)],
+            "publishers": [fake.company() for _ in range(max(20, n // 10))],
+            "words": sorted(set(fake.words(nb=5000))),
+            "descriptions": [fake.paragraph(nb_sentences=8) for _ in range(500)],
+            "reviews": [fake.paragraph(nb_sentences=4) for _ in range(1000)],
+            "names": [(fake.last_name(), fake.first_name()) for _ in range(1000)],
+        }
+
+    # ─── таблицы
+    def _book_rows(self, first_id, pools):
+        rng, lo, hi = self.rng, *self.years
+        for i in range(self.books):
+            title = " ".join(rng.sample(pools["words"], rng.randint(2, 5))).capitalize()
+            yield {
+                "id": first_id + i,
+                "title": title,
+                "description": rng.choice(pools["descriptions"]),
+                # ближе к настоящему каталогу: новых книг больше, чем старых
+                "year": int(rng.triangular(lo, hi, hi)),
+                "publisher": rng.choice(pools["publishers"]),
+                "author": rng.choice(pools["authors"]),
+                "pages": max(16, int(rng.lognormvariate(5.7, 0.4))),
+            }
+
+    def _genre_rows(self, book_ids, genre_ids):
+        lo, hi = self.genres_per_book
+        for book_id in book_ids:
+            for genre_id in self.rng.sample(genre_ids, min(len(genre_ids), self.rng.randint(lo, hi))):
+                yield {"book_id": book_id, "genre_id": genre_id}
+
+    def _user_rows(self, first_id, pools):
+        from werkzeug.security import generate_password_hash
+        password_hash = generate_password_hash(self.password)   # один хэш на всех — дорого
+        role_id = lookups.role("user").id
+        for i in range(self.users):
+            last, first = self.rng.choice(pools["names"])
+            yield {
+                "id": first_id + i,
+                "username": f"load{first_id + i}",
+                "password_hash": password_hash,
+                "last_name": last,
+                "first_name": first,
+                "role_id": role_id,
+            }
+
+    def _reviews_per_book(self, n_books, n_users):
+        # ранги популярности перемешаны, чтобы «хиты» не шли подряд по id
+        weights = [1 / (rank + 1) ** self.popularity for rank in range(n_books)]
+        self.rng.shuffle(weights)
+        counts = [0] * n_books
+        for _ in range(5):
+            # у «хитов» рецензий не больше, чем пользователей; остаток — остальным книгам
+            deficit = self.reviews - sum(counts)
+            free = [i for i, c in enumerate(counts) if c < n_users]
+            if deficit <= 0 or not free:
+                break
+            scale = deficit / sum(weights[i] for i in free)
+            for i in free:
+                counts[i] = min(n_users, counts[i] + int(weights[i] * scale + self.rng.random()))
+        return counts
+
+    def _review_rows(self, book_ids, user_ids, counts, pools):
+        rng = self.rng
+        statuses = [lookups.status_id(name) for name in self.status_mix]
+        status_weights = list(self.status_mix.values())
+        ratings = list(range(len(self.rating_weights)))
+        next_id = self._next_id(Review)
+        for book_id, count in zip(book_ids, counts):
+            if not count:
+                continue
+            chosen_status = rng.choices(statuses, status_weights, k=count)
+            chosen_rating = rng.choices(ratings, self.rating_weights, k=count)
+            for j, user_id in enumerate(rng.sample(user_ids, count)):
+                yield {
+                    "id": next_id,
+                    "book_id": book_id,
+                    "user_id": user_id,
+                    "rating": chosen_rating[j],
+                    "text_md": rng.choice(pools["reviews"]),
+                    "created_at": EPOCH - timedelta(seconds=rng.randrange(self.days * 86400)),
+                    "status_id": chosen_status[j],
+                }
+                next_id += 1
+
+    # ─── запуск
+    def run(self):
+        started = time.perf_counter()
+        pools = self._pools()
+        genre_ids = list(db.session.scalars(select(Genre.id)))
+        if not genre_ids:
+            raise RuntimeError("нет жанров — сначала выполните flask seed")
+
+        first_book = self._next_id(Book)
+        book_ids = list(range(first_book, first_book + self.books))
+        self._insert(Book.__table__, self._book_rows(first_book, pools), self.books, "book")
+        links = list(self._genre_rows(book_ids, genre_ids))
+        self._insert(book_genres, links, len(links), "book_genres")
+
+        first_user = self._next_id(User)
+        self._insert(User.__table__, self._user_rows(first_user, pools), self.users, "user")
+        user_ids = list(range(first_user, first_user + self.users))
+
+        if self.reviews and user_ids:
+            counts = self._reviews_per_book(len(book_ids), len(user_ids))
+            self._insert(Review.__table__, self._review_rows(book_ids, user_ids, counts, pools),
+                         sum(counts), "review")
+
+        self._sync_sequences()
+        self._rebuild_derived()
+        self.report["total"] = (sum(n for n, _ in self.report.values()),
+                                time.perf_counter() - started)
+        return self.report
+
+    def _sync_sequences(self):
+        # явные id не двигают последовательности PostgreSQL
+        if db.session.get_bind().dialect.name != "postgresql":
+            return
+        for table in ("book", "user", "review"):
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                f"(SELECT MAX(id) FROM \"{table}\"))"))
+        db.session.commit()
+
+    def _rebuild_derived(self):
+        started = time.perf_counter()
+        rebuild_book_stats()
+        facets.rebuild()
+        if search.fts_available():
+            search.rebuild_index(db.session)
+        db.session.commit()
+        self.report["derived"] = (0, time.perf_counter() - started)
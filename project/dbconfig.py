@@ -0,0 +1,83 @@
+# dbconfig.py
+"""Настройки движка БД в зависимости от бэкенда.
+
+SQLite: WAL (читатели не блокируют писателя), synchronous=NORMAL,
+busy_timeout вместо мгновенного «database is locked», mmap и foreign_keys
+(без него SQLite не выполняет ON DELETE CASCADE, на которые рассчитаны
+passive_deletes в моделях) — через событие connect, т. е. для каждого нового
+соединения пула.
+PostgreSQL: размер пула, overflow, pre-ping, recycle и statement_timeout.
+Все значения берутся из Config (а туда — из переменных окружения).
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+def backend_name(uri):
+    return make_url(uri).get_backend_name()
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS для бэкенда из SQLALCHEMY_DATABASE_URI."""
+    backend = backend_name(config["SQLALCHEMY_DATABASE_URI"])
+    if backend == "sqlite":
+        # таймаут драйвера в секундах; тот же busy_timeout, но и на этапе connect
+        return {"connect_args": {"timeout": config["SQLITE_BUSY_TIMEOUT_MS"] / 1000}}
+    if backend == "postgresql":
+        options = {
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            "pool_timeout": config["DB_POOL_TIMEOUT"],
+            "pool_recycle": config["DB_POOL_RECYCLE"],
+            "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        }
+        if config["DB_STATEMENT_TIMEOUT_MS"]:
+            options["connect_args"] = {
+                "options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"
+            }
+        return options
+    return {}
+
+
+def sqlite_pragmas(config):
+    return {
+        "journal_mode": config["SQLITE_JOURNAL_MODE"],
+        "synchronous": config["SQLITE_SYNCHRONOUS"],
+        "busy_timeout": config["SQLITE_BUSY_TIMEOUT_MS"],
+        "mmap_size": config["SQLITE_MMAP_SIZE"],
+        "foreign_keys": "ON",
+    }
+
+
+def install(engine, config):
+    """Вешает PRAGMA на connect (только SQLite)."""
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def describe(engine):
+    """Строка с фактическими настройками для лога запуска."""
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as conn:
+            values = {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                      for name in ("journal_mode", "synchronous", "busy_timeout", "mmap_size",
+                                   "foreign_keys")}
+        return "sqlite: " + ", ".join(f"{k}={v}" for k, v in values.items())
+    pool = engine.pool
+    parts = [f"pool={type(pool).__name__}"]
+    if hasattr(pool, "size"):
+        parts += [f"size={pool.size()}", f"max_overflow={pool._max_overflow}",
+                  f"timeout={pool._timeout}"]
+    parts += [f"recycle={pool._recycle}", f"pre_ping={pool._pre_ping}"]
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            parts.append(f"statement_timeout={conn.exec_driver_sql('SHOW statement_timeout').scalar()}")
+    return f"{engine.dialect.name}: " + ", ".join(parts)
@@ -1,4 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from pagecache import PageCache
+from instrumentation import Instrumentation
+from jobs import JobQueue
 db = SQLAlchemy()
 login_manager = LoginManager()
+page_cache = PageCache()
+instrumentation = Instrumentation()
+job_queue = JobQueue()
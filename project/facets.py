@@ -0,0 +1,179 @@
+# facets.py
+"""Фасетный фильтр каталога: жанр, диапазон годов, минимальная оценка.
+
+Счётчики хранятся в facet_count и меняются инкрементально: перед изменением
+книги её вклад вычитается (remove_book), после — добавляется заново
+(add_book), в той же транзакции. Страница каталога суммирует лишь
+несколько строк этой маленькой таблицы вместо GROUP BY по книгам.
+"""
+from sqlalchemy import text
+
+from extensions import db
+from models import Book, BookStats, FacetCount, book_genres
+
+RATING_CHOICES = [5, 4, 3, 2, 1]
+
+
+class FacetFilter:
+    """Параметры фильтра из query string (невалидные значения игнорируются)."""
+
+    def __init__(self, args):
+        self.genre = args.get("genre", type=int)
+        self.year_from = args.get("year_from", type=int)
+        self.year_to = args.get("year_to", type=int)
+        self.min_rating = args.get("min_rating", type=int)
+        if self.min_rating not in RATING_CHOICES:
+            self.min_rating = None
+
+    @property
+    def active(self):
+        return any(v is not None for v in
+                   (self.genre, self.year_from, self.year_to, self.min_rating))
+
+    def url_args(self, **override):
+        """Аргументы для url_for: текущий фильтр с заменой части значений."""
+        args = {"genre": self.genre, "year_from": self.year_from,
+                "year_to": self.year_to, "min_rating": self.min_rating}
+        args.update(override)
+        return {k: v for k, v in args.items() if v is not None}
+
+    def apply(self, query):
+        """Фильтрует запрос книг (для самой выдачи, не для счётчиков)."""
+        if self.genre is not None:
+            query = query.filter(Book.genres.any(id=self.genre))
+        if self.year_from is not None:
+            query = query.filter(Book.year >= self.year_from)
+        if self.year_to is not None:
+            query = query.filter(Book.year <= self.year_to)
+        if self.min_rating is not None:
+            query = query.filter(Book.stats.has(BookStats.avg_rating >= self.min_rating))
+        return query
+
+
+# ──────────────── ЧТЕНИЕ СЧЁТЧИКОВ ──────────────────────────────
+def _cell_filter(query, flt, use_genre=True, use_year=True, use_rating=True):
+    if use_genre:
+        query = query.filter(FacetCount.genre_id == (flt.genre or 0))
+    if use_year and flt.year_from is not None:
+        query = query.filter(FacetCount.year >= flt.year_from)
+    if use_year and flt.year_to is not None:
+        query = query.filter(FacetCount.year <= flt.year_to)
+    if use_rating and flt.min_rating is not None:
+        query = query.filter(FacetCount.rating_bucket >= flt.min_rating)
+    return query
+
+
+def facet_counts(flt):
+    """Счётчики для боковой панели с учётом остальных условий фильтра."""
+    total = db.func.sum(FacetCount.books)
+
+    genre_rows = (
+        _cell_filter(db.session.query(FacetCount.genre_id, total), flt, use_genre=False)
+        .filter(FacetCount.genre_id != 0)
+        .group_by(FacetCount.genre_id)
+    )
+    decade = (FacetCount.year // 10) * 10
+    decade_rows = (
+        _cell_filter(db.session.query(decade, total), flt, use_year=False)
+        .group_by(decade).order_by(decade.desc())
+    )
+    bucket_rows = (
+        _cell_filter(db.session.query(FacetCount.rating_bucket, total), flt, use_rating=False)
+        .group_by(FacetCount.rating_bucket)
+    )
+    matched = _cell_filter(db.session.query(total), flt).scalar() or 0
+
+    by_bucket = dict(bucket_rows.all())
+    return {
+        "total": matched,
+        "genres": {gid: n for gid, n in genre_rows if n},
+        "decades": [(d, n) for d, n in decade_rows if n],
+        # «не ниже r» — сумма по корзинам r..5
+        "ratings": [(r, sum(n for b, n in by_bucket.items() if b >= r)) for r in RATING_CHOICES],
+    }
+
+
+# ──────────────── ИНКРЕМЕНТАЛЬНОЕ ОБНОВЛЕНИЕ ─────────────────────
+def _is_sqlite(bind):
+    dialect = getattr(bind, "dialect", None) or bind.get_bind().dialect
+    return dialect.name == "sqlite"
+
+
+def _bucket_expr(avg):
+    # в SQLite нет гарантированного FLOOR, но CAST усекает (avg ≥ 0 — то же самое);
+    # PostgreSQL при CAST округляет, поэтому там FLOOR
+    floor = db.cast(avg, db.Integer) if _is_sqlite(db.session) else \
+        db.cast(db.func.floor(avg), db.Integer)
+    return db.case((avg.is_(None), -1), else_=floor)
+
+
+def _book_cells(book_ids):
+    """Ячейки (genre_id, year, bucket, n), в которые сейчас входят книги book_ids."""
+    bucket = _bucket_expr(BookStats.avg_rating)
+    everyone = (
+        db.select(db.literal(0), Book.year, bucket, db.func.count())
+        .select_from(Book)
+        .outerjoin(BookStats, BookStats.book_id == Book.id)
+        .where(Book.id.in_(book_ids))
+        .group_by(Book.year, bucket)
+    )
+    per_genre = (
+        db.select(book_genres.c.genre_id, Book.year, bucket, db.func.count())
+        .select_from(Book)
+        .join(book_genres, book_genres.c.book_id == Book.id)
+        .outerjoin(BookStats, BookStats.book_id == Book.id)
+        .where(Book.id.in_(book_ids))
+        .group_by(book_genres.c.genre_id, Book.year, bucket)
+    )
+    return db.union_all(everyone, per_genre)
+
+
+def _shift(book_ids, sign):
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+    cells = [{"g": g, "y": y, "b": b, "d": sign * n}
+             for g, y, b, n in db.session.execute(_book_cells(book_ids))]
+    if cells:
+        _upsert(cells)
+
+
+def _upsert(cells):
+    # один executemany на все ячейки (пакетная модерация трогает сотни книг)
+    db.session.execute(text(
+        "INSERT INTO facet_count (genre_id, year, rating_bucket, books) "
+        "VALUES (:g, :y, :b, :d) "
+        "ON CONFLICT (genre_id, year, rating_bucket) "
+        "DO UPDATE SET books = facet_count.books + excluded.books"
+    ), cells)
+
+
+def remove_book(*book_ids):
+    """Вычитает текущий вклад книг (вызывать ДО изменения книги/рейтинга)."""
+    _shift(book_ids, -1)
+
+
+def add_book(*book_ids):
+    """Добавляет вклад книг по их текущему состоянию (ПОСЛЕ flush)."""
+    _shift(book_ids, +1)
+
+
+def rebuild(conn=None):
+    """Пересчитывает все счётчики с нуля (миграция / flask rebuild-facets)."""
+    bind = conn or db.session
+    bind.execute(text("DELETE FROM facet_count"))
+    floor = "s.avg_rating" if _is_sqlite(bind) else "FLOOR(s.avg_rating)"
+    bucket = f"CASE WHEN s.avg_rating IS NULL THEN -1 ELSE CAST({floor} AS INTEGER) END"
+    bind.execute(text(
+        "INSERT INTO facet_count (genre_id, year, rating_bucket, books) "
+        f"SELECT 0, b.year, {bucket}, COUNT(*) "
+        "FROM book b LEFT JOIN book_stats s ON s.book_id = b.id "
+        f"GROUP BY b.year, {bucket}"
+    ))
+    bind.execute(text(
+        "INSERT INTO facet_count (genre_id, year, rating_bucket, books) "
+        f"SELECT bg.genre_id, b.year, {bucket}, COUNT(*) "
+        "FROM book b JOIN book_genres bg ON bg.book_id = b.id "
+        "LEFT JOIN book_stats s ON s.book_id = b.id "
+        f"GROUP BY bg.genre_id, b.year, {bucket}"
+    ))
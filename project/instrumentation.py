@@ -0,0 +1,233 @@
+# instrumentation.py
+"""Инструментирование запросов (включается INSTRUMENTATION=1).
+
+На каждый запрос собирается: число SQL-запросов и их суммарное время,
+самые медленные выражения, время рендера шаблонов и Markdown. Итог уходит
+в заголовок Server-Timing (виден во вкладке Network браузера), медленные
+запросы пишутся в лог вместе с худшими SQL.
+
+Метрики процесса (частота запросов, гистограммы задержек, SQL, доля
+попаданий в кэши) отдаются в текстовом формате Prometheus по /_metrics.
+Под gunicorn у каждого воркера свои счётчики — у серии есть метка pid.
+
+PROFILE_SAMPLE_RATE — доля запросов, которые профилируются cProfile
+(дамп .prof в PROFILE_DIR); администратор может запросить профиль
+конкретной страницы параметром ?_profile=1.
+"""
+import cProfile
+import heapq
+import os
+import random
+import time
+from collections import defaultdict
+from threading import Lock
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+
+import markup
+
+# границы гистограммы задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Metrics:
+    """Минимальный реестр счётчиков и гистограмм (без prometheus_client)."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = defaultdict(int)              # (endpoint, method, status) → n
+        self.latency = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.latency_sum = defaultdict(float)         # endpoint → секунды
+        self.sql_count = defaultdict(int)             # endpoint → запросов
+        self.sql_seconds = defaultdict(float)
+
+    def observe(self, endpoint, method, status, seconds, sql_count, sql_seconds):
+        bucket = next((i for i, b in enumerate(LATENCY_BUCKETS) if seconds <= b),
+                      len(LATENCY_BUCKETS))
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.latency[endpoint][bucket] += 1
+            self.latency_sum[endpoint] += seconds
+            self.sql_count[endpoint] += sql_count
+            self.sql_seconds[endpoint] += sql_seconds
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.metrics = Metrics()
+        self.caches = {}                 # имя → fn() → (hits, misses)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("INSTRUMENTATION", False)
+        self.slow_request = app.config.get("SLOW_REQUEST_MS", 500) / 1000
+        self.slow_statements = app.config.get("SLOW_SQL_STATEMENTS", 3)
+        self.sample_rate = app.config.get("PROFILE_SAMPLE_RATE", 0.0)
+        self.profile_dir = app.config.get("PROFILE_DIR")
+        self.logger = app.logger
+        app.extensions["instrumentation"] = self
+        if not self.enabled:
+            return
+
+        app.before_request(self._before)
+        app.after_request(self._after)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        markup.render_observer = self._markdown_rendered
+        with app.app_context():
+            from extensions import db
+            event.listen(db.engine, "before_cursor_execute", self._sql_started)
+            event.listen(db.engine, "after_cursor_execute", self._sql_finished)
+            event.listen(db.engine, "handle_error", self._sql_failed)
+
+    def track_cache(self, name, stats):
+        """Регистрирует кэш для /_metrics: stats() → (попадания, промахи)."""
+        self.caches[name] = stats
+
+    # ─── жизненный цикл запроса
+    @staticmethod
+    def _state():
+        return g.get("_instr") if has_request_context() else None
+
+    def _before(self):
+        g._instr = state = {
+            "started": time.perf_counter(),
+            "sql_count": 0, "sql_seconds": 0.0, "slowest": [],
+            "template_seconds": 0.0, "markdown_seconds": 0.0,
+            "profiler": None,
+        }
+        if self._want_profile():
+            state["profiler"] = cProfile.Profile()
+            state["profiler"].enable()
+
+    def _want_profile(self):
+        if not self.profile_dir:
+            return False
+        if request.args.get("_profile"):
+            from flask_login import current_user
+            return current_user.is_authenticated and current_user.role_name == "administrator"
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _after(self, response):
+        state = self._state()
+        if state is None:
+            return response
+        total = time.perf_counter() - state["started"]
+        if state["profiler"] is not None:
+            state["profiler"].disable()
+            self._dump_profile(state["profiler"], total)
+
+        response.headers.add("Server-Timing", ", ".join([
+            f'sql;dur={state["sql_seconds"] * 1000:.1f};desc="SQL x{state["sql_count"]}"',
+            f'tpl;dur={state["template_seconds"] * 1000:.1f};desc="Templates"',
+            f'md;dur={state["markdown_seconds"] * 1000:.1f};desc="Markdown"',
+            f'app;dur={total * 1000:.1f}',
+        ]))
+        endpoint = request.endpoint or "unknown"
+        self.metrics.observe(endpoint, request.method, response.status_code, total,
+                             state["sql_count"], state["sql_seconds"])
+        if total >= self.slow_request:
+            worst = "; ".join(f"{sec * 1000:.1f} мс: {sql[:200]}"
+                              for sec, sql in sorted(state["slowest"], reverse=True))
+            self.logger.warning("медленный запрос %s %s: %.0f мс, SQL x%d (%.0f мс). %s",
+                                request.method, request.full_path.rstrip("?"), total * 1000,
+                                state["sql_count"], state["sql_seconds"] * 1000, worst)
+        return response
+
+    def _dump_profile(self, profiler, total):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unknown'}-" \
+               f"{total * 1000:.0f}ms-{os.getpid()}.prof"
+        profiler.dump_stats(os.path.join(self.profile_dir, name))
+
+    # ─── источники времени
+    def _sql_started(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_instr_started", []).append((context, time.perf_counter()))
+
+    def _sql_finished(self, conn, cursor, statement, parameters, context, executemany):
+        _, started = conn.info["_instr_started"].pop()
+        state = self._state()
+        if state is None:
+            return
+        seconds = time.perf_counter() - started
+        state["sql_count"] += 1
+        state["sql_seconds"] += seconds
+        slowest = state["slowest"]
+        if len(slowest) < self.slow_statements:
+            heapq.heappush(slowest, (seconds, statement))
+        elif seconds > slowest[0][0]:
+            heapq.heapreplace(slowest, (seconds, statement))
+
+    def _sql_failed(self, context):
+        # упавший запрос не дойдёт до after_cursor_execute — убираем его отметку,
+        # иначе следующий запрос на этом соединении возьмёт чужое время начала
+        conn, failed = context.connection, context.execution_context
+        stack = conn.info.get("_instr_started") if conn is not None else None
+        if failed is not None and stack and stack[-1][0] is failed:
+            stack.pop()
+
+    def _template_started(self, sender, template, context, **extra):
+        state = self._state()
+        if state is not None:
+            state.setdefault("template_stack", []).append(time.perf_counter())
+
+    def _template_finished(self, sender, template, context, **extra):
+        state = self._state()
+        if state is not None and state.get("template_stack"):
+            state["template_seconds"] += time.perf_counter() - state["template_stack"].pop()
+
+    def _markdown_rendered(self, seconds):
+        state = self._state()
+        if state is not None:
+            state["markdown_seconds"] += seconds
+
+    # ─── экспорт
+    def render_metrics(self):
+        """Метрики процесса в текстовом формате Prometheus (0.0.4)."""
+        m, pid = self.metrics, os.getpid()
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        with m._lock:
+            family("app_requests_total", "counter", "HTTP-запросы по endpoint, методу и статусу")
+            for (endpoint, method, status), n in sorted(m.requests.items()):
+                out.append(f'app_requests_total{{pid="{pid}",endpoint="{endpoint}",'
+                           f'method="{method}",status="{status}"}} {n}')
+
+            family("app_request_duration_seconds", "histogram", "Время обработки запроса")
+            for endpoint, counts in sorted(m.latency.items()):
+                labels = f'pid="{pid}",endpoint="{endpoint}"'
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                    cumulative += n
+                    out.append(f'app_request_duration_seconds_bucket{{{labels},le="{bound}"}} '
+                               f'{cumulative}')
+                out.append(f"app_request_duration_seconds_sum{{{labels}}} "
+                           f"{m.latency_sum[endpoint]:.6f}")
+                out.append(f"app_request_duration_seconds_count{{{labels}}} {cumulative}")
+
+            family("app_sql_queries_total", "counter", "SQL-запросы, выполненные при обработке")
+            for endpoint, n in sorted(m.sql_count.items()):
+                out.append(f'app_sql_queries_total{{pid="{pid}",endpoint="{endpoint}"}} {n}')
+            family("app_sql_seconds_total", "counter", "Суммарное время SQL")
+            for endpoint, sec in sorted(m.sql_seconds.items()):
+                out.append(f'app_sql_seconds_total{{pid="{pid}",endpoint="{endpoint}"}} '
+                           f'{sec:.6f}')
+
+        family("app_cache_requests_total", "counter", "Обращения к кэшам: попадания и промахи")
+        ratios = []
+        for name, stats in sorted(self.caches.items()):
+            hits, misses = stats()
+            out.append(f'app_cache_requests_total{{pid="{pid}",cache="{name}",result="hit"}} {hits}')
+            out.append(f'app_cache_requests_total{{pid="{pid}",cache="{name}",result="miss"}} {misses}')
+            ratios.append((name, hits / (hits + misses) if hits + misses else 0.0))
+        family("app_cache_hit_ratio", "gauge", "Доля попаданий в кэш с запуска процесса")
+        for name, ratio in ratios:
+            out.append(f'app_cache_hit_ratio{{pid="{pid}",cache="{name}"}} {ratio:.4f}')
+        return "\n".join(out) + "\n"
@@ -0,0 +1,287 @@
+# jobs.py
+"""Очередь фоновых задач в таблице job и её исполнитель.
+
+Обработчик запроса ставит задачу (job_queue.enqueue) в той же транзакции,
+что и сами данные: задача появится, только если коммит прошёл, и не
+потеряется, если процесс упадёт сразу после ответа. Отложенные побочные
+эффекты — миниатюры, поисковый индекс, удаление файлов обложек — выполняются
+уже вне запроса (сами задачи — в tasks.py):
+
+- JOBS_WORKER=thread — поток в процессе приложения; запускается при первой
+  поставленной задаче и будится сразу после коммита;
+- JOBS_WORKER=off — задачи выполняет только отдельный процесс
+  flask jobs-worker (их может быть несколько).
+
+Исполнитель берёт пачку готовых задач в аренду одним условным UPDATE (как
+очередь модерации; на PostgreSQL подзапрос — FOR UPDATE SKIP LOCKED) и
+выполняет каждую в своей транзакции: изменения обработчика и отметка
+«выполнено» коммитятся вместе. Ошибка — повтор через
+JOBS_RETRY_BASE_SECONDS × 2^(попытка-1); после max_attempts задача остаётся
+в статусе failed (flask jobs-retry вернёт её в очередь). Аренду упавшего
+процесса подберёт другой исполнитель, поэтому обработчики должны быть
+идемпотентны.
+
+Кэш страниц с бэкендом memory живёт в памяти веб-процесса: отдельный
+flask jobs-worker не сбросит его после переиндексации (выдача поиска доживёт
+до PAGE_CACHE_TTL); видимые изменения данных сбрасывает сам запрос.
+"""
+import json
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from sqlalchemy import event
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+PURGE_EVERY = 3600               # секунд между чистками выполненных задач
+MAX_ERROR_LENGTH = 2000
+
+
+class JobQueue:
+    def __init__(self, app=None):
+        self.handlers = {}               # kind → (fn(**payload), max_attempts)
+        self.app = None
+        self.mode = "thread"
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+        self._lock = Lock()
+        self._listening = False
+        self._purged = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config.get("JOBS_WORKER", "thread")
+        self.batch_size = app.config.get("JOBS_BATCH_SIZE", 20)
+        self.lease = app.config.get("JOBS_LEASE_SECONDS", 300)
+        self.poll = app.config.get("JOBS_POLL_SECONDS", 2)
+        self.retry_base = app.config.get("JOBS_RETRY_BASE_SECONDS", 10)
+        self.keep_done = app.config.get("JOBS_KEEP_DONE_HOURS", 24)
+        self.logger = app.logger
+        app.extensions["jobs"] = self
+        if not self._listening:
+            from extensions import db
+            event.listen(db.session, "after_commit", self._after_commit)
+            self._listening = True
+
+    def handler(self, kind, max_attempts=5):
+        """Регистрирует обработчик задачи kind: fn(**payload)."""
+        def register(fn):
+            self.handlers[kind] = (fn, max_attempts)
+            return fn
+        return register
+
+    # ─── постановка
+    def enqueue(self, kind, payload=None, delay=0):
+        """Добавляет задачу в текущую транзакцию; выполнится после коммита."""
+        from extensions import db
+        from models import Job
+
+        if kind not in self.handlers:
+            raise KeyError(f"неизвестная задача: {kind}")
+        now = datetime.utcnow()
+        db.session.add(Job(kind=kind, payload=json.dumps(payload or {}),
+                           max_attempts=self.handlers[kind][1], status=QUEUED,
+                           run_at=now + timedelta(seconds=delay), created_at=now))
+        db.session.info["jobs_enqueued"] = True
+
+    def _after_commit(self, session):
+        if session.info.pop("jobs_enqueued", False) and self.mode == "thread":
+            self._start_thread()
+            self._wake.set()
+
+    # ─── выполнение
+    def claim(self, limit):
+        """Берёт в аренду до limit готовых задач.
+
+        Возвращает (токен, [(id, kind, payload, попытка, max_attempts)]).
+        """
+        from extensions import db
+        from models import Job
+
+        now = datetime.utcnow()
+        token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        expired = db.and_(Job.status == RUNNING, Job.locked_until <= now)
+        # процесс, упавший на задаче max_attempts раз, больше её не получит
+        db.session.execute(
+            db.update(Job).where(expired, Job.attempts >= Job.max_attempts)
+            .values(status=FAILED, finished_at=now, locked_by=None, locked_until=None,
+                    last_error="аренда истекла: исполнитель не завершил задачу")
+            .execution_options(synchronize_session=False)
+        )
+        ready = db.or_(db.and_(Job.status == QUEUED, Job.run_at <= now), expired)
+        free = db.select(Job.id).where(ready).order_by(Job.run_at, Job.id).limit(limit)
+        if db.session.get_bind().dialect.name == "postgresql":
+            free = free.with_for_update(skip_locked=True)
+        # условие повторяется снаружи: строка, которую успели взять, не перезаписывается
+        db.session.execute(
+            db.update(Job).where(Job.id.in_(free), ready)
+            .values(status=RUNNING, locked_by=token, attempts=Job.attempts + 1,
+                    locked_until=now + timedelta(seconds=self.lease))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        jobs = db.session.execute(
+            db.select(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+            .where(Job.locked_by == token, Job.status == RUNNING)
+            .order_by(Job.run_at, Job.id)).all()
+        return token, jobs
+
+    def run_job(self, job, token):
+        """Выполняет одну задачу из claim(). Возвращает True при успехе."""
+        from extensions import db
+        from models import Job
+
+        job_id, kind, payload, attempts, max_attempts = job
+        mine = db.and_(Job.id == job_id, Job.locked_by == token)
+        entry = self.handlers.get(kind)
+        try:
+            if entry is None:
+                raise LookupError(f"нет обработчика задачи {kind}")
+            entry[0](**json.loads(payload))
+            db.session.execute(
+                db.update(Job).where(mine)
+                .values(status=DONE, finished_at=datetime.utcnow(), locked_by=None,
+                        locked_until=None, last_error=None)
+                .execution_options(synchronize_session=False))
+            db.session.commit()
+            return True
+        except Exception as exc:
+            db.session.rollback()
+            error = f"{type(exc).__name__}: {exc}"[:MAX_ERROR_LENGTH]
+            final = entry is None or attempts >= max_attempts
+            values = {"status": FAILED, "finished_at": datetime.utcnow()} if final else {
+                "status": QUEUED,
+                "run_at": datetime.utcnow() + timedelta(
+                    seconds=self.retry_base * 2 ** (attempts - 1)),
+            }
+            db.session.execute(
+                db.update(Job).where(mine)
+                .values(locked_by=None, locked_until=None, last_error=error, **values)
+                .execution_options(synchronize_session=False))
+            db.session.commit()
+            self.logger.warning("задача %s #%d (попытка %d из %d) %s: %s", kind, job_id,
+                                attempts, max_attempts,
+                                "провалена" if final else "будет повторена", error)
+            return False
+
+    def run_pending(self, limit=None):
+        """Выполняет готовые задачи, пока они есть (или limit штук). Возвращает (ok, ошибок)."""
+        ok = failed = 0
+        while limit is None or ok + failed < limit:
+            size = self.batch_size if limit is None else min(self.batch_size, limit - ok - failed)
+            token, jobs = self.claim(size)
+            if not jobs:
+                break
+            for job in jobs:
+                if self.run_job(job, token):
+                    ok += 1
+                else:
+                    failed += 1
+        return ok, failed
+
+    def work(self, stop=None):
+        """Цикл исполнителя: задачи → ожидание пробуждения или JOBS_POLL_SECONDS."""
+        from extensions import db
+
+        stop = stop or self._stop
+        while not stop.is_set():
+            self._wake.clear()
+            try:
+                done = sum(self.run_pending())
+                self._purge_old()
+            except Exception:
+                self.logger.exception("исполнитель задач: сбой цикла")
+                db.session.rollback()
+                done = 0
+            if not done:
+                self._wake.wait(self.poll)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _start_thread(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = Thread(target=self._thread_main, name="jobs", daemon=True)
+            self._thread.start()
+
+    def _thread_main(self):
+        with self.app.app_context():
+            self.work()
+
+    # ─── обслуживание
+    def _purge_old(self):
+        now = datetime.utcnow()
+        if self._purged is not None and (now - self._purged).total_seconds() < PURGE_EVERY:
+            return
+        self._purged = now
+        self.purge(timedelta(hours=self.keep_done))
+
+    def purge(self, older_than):
+        """Удаляет выполненные задачи старше older_than. Возвращает их число."""
+        from extensions import db
+        from models import Job
+
+        deleted = db.session.execute(
+            db.delete(Job).where(Job.status == DONE,
+                                 Job.finished_at < datetime.utcnow() - older_than)
+        ).rowcount
+        db.session.commit()
+        return deleted
+
+    def retry_failed(self, kind=None, job_ids=None):
+        """Возвращает проваленные задачи в очередь с новым счётчиком попыток."""
+        from extensions import db
+        from models import Job
+
+        query = db.update(Job).where(Job.status == FAILED)
+        if kind:
+            query = query.where(Job.kind == kind)
+        if job_ids:
+            query = query.where(Job.id.in_(job_ids))
+        count = db.session.execute(
+            query.values(status=QUEUED, attempts=0, run_at=datetime.utcnow(),
+                         finished_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        return count
+
+    def stats(self):
+        """{kind: {статус: n, "retries": повторов, "ready": готовых, "oldest": давность}}."""
+        from extensions import db
+        from models import Job
+
+        now = datetime.utcnow()
+        result = {}
+        rows = db.session.execute(
+            db.select(Job.kind, Job.status, db.func.count(),
+                      db.func.sum(db.case((Job.attempts > 1, Job.attempts - 1), else_=0)),
+                      db.func.sum(db.case((Job.run_at <= now, 1), else_=0)),
+                      db.func.min(Job.created_at))
+            .group_by(Job.kind, Job.status))
+        for kind, status, n, retries, ready, oldest in rows:
+            entry = result.setdefault(kind, {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0,
+                                             "retries": 0, "ready": 0, "oldest": None})
+            entry[status] = n
+            entry["retries"] += retries or 0
+            if status == QUEUED:
+                entry["ready"] = ready or 0
+                entry["oldest"] = now - oldest if oldest else None
+        return result
+
+    def recent_failures(self, limit=10):
+        from extensions import db
+        from models import Job
+
+        return db.session.scalars(
+            db.select(Job).where(Job.status == FAILED)
+            .order_by(Job.finished_at.desc(), Job.id.desc()).limit(limit)).all()
@@ -0,0 +1,50 @@
+# markup.py
+"""Markdown → безопасный HTML (общий для описаний книг и рецензий)."""
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import bleach
+from markdown import markdown
+
+ALLOWED_TAGS = ['p', 'ul', 'ol', 'li', 'strong', 'em', 'code', 'pre',
+                'blockquote', 'h1', 'h2', 'h3', 'br']
+
+_CACHE_SIZE = 2048
+_cache = OrderedDict()          # sha1(source) → html
+_lock = Lock()
+
+cache_stats = {'hits': 0, 'misses': 0}
+render_observer = None          # fn(секунды) после каждого рендера (см. instrumentation.py)
+
+
+def render_markdown(source):
+    """Рендерит Markdown и вычищает всё, кроме разрешённых тегов."""
+    started = time.perf_counter()
+    html = bleach.clean(markdown(source or '', output_format='html'),
+                        tags=ALLOWED_TAGS, strip=True)
+    if render_observer is not None:
+        render_observer(time.perf_counter() - started)
+    return html
+
+
+def cached_markdown(source):
+    """То же, что render_markdown, но с LRU-кэшем по хэшу содержимого.
+
+    Нужен строкам, у которых ещё нет сохранённого HTML (до backfill-html).
+    """
+    key = hashlib.sha1((source or '').encode('utf-8')).hexdigest()
+    with _lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+            cache_stats['hits'] += 1
+            return html
+        cache_stats['misses'] += 1
+    html = render_markdown(source)
+    with _lock:
+        _cache[key] = html
+        if len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return html
@@ -0,0 +1,306 @@
+# migrations.py
+"""Версионные миграции схемы (вместо db.create_all() при каждом старте).
+
+Новая БД создаётся целиком по моделям, затем на ней прогоняются все шаги
+(они создают то, чего нет в моделях, — например, FTS-таблицу). Для
+существующей БД (например, старого instance/library.db) по порядку
+выполняются ещё не применённые шаги. Шаги идемпотентны: проверяют, нет ли
+уже таблицы/колонки/индекса, поэтому их можно безопасно перезапустить.
+"""
+from datetime import datetime
+
+from sqlalchemy import bindparam, inspect, text
+
+from extensions import db
+import facets
+import search
+import seeding
+
+MIGRATIONS = []                 # [(version, description, fn(conn))]
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+# ──────────────── ВСПОМОГАТЕЛЬНЫЕ ОПЕРАЦИИ ──────────────────────
+def create_table_if_missing(conn, name):
+    db.metadata.tables[name].create(conn, checkfirst=True)
+
+
+def add_column_if_missing(conn, table_name, column_name):
+    if column_name in {c["name"] for c in inspect(conn).get_columns(table_name)}:
+        return
+    col = db.metadata.tables[table_name].c[column_name]
+    col_type = col.type.compile(conn.dialect)
+    conn.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN "{column_name}" {col_type}'))
+
+
+def create_index_if_missing(conn, table_name, index_name):
+    table = db.metadata.tables[table_name]
+    index = next(i for i in table.indexes if i.name == index_name)
+    index.create(conn, checkfirst=True)
+
+
+def _rebuild_sqlite_table(conn, table_name):
+    """Пересоздаёт таблицу по модели с переносом строк: ограничения в SQLite
+    ALTER-ом не добавить и не снять."""
+    old_name = f"_{table_name}_old"
+    columns = ", ".join(f'"{c["name"]}"' for c in inspect(conn).get_columns(table_name))
+    for index in inspect(conn).get_indexes(table_name):     # имена индексов в SQLite глобальны
+        conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+    conn.execute(text(f'ALTER TABLE "{table_name}" RENAME TO "{old_name}"'))
+    db.metadata.tables[table_name].create(conn)
+    conn.execute(text(f'INSERT INTO "{table_name}" ({columns}) SELECT {columns} FROM "{old_name}"'))
+    conn.execute(text(f'DROP TABLE "{old_name}"'))
+
+
+def drop_unique_if_present(conn, table_name, column_names):
+    found = [u for u in inspect(conn).get_unique_constraints(table_name)
+             if u["column_names"] == list(column_names)]
+    if not found:
+        return
+    if conn.dialect.name == "sqlite":
+        _rebuild_sqlite_table(conn, table_name)
+        return
+    for u in found:
+        conn.execute(text(f'ALTER TABLE "{table_name}" DROP CONSTRAINT "{u["name"]}"'))
+
+
+def add_unique_if_missing(conn, table_name, constraint_name):
+    table = db.metadata.tables[table_name]
+    constraint = next(c for c in table.constraints if c.name == constraint_name)
+    column_names = [c.name for c in constraint.columns]
+    if any(u["column_names"] == column_names
+           for u in inspect(conn).get_unique_constraints(table_name)):
+        return
+    if conn.dialect.name == "sqlite":
+        _rebuild_sqlite_table(conn, table_name)
+        return
+    columns = ", ".join(f'"{name}"' for name in column_names)
+    conn.execute(text(f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{constraint_name}" '
+                      f'UNIQUE ({columns})'))
+
+
+# агрегаты книг по одобренным рецензиям (схема версии 1, без моделей)
+_STATS_SELECT = (
+    "SELECT b.id, COUNT(r.id), COALESCE(SUM(r.rating), 0), "
+    "       CASE WHEN COUNT(r.id) > 0 THEN ROUND(SUM(r.rating) * 1.0 / COUNT(r.id), 2) END "
+    "FROM book b LEFT JOIN review r ON r.book_id = b.id AND r.status_id = "
+    "     (SELECT id FROM review_status WHERE name = 'approved') "
+)
+
+
+class MigrationError(RuntimeError):
+    """Шаг нельзя выполнить автоматически: данные требуют решения оператора."""
+
+
+# ──────────────── ДУБЛИКАТЫ РЕЦЕНЗИЙ (до миграции 2) ────────────
+def duplicate_reviews(conn, limit=20):
+    """([(book_id, user_id, рецензий)] — первые limit пар с дубликатами, всего пар)."""
+    pairs = ("SELECT book_id, user_id, COUNT(*) AS n FROM review "
+             "GROUP BY book_id, user_id HAVING COUNT(*) > 1")
+    total = conn.execute(text(f"SELECT COUNT(*) FROM ({pairs}) d")).scalar()
+    rows = conn.execute(text(f"{pairs} ORDER BY book_id, user_id LIMIT :limit"),
+                        {"limit": limit}).all()
+    return rows, total
+
+
+def remove_duplicate_reviews(conn):
+    """Оставляет самую раннюю рецензию пользователя на книгу и пересчитывает
+    агрегаты затронутых книг. Возвращает число удалённых рецензий."""
+    books = [b for (b,) in conn.execute(text(
+        "SELECT DISTINCT book_id FROM review GROUP BY book_id, user_id HAVING COUNT(*) > 1"))]
+    if not books:
+        return 0
+    removed = conn.execute(text(
+        "DELETE FROM review WHERE id NOT IN "
+        "(SELECT MIN(id) FROM review GROUP BY book_id, user_id)"
+    )).rowcount
+    ids = bindparam("ids", expanding=True)
+    conn.execute(text("DELETE FROM book_stats WHERE book_id IN :ids").bindparams(ids),
+                 {"ids": books})
+    conn.execute(text(
+        "INSERT INTO book_stats (book_id, review_count, rating_sum, avg_rating) "
+        + _STATS_SELECT + "WHERE b.id IN :ids GROUP BY b.id").bindparams(ids), {"ids": books})
+    if inspect(conn).has_table("facet_count"):
+        facets.rebuild(conn)
+    return removed
+
+
+# ──────────────── ШАГИ ──────────────────────────────────────────
+@migration(1, "book_stats и сохранённый HTML описаний/рецензий")
+def _stats_and_rendered_html(conn):
+    create_table_if_missing(conn, "book_stats")
+    if not conn.execute(text("SELECT 1 FROM book_stats LIMIT 1")).first():
+        conn.execute(text(
+            "INSERT INTO book_stats (book_id, review_count, rating_sum, avg_rating) "
+            + _STATS_SELECT + "GROUP BY b.id"
+        ))
+    add_column_if_missing(conn, "book", "description_rendered")
+    add_column_if_missing(conn, "review", "text_rendered")
+
+
+@migration(2, "индексы для фильтров/сортировок и уникальность (book_id, user_id)")
+def _hot_path_indexes(conn):
+    # уникальный индекс не создать, пока есть дубликаты; удалять рецензии
+    # при автоматическом старте нельзя — это решает оператор
+    rows, total = duplicate_reviews(conn)
+    if total:
+        listing = "\n".join(f"  книга {b}, пользователь {u}: {n} рецензий" for b, u, n in rows)
+        raise MigrationError(
+            f"миграция 2: у {total} пар (книга, пользователь) несколько рецензий:\n{listing}\n"
+            f"Оставить самую раннюю и пересчитать агрегаты: "
+            f"AUTO_MIGRATE=0 flask dedupe-reviews, затем flask db-upgrade")
+    for table_name, index_name in (
+        ("review", "uq_review_book_user"),
+        ("review", "ix_review_book_status_created"),
+        ("review", "ix_review_user_created"),
+        ("review", "ix_review_status_created"),
+        ("book", "ix_book_year_id"),
+        ("book_genres", "ix_book_genres_book_genre"),
+        ("book_genres", "ix_book_genres_genre_book"),
+        ("cover", "ix_cover_book_id"),
+    ):
+        create_index_if_missing(conn, table_name, index_name)
+
+
+@migration(3, "полнотекстовый индекс книг (FTS5)")
+def _book_fts(conn):
+    if search.fts_available(conn):
+        search.create_index(conn)
+        search.rebuild_index(conn)
+
+
+@migration(4, "счётчики фасетов каталога")
+def _facet_counts(conn):
+    create_table_if_missing(conn, "facet_count")
+    facets.rebuild(conn)
+
+
+@migration(5, "справочники ролей и статусов рецензий")
+def _reference_rows(conn):
+    seeding.seed_reference(conn)
+
+
+@migration(6, "updated_at у книг, агрегатов и рецензий (ETag в API)")
+def _updated_at(conn):
+    now = datetime.utcnow()
+    for table_name in ("book", "book_stats", "review"):
+        add_column_if_missing(conn, table_name, "updated_at")
+    conn.execute(text("UPDATE book SET updated_at = :t WHERE updated_at IS NULL"), {"t": now})
+    conn.execute(text("UPDATE book_stats SET updated_at = :t WHERE updated_at IS NULL"), {"t": now})
+    conn.execute(text("UPDATE review SET updated_at = COALESCE(created_at, :t) "
+                      "WHERE updated_at IS NULL"), {"t": now})
+
+
+@migration(7, "индекс естественного ключа книги для import-books")
+def _book_natural_key(conn):
+    create_index_if_missing(conn, "book", "ix_book_natural_key")
+
+
+@migration(8, "индекс рецензий книги по оценке (сортировка «высокая оценка»)")
+def _review_rating_index(conn):
+    create_index_if_missing(conn, "review", "ix_review_book_status_rating")
+
+
+@migration(9, "аренда рецензий в очереди модерации")
+def _review_claims(conn):
+    add_column_if_missing(conn, "review", "claimed_by")
+    add_column_if_missing(conn, "review", "claim_expires")
+
+
+@migration(10, "таблица похожих книг (top-K)")
+def _book_similar(conn):
+    create_table_if_missing(conn, "book_similar")
+
+
+@migration(11, "очередь фоновых задач")
+def _jobs(conn):
+    create_table_if_missing(conn, "job")
+
+
+@migration(12, "обложки: своя строка у каждой книги, общий файл по md5")
+def _shared_cover_files(conn):
+    drop_unique_if_present(conn, "cover", ["md5_hash"])
+    create_index_if_missing(conn, "cover", "ix_cover_md5_hash")
+
+
+@migration(13, "уникальность связи книга–жанр")
+def _unique_book_genres(conn):
+    # дубли связи — одинаковые пары без своих данных: оставляем по одной
+    duplicates = conn.execute(text(
+        "SELECT book_id, genre_id FROM book_genres "
+        "GROUP BY book_id, genre_id HAVING COUNT(*) > 1")).all()
+    for book_id, genre_id in duplicates:
+        pair = {"b": book_id, "g": genre_id}
+        conn.execute(text("DELETE FROM book_genres WHERE book_id = :b AND genre_id = :g"), pair)
+        conn.execute(text("INSERT INTO book_genres (book_id, genre_id) VALUES (:b, :g)"), pair)
+    add_unique_if_missing(conn, "book_genres", "uq_book_genres_book_genre")
+    if duplicates:                          # счётчики фасетов и документы поиска их учли дважды
+        facets.rebuild(conn)
+        if search.fts_available(conn):
+            search.rebuild_index(conn)
+
+
+# ──────────────── ЗАПУСК ────────────────────────────────────────
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " version INTEGER PRIMARY KEY,"
+        " description TEXT NOT NULL,"
+        " applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+def current_version(conn):
+    _ensure_version_table(conn)
+    return conn.execute(text("SELECT MAX(version) FROM schema_migrations")).scalar() or 0
+
+
+def _stamp(conn, version, description):
+    conn.execute(
+        text("INSERT INTO schema_migrations (version, description, applied_at) "
+             "VALUES (:v, :d, :t)"),
+        {"v": version, "d": description, "t": datetime.utcnow()},
+    )
+
+
+def upgrade(engine=None):
+    """Доводит схему до последней версии. Возвращает список применённых версий."""
+    engine = engine or db.engine
+    applied = []
+    with engine.begin() as conn:
+        fresh = not inspect(conn).has_table("book")
+        version = current_version(conn)
+        if fresh:
+            db.metadata.create_all(conn)
+        for v, description, fn in MIGRATIONS:
+            if v <= version:
+                continue
+            fn(conn)
+            _stamp(conn, v, description)
+            applied.append(v)
+    return applied
+
+
+def pending(engine=None):
+    """Версии, которые ещё не применены."""
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        version = current_version(conn)
+    return [(v, d) for v, d, _ in MIGRATIONS if v > version]
+
+
+@migration(14, "отметка расчёта похожих книг")
+def _book_similar_state(conn):
+    create_table_if_missing(conn, "book_similar_state")
+    # книги с уже посчитанными списками; остальные пересчитает ближайший запуск
+    conn.execute(text(
+        "INSERT INTO book_similar_state (book_id, computed_at) "
+        "SELECT book_id, MAX(computed_at) FROM book_similar "
+        "WHERE book_id NOT IN (SELECT book_id FROM book_similar_state) GROUP BY book_id"))
@@ -1,15 +1,23 @@
+import time
+from collections import OrderedDict, namedtuple
 from datetime import datetime
-from flask_login import UserMixin
+from threading import Lock
+from flask import current_app
+from flask_login import UserMixin, user_logged_in, user_logged_out
 from werkzeug.security import generate_password_hash, check_password_hash
-from markdown import markdown
-import bleach, os, hashlib
+from sqlalchemy.orm import joinedload, selectinload
 
 from extensions import db, login_manager
+from markup import render_markdown, cached_markdown
 
 book_genres = db.Table(
     'book_genres',
     db.Column('book_id', db.Integer, db.ForeignKey('book.id',ondelete='CASCADE')),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id',ondelete='CASCADE'))
+    db.Column('genre_id', db.Integer, db.ForeignKey('genre.id',ondelete='CASCADE')),
+    # дубль связи навсегда удвоил бы вклад книги в счётчики фасетов
+    db.UniqueConstraint('book_id', 'genre_id', name='uq_book_genres_book_genre'),
+    db.Index('ix_book_genres_book_genre', 'book_id', 'genre_id'),
+    db.Index('ix_book_genres_genre_book', 'genre_id', 'book_id'),
 )
 
 class Role(db.Model):
@@ -26,11 +34,16 @@ class User(UserMixin, db.Model):
     middle_name = db.Column(db.String(64))
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'), nullable=False)
     role = db.relationship('Role')
-    reviews = db.relationship('Review', back_populates='user', cascade='all, delete', passive_deletes=True)
+    reviews = db.relationship('Review', back_populates='user', foreign_keys='Review.user_id',
+                              cascade='all, delete', passive_deletes=True)
+
+    @property
+    def role_name(self):
+        return lookups.role(self.role_id).name
 
     @property
     def full_name(self):
-        return f"{self.last_name} {self.first_name} {self.middle_name or ''}".strip()
+        return _full_name(self.last_name, self.first_name, self.middle_name)
 
     @property
     def password(self):
@@ -43,44 +56,112 @@ class User(UserMixin, db.Model):
     def verify_password(self, pwd):
         return check_password_hash(self.password_hash, pwd)
 
+def _full_name(last_name, first_name, middle_name):
+    return f"{last_name} {first_name} {middle_name or ''}".strip()
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identities.get(int(user_id))
 
 class Genre(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True, nullable=False)
 
 class Cover(db.Model):
+    # строка своя у каждой книги; книги с одинаковым изображением ссылаются
+    # на один файл (путь по md5), поэтому md5_hash не уникален
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(128), nullable=False)
     mimetype = db.Column(db.String(64), nullable=False)
-    md5_hash = db.Column(db.String(64), nullable=False, unique=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), nullable=False)
+    md5_hash = db.Column(db.String(64), nullable=False, index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), nullable=False, index=True)
 
 class Book(db.Model):
+    __table_args__ = (
+        db.Index('ix_book_year_id', 'year', 'id'),          # главная: ORDER BY year, id
+        db.Index('ix_book_natural_key', 'title', 'author', 'year'),   # upsert в import-books
+    )
+
     @property
     def description_html(self):
-        from markdown import markdown
-        import bleach
-        allowed=['p','ul','ol','li','strong','em','code','pre','blockquote','h1','h2','h3','br']
-        return bleach.clean(markdown(self.description, output_format='html'), tags=allowed, strip=True)
+        return self.description_rendered or cached_markdown(self.description)
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(256), nullable=False)
     description = db.Column(db.Text, nullable=False)
+    description_rendered = db.Column(db.Text)     # HTML, пересчитывается при смене description
     year = db.Column(db.Integer, nullable=False)
     publisher = db.Column(db.String(128), nullable=False)
     author = db.Column(db.String(128), nullable=False)
     pages = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     genres = db.relationship('Genre', secondary=book_genres, backref='books')
     cover = db.relationship('Cover', backref='book', uselist=False, cascade='all, delete')
     reviews = db.relationship('Review', back_populates='book', cascade='all, delete', passive_deletes=True)
 
+    stats = db.relationship('BookStats', uselist=False, lazy='joined',
+                            cascade='all, delete-orphan', passive_deletes=True)
+
     def avg_rating(self):
-        approved_reviews = [r.rating for r in self.reviews if r.status and r.status.name == 'approved']
-        return round(sum(approved_reviews)/len(approved_reviews),2) if approved_reviews else None
+        return self.stats.avg_rating if self.stats else None
+
+    @property
+    def review_count(self):
+        return self.stats.review_count if self.stats else 0
+
+class BookStats(db.Model):
+    """Материализованные агрегаты одобренных рецензий книги."""
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True)
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    avg_rating = db.Column(db.Float)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class FacetCount(db.Model):
+    """Счётчики фасетов: число книг в ячейке (жанр × год × корзина рейтинга).
+
+    genre_id = 0 — строка «все жанры» (книга учитывается один раз);
+    rating_bucket = floor(avg_rating), -1 — нет одобренных рецензий.
+    """
+    genre_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rating_bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    books = db.Column(db.Integer, nullable=False, default=0)
+
+class BookSimilar(db.Model):
+    """Top-K похожих книг для каждой книги (считает flask rebuild-similar, см. similar.py)."""
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'),
+                         primary_key=True, autoincrement=False)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    similar_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'),
+                           nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+class BookSimilarState(db.Model):
+    """Когда список похожих книги считался в последний раз — и пустой тоже."""
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'),
+                        primary_key=True, autoincrement=False)
+    computed_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class Job(db.Model):
+    """Фоновая задача (см. jobs.py): ставится в транзакции записи, выполняется после."""
+    __table_args__ = (
+        db.Index('ix_job_ready', 'status', 'run_at'),       # выборка готовых к запуску
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')     # JSON-аргументы обработчика
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued|running|done|failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)   # не раньше
+    locked_by = db.Column(db.String(96))               # аренда исполнителя
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
 
 class ReviewStatus(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -88,19 +169,378 @@ class ReviewStatus(db.Model):
     description = db.Column(db.Text, nullable=False)
 
 class Review(db.Model):
+    __table_args__ = (
+        db.Index('uq_review_book_user', 'book_id', 'user_id', unique=True),   # одна рецензия на книгу
+        db.Index('ix_review_book_status_created', 'book_id', 'status_id', 'created_at'),
+        db.Index('ix_review_book_status_rating', 'book_id', 'status_id', 'rating', 'created_at', 'id'),
+        db.Index('ix_review_user_created', 'user_id', 'created_at', 'id'),    # «Мои рецензии»
+        db.Index('ix_review_status_created', 'status_id', 'created_at', 'id'),  # очередь модерации
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id',ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id',ondelete='CASCADE'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     text_md = db.Column(db.Text, nullable=False)
+    text_rendered = db.Column(db.Text)            # HTML, пересчитывается при смене text_md
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     status_id = db.Column(db.Integer, db.ForeignKey('review_status.id'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # очередь модерации: кто взял рецензию в работу и до какого времени (аренда)
+    claimed_by = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    claim_expires = db.Column(db.DateTime)
 
     book = db.relationship('Book', back_populates='reviews')
-    user = db.relationship('User', back_populates='reviews')
+    user = db.relationship('User', back_populates='reviews', foreign_keys=[user_id])
     status = db.relationship('ReviewStatus')
 
     @property
     def text_html(self):
-        allowed = ['p','ul','ol','li','strong','em','code','pre','blockquote','h1','h2','h3','br']
-        return bleach.clean(markdown(self.text_md, output_format='html'), tags=allowed, strip=True)
+        return self.text_rendered or cached_markdown(self.text_md)
+
+    @property
+    def status_name(self):
+        return lookups.status(self.status_id).name
+
+    @property
+    def claim_active(self):
+        return self.claim_expires is not None and self.claim_expires > datetime.utcnow()
+
+    @property
+    def status_label(self):
+        return lookups.status(self.status_id).description
+
+
+# ──────────────── СОХРАНЁННЫЙ HTML ──────────────────────────────
+# Рендер выполняется только при присваивании нового исходника, а не при чтении.
+@db.event.listens_for(Book.description, 'set')
+def _render_description(target, value, oldvalue, initiator):
+    if value != oldvalue:
+        target.description_rendered = render_markdown(value)
+
+@db.event.listens_for(Review.text_md, 'set')
+def _render_review_text(target, value, oldvalue, initiator):
+    if value != oldvalue:
+        target.text_rendered = render_markdown(value)
+
+def backfill_rendered_html(force=False, batch_size=500):
+    """Заполняет сохранённый HTML у строк, где его нет (или у всех при force)."""
+    done = 0
+    for model, source, target in ((Book, 'description', 'description_rendered'),
+                                  (Review, 'text_md', 'text_rendered')):
+        src_col, dst_col = getattr(model, source), getattr(model, target)
+        last_id = 0
+        while True:
+            q = db.session.query(model.id, src_col).filter(model.id > last_id)
+            if not force:
+                q = q.filter(dst_col.is_(None))
+            rows = q.order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            db.session.execute(
+                db.update(model),
+                [{'id': pk, target: render_markdown(text)} for pk, text in rows],
+            )
+            db.session.commit()
+            last_id = rows[-1].id
+            done += len(rows)
+    return done
+
+# ──────────────── ВРЕМЯ ИЗМЕНЕНИЯ (ETag в API) ──────────────────
+# updated_at сдвигается при любом UPDATE строки (onupdate). Смена одних
+# жанров колонок book не меняет — строку всё равно «трогаем».
+@db.event.listens_for(Book, 'before_update')
+def _touch_book(mapper, connection, target):
+    target.updated_at = datetime.utcnow()
+
+# ──────────────── АГРЕГАТЫ РЕЙТИНГА ─────────────────────────────
+def _avg_expr(count, total):
+    return db.case((count > 0, db.func.round(total * 1.0 / count, 2)), else_=None)
+
+def adjust_book_stats(book_id, count_delta, rating_delta):
+    """Инкрементально сдвигает агрегаты книги в текущей транзакции."""
+    if not count_delta and not rating_delta:
+        return
+    t = BookStats.__table__
+    new_count = t.c.review_count + count_delta
+    new_sum = t.c.rating_sum + rating_delta
+    res = db.session.execute(
+        t.update().where(t.c.book_id == book_id)
+        .values(review_count=new_count, rating_sum=new_sum,
+                avg_rating=_avg_expr(new_count, new_sum))
+    )
+    if res.rowcount == 0:          # строки ещё нет (книга до миграции) — считаем с нуля
+        db.session.flush()
+        rebuild_book_stats([book_id])
+
+def adjust_many_book_stats(deltas):
+    """То же для многих книг: {book_id: (count_delta, rating_delta)} одним executemany."""
+    deltas = {b: d for b, d in deltas.items() if d[0] or d[1]}
+    if not deltas:
+        return
+    t = BookStats.__table__
+    have = set(db.session.scalars(
+        db.select(t.c.book_id).where(t.c.book_id.in_(list(deltas)))))
+    new_count = t.c.review_count + db.bindparam('dc', type_=db.Integer)
+    new_sum = t.c.rating_sum + db.bindparam('ds', type_=db.Integer)
+    if have:
+        db.session.execute(
+            t.update().where(t.c.book_id == db.bindparam('b'))
+            .values(review_count=new_count, rating_sum=new_sum,
+                    avg_rating=_avg_expr(new_count, new_sum)),
+            [{'b': b, 'dc': deltas[b][0], 'ds': deltas[b][1]} for b in have],
+        )
+    missing = set(deltas) - have
+    if missing:
+        db.session.flush()
+        rebuild_book_stats(sorted(missing))
+
+def rebuild_book_stats(book_ids=None):
+    """Пересчитывает агрегаты одним INSERT … SELECT (все книги или только book_ids)."""
+    t = BookStats.__table__
+    approved = (db.select(ReviewStatus.id)
+                .where(ReviewStatus.name == 'approved').scalar_subquery())
+    count = db.func.count(Review.id)
+    total = db.func.coalesce(db.func.sum(Review.rating), 0)
+    src = (
+        db.select(Book.id, count, total, _avg_expr(count, total), db.literal(datetime.utcnow()))
+        .select_from(Book)
+        .outerjoin(Review, db.and_(Review.book_id == Book.id, Review.status_id == approved))
+        .group_by(Book.id)
+    )
+    delete = t.delete()
+    if book_ids is not None:
+        src = src.where(Book.id.in_(book_ids))
+        delete = delete.where(t.c.book_id.in_(book_ids))
+    db.session.execute(delete)
+    db.session.execute(
+        t.insert().from_select(['book_id', 'review_count', 'rating_sum', 'avg_rating', 'updated_at'], src)
+    )
+
+
+# ──────────────── ЗАПРОСЫ ДЛЯ ПРЕДСТАВЛЕНИЙ ──────────────────────
+# Каждая страница получает связи заранее (joined/selectin), чтобы шаблон
+# не делал отдельный SELECT на каждую строку.
+def book_list_query():
+    """Карточки книг: обложка и агрегаты — JOIN, жанры — одним SELECT … IN."""
+    return Book.query.options(
+        joinedload(Book.cover), joinedload(Book.stats), selectinload(Book.genres)
+    )
+
+def book_detail_query():
+    """Страница книги — те же связи, что и у карточки."""
+    return book_list_query()
+
+def book_reviews_query():
+    """Рецензии на странице книги: имя автора подтягивается тем же JOIN-ом."""
+    return Review.query.options(
+        joinedload(Review.user).load_only(User.last_name, User.first_name, User.middle_name)
+    )
+
+def similar_books_query(book_id):
+    """Панель «похожие книги»: готовый top-K по первичному ключу, обложка и
+    агрегаты — тем же запросом (жанры карточке панели не нужны)."""
+    return (Book.query
+            .join(BookSimilar, BookSimilar.similar_id == Book.id)
+            .filter(BookSimilar.book_id == book_id)
+            .options(joinedload(Book.cover))
+            .order_by(BookSimilar.rank))
+
+# сортировки рецензий книги: ключ keyset-пагинации (все колонки — по убыванию)
+BOOK_REVIEW_SORTS = {
+    'new': [Review.created_at, Review.id],
+    'top': [Review.rating, Review.created_at, Review.id],
+}
+
+def moderation_reviews_query():
+    """Очередь модерации: книга и автор рецензии."""
+    return Review.query.options(joinedload(Review.book), joinedload(Review.user))
+
+def user_reviews_query():
+    """«Мои рецензии»: книга (статус берётся из справочника lookups)."""
+    return Review.query.options(joinedload(Review.book))
+
+def review_detail_query():
+    """Карточка рецензии для модератора."""
+    return Review.query.options(joinedload(Review.book), joinedload(Review.user))
+
+
+# ──────────────── СПРАВОЧНИКИ ───────────────────────────────────
+LookupRow = namedtuple('LookupRow', 'id name description')
+
+class LookupRegistry:
+    """Процессный кэш справочников: роли, статусы рецензий, жанры.
+
+    Загружается при первом обращении. В своём процессе изменения строк
+    справочника сбрасывают кэш сразу (invalidate(), см. слушатели ниже);
+    строки, добавленные или удалённые другим процессом (flask import-books),
+    воркер заметит не позже чем через LOOKUPS_CHECK_SECONDS: раз в этот
+    интервал одним запросом сверяются число и максимальный id строк
+    справочников. Переименование в другом процессе так не видно — после
+    него воркеры нужно перезапустить (0 — не сверять вовсе).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._data = None
+        self._version = None
+        self._checked = 0.0
+
+    def invalidate(self):
+        self._data = None
+
+    def _current_version(self):
+        counters = []
+        for model in (Role, ReviewStatus, Genre):
+            counters += [db.select(db.func.count(model.id)).scalar_subquery(),
+                         db.select(db.func.max(model.id)).scalar_subquery()]
+        return tuple(db.session.execute(db.select(*counters)).one())
+
+    def _read(self):
+        def rows(model, has_description=True):
+            cols = (model.id, model.name,
+                    model.description if has_description else db.literal(None))
+            return [LookupRow(*r) for r in db.session.query(*cols).order_by(model.name)]
+        tables = {
+            'role': rows(Role),
+            'status': rows(ReviewStatus),
+            'genre': rows(Genre, has_description=False),
+        }
+        return {
+            kind: {'list': items,
+                   'by_id': {r.id: r for r in items},
+                   'by_name': {r.name: r for r in items}}
+            for kind, items in tables.items()
+        }
+
+    def _fresh(self, data, interval):
+        return data is not None and (interval <= 0 or time.monotonic() < self._checked + interval)
+
+    def _load(self):
+        interval = current_app.config.get('LOOKUPS_CHECK_SECONDS', 0)
+        data = self._data
+        if self._fresh(data, interval):
+            return data
+        with self._lock:
+            if self._fresh(self._data, interval):
+                return self._data
+            version = self._current_version()
+            self._checked = time.monotonic()
+            if self._data is None or version != self._version:
+                self._data = self._read()
+                self._version = version
+            return self._data
+
+    def _get(self, kind, key):
+        table = self._load()[kind]
+        return table['by_name' if isinstance(key, str) else 'by_id'][key]
+
+    def role(self, key):
+        """Роль по id или имени."""
+        return self._get('role', key)
+
+    def status(self, key):
+        """Статус рецензии по id или имени."""
+        return self._get('status', key)
+
+    def status_id(self, name):
+        return self.status(name).id
+
+    def genre_choices(self):
+        """Пары (id, name) для SelectMultipleField, по алфавиту."""
+        return [(g.id, g.name) for g in self._load()['genre']['list']]
+
+
+lookups = LookupRegistry()
+
+def _invalidate_lookups(mapper, connection, target):
+    lookups.invalidate()
+
+for _model in (Role, ReviewStatus, Genre):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        db.event.listen(_model, _event, _invalidate_lookups)
+
+
+# ──────────────── КЭШ ТЕКУЩЕГО ПОЛЬЗОВАТЕЛЯ ─────────────────────
+class SessionIdentity(UserMixin):
+    """Снимок пользователя для current_user: поля, нужные шаблонам и проверкам
+    ролей, без ORM-объекта (не привязан к сессии БД, не делает ленивых запросов).
+    """
+
+    def __init__(self, id, username, last_name, first_name, middle_name, role_id):
+        self.id = id
+        self.username = username
+        self.full_name = _full_name(last_name, first_name, middle_name)
+        self.role_id = role_id
+
+    @property
+    def role_name(self):
+        return lookups.role(self.role_id).name
+
+
+class IdentityCache:
+    """Короткоживущий процессный кэш user_id → SessionIdentity.
+
+    В своём процессе запись сбрасывается сразу при входе/выходе и изменении
+    или удалении пользователя; IDENTITY_CACHE_TTL ограничивает время, на
+    которое другие воркеры могут видеть устаревшие данные (0 — кэш выключен).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()     # user_id → (expires, identity)
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, user_id):
+        row = (db.session.query(User.id, User.username, User.last_name,
+                                User.first_name, User.middle_name, User.role_id)
+               .filter(User.id == user_id).first())
+        return SessionIdentity(*row) if row else None
+
+    def get(self, user_id):
+        ttl = current_app.config.get('IDENTITY_CACHE_TTL', 0)
+        if ttl <= 0:
+            return self._load(user_id)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        identity = self._load(user_id)
+        if identity is None:
+            return None
+        size = current_app.config.get('IDENTITY_CACHE_SIZE', 1024)
+        with self._lock:
+            self._entries[user_id] = (now + ttl, identity)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+        return identity
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identities = IdentityCache()
+
+def _discard_identity(mapper, connection, target):
+    identities.discard(target.id)
+
+for _event in ('after_update', 'after_delete'):
+    db.event.listen(User, _event, _discard_identity)
+
+@user_logged_in.connect
+@user_logged_out.connect
+def _discard_session_identity(sender, user, **extra):
+    # выход анонима (GET /logout без входа) приходит с AnonymousUserMixin без id
+    if user is not None and user.is_authenticated:
+        identities.discard(user.id)
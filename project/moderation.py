@@ -0,0 +1,160 @@
+# moderation.py
+"""Пакетная модерация рецензий и очередь с арендой.
+
+Один переход статуса для набора рецензий (список id или «все в статусе X
+у книги Y») выполняется одним UPDATE; агрегаты рейтинга и счётчики фасетов
+сдвигаются в той же транзакции. Коммит — за вызывающим.
+
+Очередь: модератор берёт пачку ожидающих рецензий в аренду (claimed_by,
+claim_expires) одним условным UPDATE — две параллельные выборки не получат
+одну и ту же строку. На PostgreSQL подзапрос берёт строки с
+FOR UPDATE SKIP LOCKED и не ждёт чужих транзакций. Истёкшая аренда просто
+перестаёт учитываться: рецензия снова свободна.
+"""
+from datetime import datetime, timedelta
+
+from extensions import db
+from models import Review, adjust_many_book_stats, lookups
+import facets
+
+UPDATED = "updated"
+UNCHANGED = "unchanged"        # уже в целевом статусе
+SKIPPED = "skipped"            # не в статусе from_status
+CLAIMED = "claimed"            # в аренде у другого модератора
+NOT_FOUND = "not_found"
+
+
+class BulkResult:
+    def __init__(self, status):
+        self.status = status
+        self.items = {}            # review_id → результат
+        self.book_ids = set()      # книги, у которых изменился набор одобренных рецензий
+
+    @property
+    def updated(self):
+        return sum(1 for r in self.items.values() if r == UPDATED)
+
+    @property
+    def claimed(self):
+        return sum(1 for r in self.items.values() if r == CLAIMED)
+
+    def as_dict(self):
+        return {
+            "status": self.status,
+            "updated": self.updated,
+            "results": [{"id": rid, "result": r} for rid, r in self.items.items()],
+        }
+
+
+def bulk_change_status(status_name, review_ids=None, book_id=None, from_status=None,
+                       user_id=None):
+    """Переводит рецензии в статус status_name от имени модератора user_id.
+
+    review_ids — явный список; иначе берутся все рецензии книги book_id
+    (для фильтра from_status обязателен). from_status, если задан, защищает от
+    повторной обработки: рецензии в другом статусе пропускаются. Рецензии в
+    действующей аренде у другого модератора не меняются (CLAIMED) — как и при
+    смене статуса по одной.
+    """
+    if review_ids is None and (book_id is None or from_status is None):
+        raise ValueError("нужен список id или фильтр book_id + from_status")
+    target = lookups.status_id(status_name)
+    approved = lookups.status_id("approved")
+    source = lookups.status_id(from_status) if from_status else None
+
+    now = datetime.utcnow()
+    query = db.session.query(Review.id, Review.book_id, Review.rating, Review.status_id,
+                             Review.claimed_by, Review.claim_expires)
+    if review_ids is not None:
+        review_ids = list(dict.fromkeys(review_ids))
+        query = query.filter(Review.id.in_(review_ids))
+    else:
+        query = query.filter(Review.book_id == book_id, Review.status_id == source)
+    rows = {r.id: r for r in query.order_by(Review.id).with_for_update()}
+
+    result = BulkResult(status_name)
+    changed, deltas = [], {}
+    for rid in (review_ids if review_ids is not None else rows):
+        row = rows.get(rid)
+        if row is None:
+            result.items[rid] = NOT_FOUND
+        elif row.status_id == target:
+            result.items[rid] = UNCHANGED
+        elif source is not None and row.status_id != source:
+            result.items[rid] = SKIPPED
+        elif (row.claim_expires is not None and row.claim_expires > now
+              and row.claimed_by != user_id):
+            result.items[rid] = CLAIMED
+        else:
+            result.items[rid] = UPDATED
+            changed.append(rid)
+            sign = int(target == approved) - int(row.status_id == approved)
+            if sign:
+                count, total = deltas.get(row.book_id, (0, 0))
+                deltas[row.book_id] = (count + sign, total + sign * row.rating)
+    if not changed:
+        return result
+
+    result.book_ids = set(deltas)
+    facets.remove_book(*result.book_ids)          # средняя оценка сменит корзину
+    db.session.execute(
+        db.update(Review).where(Review.id.in_(changed))
+        .values(status_id=target, claimed_by=None, claim_expires=None)
+        .execution_options(synchronize_session=False)
+    )
+    adjust_many_book_stats(deltas)
+    facets.add_book(*result.book_ids)
+    return result
+
+
+# ──────────────── ОЧЕРЕДЬ С АРЕНДОЙ ─────────────────────────────
+def _free(now):
+    return db.or_(Review.claim_expires.is_(None), Review.claim_expires <= now)
+
+
+def claim_batch(user_id, size, lease_seconds):
+    """Продлевает аренду своих рецензий и добирает свободных до size.
+
+    Возвращает id рецензий, взятых пользователем, в порядке очереди.
+    """
+    now = datetime.utcnow()
+    expires = now + timedelta(seconds=lease_seconds)
+    pending = lookups.status_id("pending")
+    held = db.session.execute(
+        db.update(Review)
+        .where(Review.status_id == pending, Review.claimed_by == user_id,
+               Review.claim_expires > now)
+        .values(claim_expires=expires)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if held < size:
+        free = (db.select(Review.id)
+                .where(Review.status_id == pending, _free(now))
+                .order_by(Review.created_at, Review.id)
+                .limit(size - held))
+        if db.session.get_bind().dialect.name == "postgresql":
+            free = free.with_for_update(skip_locked=True)
+        # условие повторяется снаружи: строка, которую успели взять, не перезаписывается
+        db.session.execute(
+            db.update(Review)
+            .where(Review.id.in_(free), Review.status_id == pending, _free(now))
+            .values(claimed_by=user_id, claim_expires=expires)
+            .execution_options(synchronize_session=False)
+        )
+    return list(db.session.scalars(
+        db.select(Review.id)
+        .where(Review.status_id == pending, Review.claimed_by == user_id,
+               Review.claim_expires > now)
+        .order_by(Review.created_at, Review.id)
+    ))
+
+
+def release_claims(user_id, review_ids=None):
+    """Возвращает рецензии пользователя в общий пул. Возвращает их число."""
+    query = db.update(Review).where(Review.claimed_by == user_id)
+    if review_ids is not None:
+        query = query.where(Review.id.in_(review_ids))
+    return db.session.execute(
+        query.values(claimed_by=None, claim_expires=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
@@ -0,0 +1,235 @@
+# pagecache.py
+"""Кэш готовых HTML-страниц для анонимных посетителей.
+
+Запись помечается тегами (например, "books", "book:42"); обработчики записи
+после коммита вызывают page_cache.invalidate(тег, ...) — устаревают только
+страницы с этими тегами. Версия тега — случайный токен, который хранится в
+том же бэкенде, поэтому файловый бэкенд работает для нескольких воркеров
+gunicorn на одной машине.
+
+Бэкенды (PAGE_CACHE_BACKEND): "memory" — LRU в процессе, "file" — каталог
+PAGE_CACHE_DIR, "none" — кэш выключен.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import Response, request, session
+from flask_login import current_user
+
+
+# ──────────────── БЭКЕНДЫ ───────────────────────────────────────
+class MemoryBackend:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def tag_versions(self, tags):
+        with self._lock:
+            return {t: self._tags.get(t, "0") for t in tags}
+
+    def bump(self, tags):
+        with self._lock:
+            for t in tags:
+                self._tags[t] = uuid.uuid4().hex
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+
+class FileBackend:
+    """Записи — pickle-файлы в каталоге; запись атомарная (temp + os.replace).
+
+    Размер каталога проверяется не на каждую запись, а раз в prune_every
+    записей воркера (десятая часть max_entries): между проверками каталог
+    может вырасти на столько же сверх лимита.
+    """
+
+    def __init__(self, directory, max_entries=5000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.prune_every = max(1, max_entries // 10)
+        self._writes = 0
+        self._lock = Lock()
+        os.makedirs(os.path.join(directory, "tags"), exist_ok=True)
+
+    def _path(self, kind, name):
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        if kind == "tags":
+            return os.path.join(self.directory, "tags", digest)
+        return os.path.join(self.directory, digest)
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, key):
+        raw = self._read(self._path("entry", key))
+        return pickle.loads(raw) if raw else None
+
+    def set(self, key, entry):
+        self._write(self._path("entry", key), pickle.dumps(entry))
+        with self._lock:
+            self._writes += 1
+            due = self._writes >= self.prune_every
+            if due:
+                self._writes = 0
+        if due:
+            self._prune()
+
+    def _prune(self):
+        # грубое ограничение размера: при переполнении удаляем самые старые файлы
+        files = [e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith(".tmp")]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda e: e.stat().st_mtime)
+        for e in files[: len(files) - self.max_entries]:
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+
+    def tag_versions(self, tags):
+        return {t: (self._read(self._path("tags", t)) or b"0").decode() for t in tags}
+
+    def bump(self, tags):
+        for t in tags:
+            self._write(self._path("tags", t), uuid.uuid4().hex.encode())
+
+    def clear(self):
+        for folder in (self.directory, os.path.join(self.directory, "tags")):
+            for e in os.scandir(folder):
+                if e.is_file():
+                    os.remove(e.path)
+
+
+# ──────────────── РАСШИРЕНИЕ ────────────────────────────────────
+class PageCache:
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 300
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()                 # счётчики меняют потоки сервера
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config.get("PAGE_CACHE_BACKEND", "memory")
+        self.ttl = app.config.get("PAGE_CACHE_TTL", 300)
+        size = app.config.get("PAGE_CACHE_SIZE", 512)
+        if kind == "memory":
+            self.backend = MemoryBackend(size)
+        elif kind == "file":
+            self.backend = FileBackend(app.config["PAGE_CACHE_DIR"], size)
+        elif kind == "none":
+            self.backend = None
+        else:
+            raise ValueError(f"PAGE_CACHE_BACKEND: неизвестный бэкенд {kind!r}")
+        app.extensions["page_cache"] = self
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, *tags):
+        """Сбрасывает все страницы, помеченные любым из тегов."""
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    @staticmethod
+    def _cacheable():
+        # только анонимы без ожидающих flash-сообщений (страница у всех одинакова)
+        return (request.method == "GET" and not current_user.is_authenticated
+                and not session.get("_flashes"))
+
+    @staticmethod
+    def _key():
+        args = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+        role = current_user.role_name if current_user.is_authenticated else "anonymous"
+        return f"{request.path}?{args}|{role}"
+
+    def cached(self, tags):
+        """Декоратор представления; tags(**view_args) → список тегов страницы."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapped(*args, **kwargs):
+                if self.backend is None or not self._cacheable():
+                    return fn(*args, **kwargs)
+                key = self._key()
+                entry = self.backend.get(key)
+                if entry is not None and entry["expires"] > time.time() \
+                        and self.backend.tag_versions(entry["tags"]) == entry["tags"]:
+                    self._count(hit=True)
+                    return self._respond(entry)
+
+                self._count(hit=False)
+                page_tags = list(tags(**kwargs))
+                versions = self.backend.tag_versions(page_tags)   # до рендера: гонка → промах
+                resp = fn(*args, **kwargs)
+                if not isinstance(resp, Response):
+                    resp = Response(resp)
+                if resp.status_code != 200 or resp.headers.get("Set-Cookie"):
+                    return resp
+                body = resp.get_data()
+                entry = {
+                    "body": body,
+                    "mimetype": resp.mimetype,
+                    "etag": hashlib.sha1(body).hexdigest(),
+                    "modified": time.time(),
+                    "expires": time.time() + self.ttl,
+                    "tags": versions,
+                }
+                self.backend.set(key, entry)
+                return self._respond(entry)
+            return wrapped
+        return decorator
+
+    @staticmethod
+    def _respond(entry):
+        resp = Response(entry["body"], mimetype=entry["mimetype"])
+        resp.set_etag(entry["etag"])
+        resp.last_modified = entry["modified"]
+        resp.cache_control.no_cache = True          # браузер перепроверяет и получает 304
+        resp.vary.add("Cookie")
+        return resp.make_conditional(request)
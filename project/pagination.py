@@ -0,0 +1,130 @@
+# pagination.py
+"""Keyset-пагинация (курсоры вместо OFFSET) и кэшированная оценка числа строк."""
+import base64
+import binascii
+import json
+import time
+from datetime import datetime
+from threading import Lock
+
+from extensions import db
+
+
+# ──────────────── КУРСОРЫ ───────────────────────────────────────
+def encode_cursor(values):
+    """Значения ключа сортировки → непрозрачный URL-safe токен."""
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _cursor_value(column, value):
+    """Значение из токена, приведённое к типу колонки; чужой тип — TypeError."""
+    kind = column.type
+    if isinstance(kind, db.DateTime):
+        if not isinstance(value, str):
+            raise TypeError(value)
+        return datetime.fromisoformat(value)
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(kind, db.Integer):
+        ok = isinstance(value, int)
+    elif isinstance(kind, (db.Float, db.Numeric)):
+        ok = isinstance(value, (int, float))
+    elif isinstance(kind, db.String):
+        ok = isinstance(value, str)
+    else:
+        ok = isinstance(value, (int, float, str))
+    if not ok:
+        raise TypeError(value)
+    return value
+
+
+def decode_cursor(token, columns):
+    """Токен → значения ключа (типы по колонкам). Битый или подделанный токен → None."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        return [_cursor_value(col, v) for col, v in zip(columns, values)]
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+class KeysetPage:
+    """Страница выборки: items + токены соседних страниц."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, columns, descending=False, after=None, before=None,
+                    per_page=10, total=None):
+    """Страница query, упорядоченного по columns (все в одном направлении).
+
+    after/before — токены из KeysetPage.next_cursor / prev_cursor.
+    Последняя колонка должна быть уникальной (обычно id).
+    """
+    key = db.tuple_(*columns)
+    before_values = decode_cursor(before, columns)
+    after_values = None if before_values else decode_cursor(after, columns)
+    backwards = before_values is not None
+
+    # при движении назад сортируем в обратную сторону и потом разворачиваем
+    reverse = descending != backwards
+    order = [c.desc() if reverse else c.asc() for c in columns]
+    cursor = before_values or after_values
+    if cursor is not None:
+        bound = db.tuple_(*[db.literal(v, type_=c.type) for c, v in zip(columns, cursor)])
+        query = query.filter(key < bound if reverse else key > bound)
+
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def token(item):
+        return encode_cursor([getattr(item, c.key) for c in columns])
+
+    if not rows:
+        return KeysetPage([], total=total)
+    has_next = more if not backwards else True
+    has_prev = (more if backwards else cursor is not None)
+    return KeysetPage(
+        rows,
+        next_cursor=token(rows[-1]) if has_next else None,
+        prev_cursor=token(rows[0]) if has_prev else None,
+        total=total,
+    )
+
+
+# ──────────────── ОЦЕНКА ЧИСЛА СТРОК ────────────────────────────
+_count_cache = {}                # key → (expires_at, value)
+_count_lock = Lock()
+
+
+def cached_count(key, query, ttl=60):
+    """COUNT(*) по query, пересчитываемый не чаще раза в ttl секунд."""
+    now = time.monotonic()
+    with _count_lock:
+        hit = _count_cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+    value = query.order_by(None).count()
+    with _count_lock:
+        _count_cache[key] = (now + ttl, value)
+    return value
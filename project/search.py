@@ -0,0 +1,98 @@
+# search.py
+"""Полнотекстовый поиск книг: SQLite FTS5 с ранжированием bm25.
+
+Индекс book_fts хранит по строке на книгу (rowid = book.id) и обновляется
+приложением при добавлении/редактировании/удалении книги. На других СУБД
+(без FTS5) используется запасной поиск через ILIKE.
+"""
+import re
+
+from sqlalchemy import text
+
+from extensions import db
+
+FTS_TABLE = "book_fts"
+
+# веса столбцов для bm25: title, author, publisher, description, genres
+_BM25_WEIGHTS = "10.0, 6.0, 2.0, 1.0, 4.0"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_SELECT_DOCS = """
+    SELECT b.id, b.title, b.author, b.publisher, b.description,
+           COALESCE((SELECT group_concat(g.name, ' ')
+                     FROM book_genres bg JOIN genre g ON g.id = bg.genre_id
+                     WHERE bg.book_id = b.id), '')
+    FROM book b
+"""
+
+
+def fts_available(conn=None):
+    dialect = conn.dialect if conn is not None else db.session.get_bind().dialect
+    return dialect.name == "sqlite"
+
+
+def create_index(conn):
+    """DDL виртуальной таблицы (вызывается из миграции)."""
+    conn.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "title, author, publisher, description, genres, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+
+
+def rebuild_index(conn):
+    """Перестраивает индекс целиком одним INSERT … SELECT."""
+    conn.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    conn.execute(text(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, author, publisher, description, genres) "
+        + _SELECT_DOCS
+    ))
+    conn.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"))
+
+
+def index_books(book_ids):
+    """Обновляет документы книг в текущей транзакции (после flush)."""
+    if not book_ids or not fts_available():
+        return
+    ids = {"ids": list(book_ids)}
+    stmt = text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN :ids").bindparams(
+        db.bindparam("ids", expanding=True))
+    db.session.execute(stmt, ids)
+    stmt = text(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, author, publisher, description, genres) "
+        + _SELECT_DOCS + " WHERE b.id IN :ids"
+    ).bindparams(db.bindparam("ids", expanding=True))
+    db.session.execute(stmt, ids)
+
+
+def build_match(query):
+    """Пользовательский ввод → безопасное FTS5-выражение: все слова, с префиксом."""
+    words = _WORD_RE.findall(query or "")
+    return " ".join(f'"{w}"*' for w in words[:16])
+
+
+def search_book_ids(query, limit=10, offset=0):
+    """id книг, подходящих под запрос, в порядке релевантности."""
+    match = build_match(query)
+    if not match:
+        return []
+    if fts_available():
+        rows = db.session.execute(text(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :q "
+            f"ORDER BY bm25({FTS_TABLE}, {_BM25_WEIGHTS}) LIMIT :limit OFFSET :offset"
+        ), {"q": match, "limit": limit, "offset": offset})
+        return [r[0] for r in rows]
+
+    from models import Book, Genre
+    conds = []
+    for w in _WORD_RE.findall(query)[:16]:
+        pattern = f"%{w}%"
+        conds.append(db.or_(
+            Book.title.ilike(pattern), Book.author.ilike(pattern),
+            Book.publisher.ilike(pattern), Book.description.ilike(pattern),
+            Book.genres.any(Genre.name.ilike(pattern)),
+        ))
+    rows = (db.session.query(Book.id).filter(*conds)
+            .order_by(Book.year.desc(), Book.id.desc()).limit(limit).offset(offset))
+    return [r[0] for r in rows]
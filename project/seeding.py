@@ -0,0 +1,113 @@
+# seeding.py
+"""Начальные данные: справочники, демо-пользователи, жанры, книги-примеры.
+
+Больше не выполняется при старте приложения: справочники ролей и статусов
+вставляет миграция, остальное — команда `flask seed`. Все вставки — пачкой
+через INSERT … ON CONFLICT DO NOTHING, поэтому повторный запуск безопасен и
+не делает SELECT на каждую строку.
+"""
+import random
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from extensions import db
+
+ROLES = {
+    "administrator": "Полный доступ",
+    "moderator":     "Модерация рецензий",
+    "user":          "Обычный пользователь",
+}
+
+STATUSES = {
+    "pending":  "На рассмотрении",
+    "approved": "Одобрена",
+    "rejected": "Отклонена",
+}
+
+# (логин, пароль, фамилия, имя, роль)
+DEMO_USERS = [
+    ("admin", "adminpass", "Admin",     "Super",  "administrator"),
+    ("mod",   "modpass",   "Moderator", "Mighty", "moderator"),
+    ("user",  "userpass",  "User",      "Usual",  "user"),
+]
+
+BASE_GENRES = [
+    "Фэнтези", "Научная фантастика", "Детектив", "История",
+    "Бизнес", "Саморазвитие", "Приключения", "Поэзия",
+]
+
+
+def insert_missing(conn, table, rows):
+    """Пакетная вставка строк, которых ещё нет (конфликт по уникальному ключу)."""
+    if not rows:
+        return
+    dialect = getattr(conn, "dialect", None) or conn.get_bind().dialect
+    insert = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect.name]
+    conn.execute(insert(table).on_conflict_do_nothing(), rows)
+
+
+def seed_reference(conn):
+    """Роли и статусы рецензий — без них приложение не работает (миграция 5)."""
+    from models import Role, ReviewStatus
+    insert_missing(conn, Role.__table__,
+                   [{"name": n, "description": d} for n, d in ROLES.items()])
+    insert_missing(conn, ReviewStatus.__table__,
+                   [{"name": n, "description": d} for n, d in STATUSES.items()])
+
+
+def fake_books(fake, genres, count):
+    """count несохранённых книг со случайными данными Faker."""
+    from models import Book, BookStats
+    return [
+        Book(
+            title=fake.sentence(nb_words=4).rstrip("."),
+            description=fake.paragraph(nb_sentences=8),
+            year=random.randint(1950, 2024),
+            publisher=fake.company(),
+            author=fake.name(),
+            pages=random.randint(120, 700),
+            genres=random.sample(genres, k=random.randint(1, 3)),
+            stats=BookStats(),
+        )
+        for _ in range(count)
+    ]
+
+
+def seed_demo(books=40):
+    """Демо-пользователи, жанры и (если каталог пуст) books книг. Коммитит.
+
+    Возвращает (новых пользователей, добавлено книг).
+    """
+    from werkzeug.security import generate_password_hash
+    from models import Book, Genre, Role, User, lookups
+    import facets
+    import search
+
+    seed_reference(db.session)
+    lookups.invalidate()
+
+    # хэш пароля дорогой — считаем только для тех, кого ещё нет
+    existing = set(db.session.scalars(
+        db.select(User.username).where(User.username.in_([u[0] for u in DEMO_USERS]))))
+    role_ids = dict(db.session.execute(db.select(Role.name, Role.id)).all())
+    insert_missing(db.session, User.__table__, [
+        {"username": login, "password_hash": generate_password_hash(pwd),
+         "last_name": last, "first_name": first, "role_id": role_ids[role]}
+        for login, pwd, last, first, role in DEMO_USERS if login not in existing
+    ])
+    insert_missing(db.session, Genre.__table__, [{"name": g} for g in BASE_GENRES])
+
+    added = 0
+    if books and not db.session.query(Book.id).first():
+        from faker import Faker                # тяжёлый импорт — только здесь
+        new_books = fake_books(Faker("ru_RU"), Genre.query.all(), books)
+        db.session.add_all(new_books)
+        db.session.flush()
+        ids = [b.id for b in new_books]
+        search.index_books(ids)
+        facets.add_book(*ids)
+        added = len(ids)
+
+    db.session.commit()
+    lookups.invalidate()
+    return len(DEMO_USERS) - len(existing), added
@@ -0,0 +1,280 @@
+# similar.py
+"""«Похожие книги»: офлайн-расчёт top-K и его инкрементальное обновление.
+
+Сходство двух книг складывается из:
+- косинуса по жанрам (матрица книга × жанр из book_genres);
+- косинуса по читателям: книга × пользователь по одобренным рецензиям,
+  с весом пользователя log(1 + книг / его рецензий) — тот, кто оценил
+  полкаталога, почти ничего не говорит о сходстве;
+- небольшой надбавки за рейтинг похожей книги (байесовское среднее) — только
+  если есть хоть какое-то пересечение по жанрам или читателям.
+
+Считается разреженными матрицами numpy/scipy порциями строк (память —
+порция × число книг), результат пишется в book_similar. На странице книги
+остаётся один запрос по первичному ключу. Без numpy/scipy команда
+недоступна, а панель просто пуста.
+
+Инкрементальный режим пересчитывает книги, у которых с прошлого запуска
+менялись рецензии, агрегаты или сама книга (updated_at), и дописывает их в
+списки остальных книг, если новая оценка проходит в их top-K. Книга,
+выпавшая из чужого списка, может оставить его на время короче K — полный
+пересчёт (--full) это выравнивает. Время расчёта каждой книги хранится в
+book_similar_state, так что книга без похожих (пустой список) не считается
+заново при каждом запуске.
+"""
+import time
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from extensions import db
+from models import Book, BookSimilar, BookSimilarState, BookStats, Review, book_genres, lookups
+
+GENRE_WEIGHT = 1.0
+READER_WEIGHT = 2.0
+RATING_WEIGHT = 0.2
+RATING_PRIOR_REVIEWS = 5        # «виртуальных» рецензий со средней оценкой каталога
+IN_CHUNK = 500                  # id в одном IN (…)
+
+
+def available():
+    try:
+        import numpy  # noqa: F401
+        import scipy.sparse  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class SimilarityModel:
+    """Матрицы признаков всех книг; score(rows, cols) — плотный блок оценок."""
+
+    def __init__(self):
+        import numpy as np
+        import scipy.sparse as sp
+
+        self.ids = np.fromiter(db.session.scalars(select(Book.id).order_by(Book.id)),
+                               dtype=np.int64)
+        n = len(self.ids)
+
+        links = db.session.execute(select(book_genres.c.book_id, book_genres.c.genre_id)).all()
+        genres = self._matrix([b for b, _ in links], [g for _, g in links], n)
+        self.genres = self._normalize(genres)
+        self.genres_t = self.genres.T.tocsr()
+
+        approved = lookups.status_id("approved")
+        pairs = db.session.execute(
+            select(Review.book_id, Review.user_id).where(Review.status_id == approved)).all()
+        readers = self._matrix([b for b, _ in pairs], [u for _, u in pairs], n)
+        per_user = np.asarray(readers.sum(axis=0)).ravel()
+        idf = np.log1p(n / np.maximum(per_user, 1))
+        self.readers = self._normalize(readers @ sp.diags(idf))
+        self.readers_t = self.readers.T.tocsr()
+
+        # байесовское среднее: у книги с одной «пятёркой» оно ниже, чем у сотни
+        stats = db.session.execute(
+            select(BookStats.book_id, BookStats.review_count, BookStats.rating_sum)).all()
+        count, total = np.zeros(n), np.zeros(n)
+        if stats:
+            arr = np.asarray(stats, dtype=np.float64)
+            pos = self.positions(arr[:, 0])
+            ok = pos >= 0
+            count[pos[ok]], total[pos[ok]] = arr[ok, 1], arr[ok, 2]
+        mean = total.sum() / count.sum() if count.sum() else 0.0
+        bayes = (RATING_PRIOR_REVIEWS * mean + total) / (RATING_PRIOR_REVIEWS + count)
+        self.prior = RATING_WEIGHT * bayes / 5
+
+    def _matrix(self, book_ids, keys, n):
+        """Бинарная разреженная матрица книга × ключ (жанр, пользователь)."""
+        import numpy as np
+        import scipy.sparse as sp
+
+        rows = self.positions(book_ids)
+        keep = rows >= 0
+        _, cols = np.unique(np.asarray(keys, dtype=np.int64), return_inverse=True)
+        m = sp.csr_matrix((np.ones(int(keep.sum())), (rows[keep], cols[keep])),
+                          shape=(n, int(cols.max()) + 1 if len(cols) else 0))
+        m.sum_duplicates()
+        m.data[:] = 1.0
+        return m
+
+    @staticmethod
+    def _normalize(m):
+        import numpy as np
+        import scipy.sparse as sp
+
+        norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+        inv = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        return (sp.diags(inv) @ m).tocsr()
+
+    def positions(self, book_ids):
+        """id книг → номера строк (-1 для неизвестных)."""
+        import numpy as np
+
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(book_ids), -1)
+        pos = np.minimum(np.searchsorted(self.ids, book_ids), len(self.ids) - 1)
+        return np.where(self.ids[pos] == book_ids, pos, -1)
+
+    def overlap(self, rows, cols=None):
+        """Симметричная часть оценки (жанры + читатели) для строк rows × cols."""
+        genres = self.genres[rows] @ (self.genres_t if cols is None else self.genres_t[:, cols])
+        readers = self.readers[rows] @ (self.readers_t if cols is None else self.readers_t[:, cols])
+        return (GENRE_WEIGHT * genres + READER_WEIGHT * readers).toarray()
+
+    def top_k(self, rows, k):
+        """[(позиция книги, [(позиция похожей, оценка), …])] для строк rows."""
+        import numpy as np
+
+        base = self.overlap(rows)
+        score = np.where(base > 0, base + self.prior[None, :], 0.0)
+        score[np.arange(len(rows)), rows] = 0.0               # сама себе не похожа
+        k = min(k, score.shape[1] - 1)
+        if k <= 0:
+            return [(row, []) for row in rows]
+        best = np.argpartition(-score, k - 1, axis=1)[:, :k]
+        result = []
+        for i, row in enumerate(rows):
+            cand = best[i][np.argsort(-score[i, best[i]], kind="stable")]
+            result.append((row, [(int(c), float(score[i, c])) for c in cand if score[i, c] > 0]))
+        return result
+
+
+# ──────────────── ЗАПУСК ────────────────────────────────────────
+def last_run():
+    return db.session.scalar(select(func.max(BookSimilarState.computed_at)))
+
+
+def dirty_books(since):
+    """Книги, чьи признаки могли измениться после since (и ещё не посчитанные)."""
+    changed = set(db.session.scalars(select(Review.book_id).where(Review.updated_at > since)))
+    changed |= set(db.session.scalars(select(Book.id).where(Book.updated_at > since)))
+    changed |= set(db.session.scalars(select(BookStats.book_id).where(BookStats.updated_at > since)))
+    changed |= set(db.session.scalars(
+        select(Book.id).where(~Book.id.in_(select(BookSimilarState.book_id)))))
+    return changed
+
+
+def _write(lists, computed_at):
+    """lists: book_id → [(similar_id, score)] — заменяет строки этих книг
+    и отмечает их посчитанными."""
+    t, state = BookSimilar.__table__, BookSimilarState.__table__
+    for part in _chunks(lists, IN_CHUNK):
+        db.session.execute(t.delete().where(t.c.book_id.in_(part)))
+        db.session.execute(state.delete().where(state.c.book_id.in_(part)))
+    if lists:
+        db.session.execute(state.insert(), [{"book_id": book_id, "computed_at": computed_at}
+                                            for book_id in lists])
+    rows = [{"book_id": book_id, "rank": rank, "similar_id": sid, "score": score,
+             "computed_at": computed_at}
+            for book_id, items in lists.items() for rank, (sid, score) in enumerate(items)]
+    for part in _chunks(rows, 5000):
+        db.session.execute(t.insert(), part)
+    return len(rows)
+
+
+def rebuild(full=False, k=12, chunk=256):
+    """Пересчитывает top-K (всё или только изменившееся). Коммитит. Возвращает отчёт."""
+    import numpy as np
+
+    started = time.perf_counter()
+    computed_at = datetime.utcnow()
+    since = None if full else last_run()
+    model = SimilarityModel()
+    ids = model.ids
+    t = BookSimilar.__table__
+
+    # строки удалённых книг (в SQLite внешние ключи не каскадируются)
+    db.session.execute(t.delete().where(
+        ~t.c.book_id.in_(select(Book.id)) | ~t.c.similar_id.in_(select(Book.id))))
+
+    if since is None:
+        db.session.execute(t.delete())
+        db.session.execute(BookSimilarState.__table__.delete())
+        dirty_rows = np.arange(len(ids))
+    else:
+        dirty_rows = model.positions(sorted(dirty_books(since)))
+        dirty_rows = dirty_rows[dirty_rows >= 0]
+
+    written = 0
+    for start in range(0, len(dirty_rows), chunk):
+        rows = dirty_rows[start:start + chunk]
+        lists = {int(ids[row]): [(int(ids[c]), s) for c, s in items]
+                 for row, items in model.top_k(rows, k)}
+        written += _write(lists, computed_at)
+
+    neighbours = 0
+    if since is not None and len(dirty_rows):
+        neighbours = _merge_into_neighbours(model, dirty_rows, k, chunk, computed_at)
+
+    db.session.commit()
+    return {"books": int(len(dirty_rows)), "neighbours": neighbours, "rows": written,
+            "full": since is None, "seconds": time.perf_counter() - started}
+
+
+def _merge_into_neighbours(model, dirty_rows, k, chunk, computed_at):
+    """Дописывает пересчитанные книги D в чужие top-K.
+
+    Затрагиваются книги, у которых D уже есть в списке или новая оценка с
+    кем-то из D выше их текущего минимума (или список короче k).
+    """
+    import numpy as np
+
+    ids = model.ids
+    dirty_ids = set(int(ids[r]) for r in dirty_rows)
+    n = len(ids)
+
+    floor = np.full(n, -np.inf)                   # оценка, которую надо превзойти
+    full_lists = db.session.execute(
+        select(BookSimilar.book_id, func.min(BookSimilar.score))
+        .group_by(BookSimilar.book_id).having(func.count() >= k)).all()
+    if full_lists:
+        pos = model.positions([b for b, _ in full_lists])
+        low = np.array([s for _, s in full_lists])
+        floor[pos[pos >= 0]] = low[pos >= 0]
+
+    affected = set()
+    for part in _chunks(dirty_ids, IN_CHUNK):
+        affected |= set(db.session.scalars(
+            select(BookSimilar.book_id).where(BookSimilar.similar_id.in_(part))))
+    is_dirty = np.zeros(n, dtype=bool)
+    is_dirty[dirty_rows] = True
+    for start in range(0, len(dirty_rows), chunk):
+        rows = dirty_rows[start:start + chunk]
+        base = model.overlap(rows)
+        score = np.where(base > 0, base + model.prior[rows][:, None], 0.0)
+        hit = (score > floor[None, :]) & (score > 0) & ~is_dirty[None, :]
+        affected |= set(int(ids[c]) for c in np.nonzero(hit.any(axis=0))[0])
+    affected -= dirty_ids
+    if not affected:
+        return 0
+
+    old = {}
+    for part in _chunks(affected, IN_CHUNK):
+        for book_id, sid, score in db.session.execute(
+                select(BookSimilar.book_id, BookSimilar.similar_id, BookSimilar.score)
+                .where(BookSimilar.book_id.in_(part))):
+            if sid not in dirty_ids:
+                old.setdefault(book_id, []).append((sid, score))
+
+    lists = {}
+    targets = model.positions(sorted(affected))
+    for start in range(0, len(targets), chunk):
+        rows = targets[start:start + chunk]
+        base = model.overlap(rows, dirty_rows)
+        score = np.where(base > 0, base + model.prior[dirty_rows][None, :], 0.0)
+        for i, row in enumerate(rows):
+            book_id = int(ids[row])
+            fresh = [(int(ids[dirty_rows[j]]), float(score[i, j]))
+                     for j in np.nonzero(score[i] > 0)[0]]
+            merged = sorted(old.get(book_id, []) + fresh, key=lambda e: -e[1])[:k]
+            lists[book_id] = merged
+    _write(lists, computed_at)
+    return len(lists)
@@ -0,0 +1,107 @@
+# sqlcount.py
+"""Подсчёт SQL-запросов, которые выполняет один HTTP-запрос к приложению."""
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from extensions import db
+
+
+# Бюджеты «запросов на страницу» для основных представлений.
+# Ключ — (endpoint, роль клиента или None для анонима).
+# Для вошедших пользователей считается, что снимок current_user уже в кэше.
+DEFAULT_BUDGETS = {
+    ("index", None): 6,
+    ("index", "administrator"): 6,
+    ("view_book", None): 4,             # книга + жанры + рецензии + похожие
+    ("view_book", "user"): 5,
+    ("book_reviews", None): 2,          # у книги без рецензий — ещё проверка, что она есть
+    ("my_reviews", "user"): 2,
+    ("moderation", "moderator"): 2,
+    ("moderation_view", "moderator"): 1,
+    ("api_books", None): 2,
+    ("api_book", None): 2,
+    ("api_book_reviews", None): 2,      # у книги без рецензий — ещё проверка, что она есть
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Представление выполнило больше SQL-запросов, чем разрешено."""
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Собирает тексты SQL-запросов, выполненных внутри блока в этом потоке.
+
+    Запросы других потоков (фоновые задачи jobs.py, соседние клиенты) не считаются.
+    """
+    engine = engine or db.engine
+    statements = []
+    thread = threading.get_ident()
+
+    def _on_execute(conn, cursor, statement, params, context, executemany):
+        if threading.get_ident() == thread:
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _on_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", _on_execute)
+
+
+def login_client(client, user):
+    """Авторизует тестовый клиент без формы логина (через сессию Flask-Login)."""
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user.id)
+        sess["_fresh"] = True
+    return client
+
+
+def assert_query_budget(client, url, budget, engine=None):
+    """GET url и проверка, что число SQL-запросов ≤ budget. Возвращает (response, statements)."""
+    with count_queries(engine) as statements:
+        response = client.get(url)
+    if len(statements) > budget:
+        listing = "\n".join(f"  {i + 1}. {s}" for i, s in enumerate(statements))
+        raise QueryBudgetExceeded(
+            f"{url}: {len(statements)} SQL-запросов при бюджете {budget}\n{listing}"
+        )
+    return response, statements
+
+
+def budget_cases(budgets=None):
+    """[(endpoint, роль, url, пользователь, бюджет)] для проверки бюджетов.
+
+    Вызывается в app-context. Адреса строятся по первой книге и рецензии в БД;
+    url None — данных для страницы нет, пользователь None — нет пользователя
+    с такой ролью. Снимки пользователей заранее кладутся в кэш current_user,
+    как у вошедшего пользователя со «тёплым» кэшем.
+    """
+    from flask import current_app, url_for
+    from models import Book, Review, Role, User, identities, lookups
+
+    lookups.genre_choices()               # справочники грузятся один раз на процесс
+    book = Book.query.first()
+    review = Review.query.first()
+    args = {
+        "index": {},
+        "view_book": {"book_id": book.id} if book else None,
+        "book_reviews": {"book_id": book.id} if book else None,
+        "my_reviews": {},
+        "moderation": {},
+        "moderation_view": {"review_id": review.id} if review else None,
+        "api_books": {},
+        "api_book": {"book_id": book.id} if book else None,
+        "api_book_reviews": {"book_id": book.id} if book else None,
+    }
+    users = {role.name: User.query.filter_by(role_id=role.id).first()
+             for role in Role.query.all()}
+    for user in users.values():
+        if user is not None:
+            identities.get(user.id)
+    with current_app.test_request_context():
+        urls = {ep: url_for(ep, **a) for ep, a in args.items() if a is not None}
+    return [(endpoint, role, urls.get(endpoint), users.get(role) if role else None, budget)
+            for (endpoint, role), budget in (budgets or DEFAULT_BUDGETS).items()]
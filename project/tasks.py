@@ -0,0 +1,64 @@
+# tasks.py
+"""Фоновые задачи, которые ставят обработчики записи (очередь — jobs.py).
+
+Сюда уходит только то, что можно отложить: миниатюры, поисковый индекс,
+удаление файлов. Агрегаты рейтинга, счётчики фасетов и сброс кэша страниц
+остаются в запросе — их видно сразу после ответа.
+
+Каждая задача идемпотентна: после сбоя или истёкшей аренды её можно
+выполнить ещё раз с тем же результатом.
+"""
+import os
+import time
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from extensions import db, job_queue, page_cache
+from models import Cover
+from covers import make_derivatives, remove_cover_files
+import search
+
+
+@job_queue.handler("cover_derivatives", max_attempts=3)
+def cover_derivatives(filename):
+    """Миниатюры новой обложки; пока их нет, /uploads отдаёт оригинал."""
+    make_derivatives(current_app.config["UPLOAD_FOLDER"], filename)
+
+
+@job_queue.handler("search_index")
+def search_index(book_ids):
+    """Документы книг в полнотекстовом индексе (удалённые книги из него пропадут).
+
+    Индекс коммитится до сброса кэша, иначе поиск успел бы закэшировать старую
+    выдачу. Кэш с бэкендом memory так сбрасывается только в своём процессе.
+    """
+    search.index_books(book_ids)
+    db.session.commit()
+    page_cache.invalidate("books")
+
+
+@job_queue.handler("cover_gc")
+def cover_gc(filename):
+    """Удаляет файл обложки с миниатюрами, если на него не ссылается ни одна книга.
+
+    Файл общий у книг с одинаковым изображением (у каждой своя строка Cover),
+    поэтому ссылки — строки Cover с этим именем. Ставится с задержкой
+    COVER_GC_DELAY_SECONDS; файл, который загрузка переиспользовала позже
+    (_publish обновляет mtime), проверяется ещё раз через ту же задержку:
+    Cover этой загрузки мог ещё не закоммититься.
+    """
+    refs = db.session.scalar(
+        select(func.count()).select_from(Cover).where(Cover.filename == filename))
+    if refs:
+        return
+    folder = current_app.config["UPLOAD_FOLDER"]
+    try:
+        age = time.time() - os.path.getmtime(os.path.join(folder, filename))
+    except FileNotFoundError:
+        return
+    delay = current_app.config["COVER_GC_DELAY_SECONDS"]
+    if age < delay:
+        job_queue.enqueue("cover_gc", {"filename": filename}, delay=delay - age)
+    else:
+        remove_cover_files(folder, filename)
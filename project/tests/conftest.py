@@ -0,0 +1,60 @@
+# tests/conftest.py
+"""Общие фикстуры: приложение на временной SQLite-базе с демо-данными.
+
+Config читает окружение при импорте, поэтому переменные выставляются до
+первого импорта модулей проекта. Кэш страниц выключен (тесты меряют
+представления, а не попадания в кэш), фоновые задачи выполняются только
+явно — через job_queue.run_pending().
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+WORKDIR = tempfile.mkdtemp(prefix="library-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ["UPLOAD_FOLDER"] = os.path.join(WORKDIR, "uploads")
+os.environ["PAGE_CACHE_BACKEND"] = "none"
+os.environ["JOBS_WORKER"] = "off"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app():
+    import seeding
+    from app import app as flask_app
+
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        seeding.seed_demo()
+    yield flask_app
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def ctx(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture(scope="session")
+def users(app):
+    """Роль → демо-пользователь с этой ролью."""
+    from models import Role, User
+
+    with app.app_context():
+        return {role.name: User.query.filter_by(role_id=role.id).first()
+                for role in Role.query.all()}
+
+
+@pytest.fixture
+def login(app, users):
+    """login("moderator") → тестовый клиент, вошедший под пользователем этой роли."""
+    from sqlcount import login_client
+
+    def make(role=None):
+        client = app.test_client()
+        return login_client(client, users[role]) if role else client
+    return make
@@ -0,0 +1,21 @@
+# tests/test_api.py
+
+
+def test_genre_rename_changes_book_etag(ctx, login):
+    from extensions import db
+    from models import Book
+
+    book = Book.query.filter(Book.genres.any()).first()
+    genre = book.genres[0]
+    client = login()
+    etag = client.get(f"/api/v1/books/{book.id}").headers["ETag"]
+
+    old_name, genre.name = genre.name, genre.name + " (новое)"
+    db.session.commit()
+    try:
+        response = client.get(f"/api/v1/books/{book.id}", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert genre.name in [g["name"] for g in response.get_json()["genres"]]
+    finally:
+        genre.name = old_name
+        db.session.commit()
@@ -0,0 +1,40 @@
+# tests/test_books.py
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+
+def test_delete_book_cascades_in_database(ctx, users, login):
+    from extensions import db
+    from models import Book, BookSimilar, BookStats, Review, book_genres, lookups
+
+    book = Book.query.filter(~Book.reviews.any()).order_by(Book.id).first()
+    other = Book.query.filter(Book.id != book.id).first()
+    db.session.add(Review(book_id=book.id, user_id=users["user"].id, rating=5,
+                          text_md="Текст", status_id=lookups.status_id("pending")))
+    db.session.add(BookSimilar(book_id=other.id, rank=99, similar_id=book.id, score=1.0,
+                               computed_at=datetime.utcnow()))
+    db.session.commit()
+    book_id = book.id
+    db.session.remove()
+
+    assert login("administrator").post(f"/books/{book_id}/delete").status_code == 302
+
+    for table, column in ((Review.__table__, "book_id"), (book_genres, "book_id"),
+                          (BookStats.__table__, "book_id"), (BookSimilar.__table__, "similar_id")):
+        count = db.session.scalar(select(func.count()).select_from(table)
+                                  .where(table.c[column] == book_id))
+        assert count == 0, table.name
+
+
+def test_book_genre_link_is_unique(ctx):
+    from extensions import db
+    from models import book_genres
+
+    book_id, genre_id = db.session.execute(select(book_genres.c.book_id,
+                                                  book_genres.c.genre_id)).first()
+    with pytest.raises(IntegrityError):
+        db.session.execute(insert(book_genres).values(book_id=book_id, genre_id=genre_id))
+    db.session.rollback()
@@ -0,0 +1,75 @@
+# tests/test_covers.py
+import io
+
+from PIL import Image
+
+
+def png_bytes(color="red"):
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 12), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def add_book(client, title, image):
+    from models import lookups
+
+    genre_id = lookups.genre_choices()[0][0]
+    response = client.post("/books/add", data={
+        "title": title, "description": "Описание", "year": 2001, "publisher": "Изд",
+        "author": "Автор", "pages": 100, "genres": [genre_id],
+        "cover": (io.BytesIO(image), "cover.png"),
+    }, content_type="multipart/form-data")
+    assert response.status_code == 302
+    return int(response.headers["Location"].rsplit("/", 1)[1])
+
+
+def test_identical_uploads_keep_both_covers(ctx, login):
+    from extensions import db
+    from models import Book
+
+    client = login("administrator")
+    image = png_bytes("teal")
+    first, second = add_book(client, "Первая", image), add_book(client, "Вторая", image)
+
+    a, b = db.session.get(Book, first), db.session.get(Book, second)
+    assert a.cover is not None and b.cover is not None
+    assert a.cover.id != b.cover.id
+    assert a.cover.filename == b.cover.filename      # один файл на двоих
+    assert client.get(f"/uploads/{a.cover.filename}").status_code == 200
+
+
+def test_cover_file_removed_with_its_last_book(app, ctx, login, monkeypatch):
+    import os
+    from extensions import db, job_queue
+    from models import Book
+
+    monkeypatch.setitem(app.config, "COVER_GC_DELAY_SECONDS", 0)
+    client = login("administrator")
+    image = png_bytes("olive")
+    first, second = add_book(client, "Третья", image), add_book(client, "Четвёртая", image)
+    path = os.path.join(app.config["UPLOAD_FOLDER"], db.session.get(Book, first).cover.filename)
+    db.session.remove()
+
+    client.post(f"/books/{first}/delete")
+    job_queue.run_pending()
+    assert os.path.exists(path)                      # файл ещё нужен второй книге
+
+    client.post(f"/books/{second}/delete")
+    job_queue.run_pending()
+    assert not os.path.exists(path)
+
+
+def test_fetch_covers_does_not_store_broken_images(tmp_path):
+    from covers import FetchStats, fetch_covers
+
+    class Source:
+        def fetch(self, seed):
+            return png_bytes("navy") if seed == "good" else b"<html>503</html>"
+
+    stats = FetchStats()
+    results = list(fetch_covers(Source(), ["good", "bad"], str(tmp_path), workers=2,
+                                retries=1, backoff=0, stats=stats))
+    assert [r[0] for r in results] == ["good"]
+    assert stats.ok == 1 and stats.retries == 1
+    stored = [p for p in tmp_path.rglob("*") if p.is_file()]
+    assert all(p.name.startswith(results[0][1]) for p in stored)
@@ -0,0 +1,42 @@
+# tests/test_moderation.py
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def pending_reviews(ctx, users):
+    """Ожидающие рецензии всех демо-пользователей на одну книгу: {роль: id}."""
+    from extensions import db
+    from models import Book, Review, lookups
+
+    book = Book.query.filter(~Book.reviews.any()).order_by(Book.id.desc()).first()
+    reviews = {role: Review(book_id=book.id, user_id=user.id, rating=4, text_md="Текст",
+                            status_id=lookups.status_id("pending"))
+               for role, user in users.items()}
+    db.session.add_all(reviews.values())
+    db.session.commit()
+    return book.id, {role: r.id for role, r in reviews.items()}
+
+
+def test_bulk_skips_reviews_claimed_by_another_moderator(pending_reviews, users, login):
+    from extensions import db
+    from models import Review, lookups
+
+    book_id, ids = pending_reviews
+    claimed = db.session.get(Review, ids["user"])
+    claimed.claimed_by = users["administrator"].id
+    claimed.claim_expires = datetime.utcnow() + timedelta(minutes=10)
+    db.session.commit()
+
+    response = login("moderator").post("/moderation/bulk", json={
+        "action": "approve", "book_id": book_id, "from_status": "pending"})
+    assert response.status_code == 200
+    results = {r["id"]: r["result"] for r in response.get_json()["results"]}
+    assert results[ids["user"]] == "claimed"
+    assert results[ids["moderator"]] == results[ids["administrator"]] == "updated"
+
+    db.session.expire_all()
+    claimed = db.session.get(Review, ids["user"])
+    assert claimed.status_id == lookups.status_id("pending")
+    assert claimed.claimed_by == users["administrator"].id
@@ -0,0 +1,16 @@
+# tests/test_pagecache.py
+from pagecache import FileBackend
+
+
+def test_file_backend_prunes_periodically(tmp_path):
+    backend = FileBackend(str(tmp_path), max_entries=20)
+    scans = []
+    original = backend._prune
+    backend._prune = lambda: (scans.append(1), original())
+
+    for i in range(100):
+        backend.set(f"/page/{i}", {"body": b"x"})
+
+    assert len(scans) == 100 // backend.prune_every
+    entries = [e for e in tmp_path.iterdir() if e.is_file()]
+    assert len(entries) <= backend.max_entries + backend.prune_every
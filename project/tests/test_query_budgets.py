@@ -0,0 +1,36 @@
+# tests/test_query_budgets.py
+"""Бюджеты SQL-запросов основных страниц (sqlcount.DEFAULT_BUDGETS).
+
+То же проверяет flask check-queries; здесь регрессия роняет тесты.
+"""
+import pytest
+
+from sqlcount import DEFAULT_BUDGETS, assert_query_budget, budget_cases, login_client
+
+
+@pytest.fixture(scope="module")
+def cases(app, users):
+    from extensions import db
+    from models import Book, Review, lookups
+
+    with app.app_context():
+        if not Review.query.first():      # для moderation_view нужна хотя бы одна рецензия
+            db.session.add(Review(book_id=Book.query.first().id, user_id=users["user"].id,
+                                  rating=3, text_md="Текст",
+                                  status_id=lookups.status_id("pending")))
+            db.session.commit()
+        return {(endpoint, role): (url, user, budget)
+                for endpoint, role, url, user, budget in budget_cases()}
+
+
+@pytest.mark.parametrize("endpoint, role", list(DEFAULT_BUDGETS),
+                         ids=[f"{e}-{r or 'anonymous'}" for e, r in DEFAULT_BUDGETS])
+def test_page_within_query_budget(app, cases, endpoint, role):
+    url, user, budget = cases[(endpoint, role)]
+    assert url is not None and (role is None or user is not None)
+    client = app.test_client()
+    if role:
+        login_client(client, user)
+    with app.app_context():
+        response, _ = assert_query_budget(client, url, budget)
+    assert response.status_code == 200
@@ -0,0 +1,22 @@
+# tests/test_similar.py
+import pytest
+
+import similar
+
+if not similar.available():
+    pytest.skip("нужны numpy и scipy", allow_module_level=True)
+
+
+def test_book_without_similar_is_not_recomputed(ctx):
+    from extensions import db
+    from models import Book, BookSimilar
+
+    lonely = Book(title="Одинокая книга", description="Без жанров и рецензий", year=1900,
+                  publisher="Изд", author="Автор", pages=10)
+    db.session.add(lonely)
+    db.session.commit()
+
+    similar.rebuild(full=True)
+    assert not BookSimilar.query.filter_by(book_id=lonely.id).count()
+    assert lonely.id not in similar.dirty_books(similar.last_run())
+    assert similar.rebuild()["books"] == 0
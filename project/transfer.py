@@ -0,0 +1,297 @@
+# transfer.py
+"""Потоковый импорт и экспорт каталога книг (CSV и JSONL).
+
+Память не зависит от размера файла: строки читаются и пишутся пачками.
+Импорт — upsert по естественному ключу (title, author, year): один SELECT
+существующих книг на пачку, затем executemany INSERT новых и UPDATE
+найденных через Core, без ORM-объектов. Жанры сопоставляются по имени через
+словарь в памяти (неизвестные создаются или считаются ошибкой строки).
+Обложки — файлы из локального каталога; одинаковые по md5 не дублируются.
+
+Экспорт идёт через yield_per: строки книг приходят с сервера порциями, к
+каждой порции — один запрос жанров.
+
+Сохранённый HTML описания не рендерится (строк может быть миллион) — его
+досчитает flask backfill-html или ленивый кэш при показе.
+"""
+import csv
+import json
+import os
+import sys
+from contextlib import nullcontext
+
+from sqlalchemy import select, tuple_
+
+from extensions import db
+from models import Book, BookStats, Cover, Genre, book_genres, lookups
+from covers import make_derivatives, store_file
+from datagen import Progress
+import facets
+import search
+import seeding
+
+FIELDS = ("title", "author", "year", "publisher", "pages", "genres", "description", "cover")
+GENRE_SEPARATOR = "|"            # в CSV жанры — одной ячейкой: «Детектив|История»
+MAX_SHOWN_ERRORS = 10
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return "csv"
+
+
+def open_stream(path, mode="r"):
+    """Файл для csv-модуля (newline="") или stdin/stdout для «-»."""
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+# ──────────────── ЧТЕНИЕ / ЗАПИСЬ СТРОК ──────────────────────────
+def read_rows(stream, fmt):
+    """(номер строки, dict) из CSV или JSONL, по одной."""
+    if fmt == "jsonl":
+        for line_no, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield line_no, json.loads(line)
+                except ValueError as exc:
+                    yield line_no, exc
+        return
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+class RowWriter:
+    def __init__(self, stream, fmt):
+        self.stream, self.fmt = stream, fmt
+        if fmt == "csv":
+            self.csv = csv.DictWriter(stream, fieldnames=FIELDS)
+            self.csv.writeheader()
+
+    def write(self, row):
+        if self.fmt == "jsonl":
+            self.stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            self.csv.writerow({**row, "genres": GENRE_SEPARATOR.join(row["genres"])})
+
+
+def clean_row(raw):
+    """Проверяет и нормализует строку файла. Ошибка — ValueError с причиной."""
+    if isinstance(raw, Exception):
+        raise ValueError(f"не JSON: {raw}")
+    if not isinstance(raw, dict):
+        raise ValueError("ожидался объект")
+    row = {}
+    for name in ("title", "author", "publisher"):
+        value = str(raw.get(name) or "").strip()
+        if not value:
+            raise ValueError(f"пустое поле {name}")
+        row[name] = value
+    for name in ("year", "pages"):
+        try:
+            row[name] = int(raw.get(name))
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} должно быть целым: {raw.get(name)!r}") from None
+    genres = raw.get("genres") or []
+    if isinstance(genres, str):
+        genres = genres.split(GENRE_SEPARATOR)
+    row["genres"] = list(dict.fromkeys(str(g).strip() for g in genres if str(g).strip()))
+    row["description"] = str(raw.get("description") or "")
+    row["cover"] = str(raw.get("cover") or "").strip() or None
+    return row
+
+
+# ──────────────── ИМПОРТ ────────────────────────────────────────
+class ImportReport:
+    def __init__(self):
+        self.inserted = self.updated = self.failed = 0
+        self.covers_added = self.covers_duplicate = self.covers_missing = 0
+        self.genres_created = 0
+        self.errors = []                 # первые MAX_SHOWN_ERRORS: (строка, причина)
+
+    def error(self, line_no, reason):
+        self.failed += 1
+        if len(self.errors) < MAX_SHOWN_ERRORS:
+            self.errors.append((line_no, reason))
+
+
+class BookImporter:
+    def __init__(self, batch_size=1000, covers_dir=None, upload_dir=None, create_genres=True,
+                 progress_file=None):
+        self.batch_size = batch_size
+        self.covers_dir = covers_dir
+        self.upload_dir = upload_dir
+        self.create_genres = create_genres
+        self.report = ImportReport()
+        self.progress = Progress("книги", file=progress_file)
+        self.genre_ids = {name: gid for gid, name in
+                          db.session.execute(select(Genre.id, Genre.name))}
+
+    def run(self, rows):
+        batch = []
+        for line_no, raw in rows:
+            try:
+                batch.append((line_no, clean_row(raw)))
+            except ValueError as exc:
+                self.report.error(line_no, str(exc))
+                continue
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+        if self.report.genres_created:
+            lookups.invalidate()          # Core-вставка не вызывает слушателей модели
+        self.progress.show()
+        return self.report
+
+    # ─── жанры
+    def _resolve_genres(self, batch):
+        missing = {g for _, row in batch for g in row["genres"]} - set(self.genre_ids)
+        if missing and self.create_genres:
+            seeding.insert_missing(db.session, Genre.__table__, [{"name": g} for g in sorted(missing)])
+            self.genre_ids.update({name: gid for gid, name in db.session.execute(
+                select(Genre.id, Genre.name).where(Genre.name.in_(missing)))})
+            self.report.genres_created += len(missing)
+            missing = set()
+        good = []
+        for line_no, row in batch:
+            unknown = [g for g in row["genres"] if g in missing]
+            if unknown:
+                self.report.error(line_no, f"неизвестные жанры: {', '.join(unknown)}")
+            else:
+                good.append((line_no, row))
+        return good
+
+    # ─── пачка
+    def _flush(self, batch):
+        batch = self._resolve_genres(batch)
+        # повтор ключа внутри пачки — действует последняя строка
+        by_key = {(r["title"], r["author"], r["year"]): (n, r) for n, r in batch}
+        existing = {}
+        for book_id, *key in db.session.execute(
+                select(Book.id, Book.title, Book.author, Book.year)
+                .where(tuple_(Book.title, Book.author, Book.year).in_(list(by_key)))
+                .order_by(Book.id.desc())):
+            existing[tuple(key)] = book_id      # дубликаты в БД — берём самую раннюю книгу
+
+        t = Book.__table__
+        update_keys = [k for k in by_key if k in existing]
+        insert_keys = [k for k in by_key if k not in existing]
+        ids = {k: existing[k] for k in update_keys}
+
+        facets.remove_book(*ids.values())       # вклад по старым жанрам/году
+        if update_keys:
+            # имена параметров не должны совпадать с колонками — отсюда префикс v_
+            updates = [{"b_id": ids[k], **{f"v_{name}": value for name, value
+                                           in self._book_values(by_key[k][1]).items()}}
+                       for k in update_keys]
+            columns = self._book_values(by_key[update_keys[0]][1])
+            db.session.execute(
+                t.update().where(t.c.id == db.bindparam("b_id"))
+                .values({name: db.bindparam(f"v_{name}") for name in columns}),
+                updates,
+            )
+            db.session.execute(book_genres.delete()
+                               .where(book_genres.c.book_id.in_(list(ids.values()))))
+        if insert_keys:
+            new_ids = db.session.execute(
+                t.insert().returning(t.c.id, sort_by_parameter_order=True),
+                [self._book_values(by_key[k][1]) for k in insert_keys],
+            ).scalars().all()
+            db.session.execute(BookStats.__table__.insert(), [{"book_id": i} for i in new_ids])
+            ids.update(zip(insert_keys, new_ids))
+
+        links = [{"book_id": ids[k], "genre_id": self.genre_ids[g]}
+                 for k, (_, r) in by_key.items() for g in r["genres"]]
+        if links:
+            db.session.execute(book_genres.insert(), links)
+        if self.covers_dir:
+            self._attach_covers({ids[k]: r["cover"] for k, (_, r) in by_key.items()
+                                 if r["cover"]})
+
+        touched = list(ids.values())
+        search.index_books(touched)
+        facets.add_book(*touched)
+        db.session.commit()
+        self.report.updated += len(update_keys)
+        self.report.inserted += len(insert_keys)
+        self.progress.add(len(batch))
+
+    @staticmethod
+    def _book_values(row):
+        return {
+            "title": row["title"], "author": row["author"], "year": row["year"],
+            "publisher": row["publisher"], "pages": row["pages"],
+            "description": row["description"],
+            "description_rendered": None,       # см. docstring модуля
+        }
+
+    # ─── обложки
+    def _attach_covers(self, wanted):
+        """wanted: book_id → имя файла в covers_dir. Книги с обложкой не трогаем."""
+        if not wanted:
+            return
+        has_cover = set(db.session.scalars(
+            select(Cover.book_id).where(Cover.book_id.in_(list(wanted)))))
+        stored = {}
+        for book_id, name in wanted.items():
+            if book_id in has_cover:
+                continue
+            path = os.path.join(self.covers_dir, name)
+            if not os.path.isfile(path):
+                self.report.covers_missing += 1
+                continue
+            stored[book_id] = store_file(path, self.upload_dir)
+        if not stored:
+            return
+        known = set(db.session.scalars(
+            select(Cover.md5_hash).where(Cover.md5_hash.in_({s[0] for s in stored.values()}))))
+        rows = []
+        for book_id, (md5, relpath, mimetype) in stored.items():
+            if md5 in known:                    # та же картинка у другой книги — файл общий
+                self.report.covers_duplicate += 1
+            else:
+                known.add(md5)
+                make_derivatives(self.upload_dir, relpath)
+            rows.append({"book_id": book_id, "md5_hash": md5, "filename": relpath,
+                         "mimetype": mimetype})
+        if rows:
+            db.session.execute(Cover.__table__.insert(), rows)
+            self.report.covers_added += len(rows)
+
+
+# ──────────────── ЭКСПОРТ ───────────────────────────────────────
+def export_books(stream, fmt, batch_size=1000, progress_file=None):
+    """Пишет весь каталог в stream. Возвращает число книг."""
+    writer = RowWriter(stream, fmt)
+    genre_names = {gid: name for gid, name in lookups.genre_choices()}
+    progress = Progress("книги", file=progress_file)
+    result = db.session.execute(
+        select(Book.id, Book.title, Book.author, Book.year, Book.publisher, Book.pages,
+               Book.description, Cover.filename)
+        .outerjoin(Cover, Cover.book_id == Book.id)
+        .order_by(Book.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for part in result.partitions():
+        genres = {}
+        for book_id, genre_id in db.session.execute(
+                select(book_genres.c.book_id, book_genres.c.genre_id)
+                .where(book_genres.c.book_id.in_([r.id for r in part]))):
+            genres.setdefault(book_id, []).append(genre_names[genre_id])
+        for r in part:
+            writer.write({
+                "title": r.title, "author": r.author, "year": r.year,
+                "publisher": r.publisher, "pages": r.pages,
+                "genres": sorted(genres.get(r.id, [])),
+                "description": r.description, "cover": r.filename,
+            })
+        progress.add(len(part))
+    progress.show()
+    return progress.done